@@ -0,0 +1,176 @@
+import argparse
+import importlib.util
+import numpy as np
+import os
+import scipy.sparse
+import subprocess
+import tempfile
+import time
+
+import tabcbm.data.scsim as scsim
+
+################################################################################
+## HELPER FUNCTIONS
+################################################################################
+
+
+def load_baseline_scsim(git_ref):
+    """
+    Loads the scsim module as it was at the given git reference so that we can
+    compare against it.
+    """
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    source = subprocess.check_output(
+        ["git", "show", f"{git_ref}:tabcbm/data/scsim.py"],
+        cwd=repo_dir,
+    )
+    with tempfile.NamedTemporaryFile(suffix=".py", delete=False) as f:
+        f.write(source)
+        path = f.name
+    spec = importlib.util.spec_from_file_location("baseline_scsim", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    os.remove(path)
+    return module
+
+
+def run_simulation(module, args, seed, **kwargs):
+    # Same simulation parameters as our synthetic single-cell dataset
+    simulator = module.scsim(
+        ngenes=args.ngenes,
+        ncells=args.ncells,
+        n_cell_types=args.num_cell_types,
+        libloc=7.64,
+        libscale=0.78,
+        mean_rate=7.68,
+        mean_shape=0.34,
+        expoutprob=0.00286,
+        expoutloc=6.15,
+        expoutscale=0.49,
+        diffexpprob=0.025,
+        diffexpdownprob=0.,
+        diffexploc=1.0,
+        diffexpscale=1.0,
+        bcv_dispersion=0.448,
+        bcv_dof=22.087,
+        act_prog_gene_sizes=[args.act_prog_genes],
+        act_prog_down_prob=0.,
+        act_prog_de_loc=1.0,
+        act_prog_de_scale=1,
+        act_prog_cell_frac=0.3,
+        act_prog_cell_types=[list(range(1, args.num_cell_types + 1))],
+        min_act_prog_usage=0.1,
+        max_act_prog_usage=0.7,
+        seed=seed,
+        **kwargs,
+    )
+    start = time.time()
+    simulator.simulate()
+    return simulator, time.time() - start
+
+
+def summary_statistics(simulator):
+    # Works for both dense (DataFrame) and chunked (sparse) counts
+    counts = simulator.counts
+    if not scipy.sparse.issparse(counts):
+        counts = scipy.sparse.csr_matrix(counts.to_numpy())
+    n_entries = counts.shape[0] * counts.shape[1]
+    mean = counts.sum() / n_entries
+    has_act_program = np.array(
+        list(simulator.cellparams['has_act_program'].values)
+    )
+    return {
+        'mean count': mean,
+        'count std': np.sqrt(counts.multiply(counts).sum() / n_entries - mean**2),
+        'fraction of zeros': 1 - counts.count_nonzero() / n_entries,
+        'mean library size': np.mean(counts.sum(axis=-1)),
+        'fraction with activity program': np.mean(has_act_program),
+    }
+
+############################################
+## Arg Parser Function
+############################################
+
+def build_parser():
+    """
+    Helper function to build our program's argument parser.
+
+    :returns ArgumentParser: The parser for our program's configuration.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            'Benchmarks the synthetic single-cell simulator.'
+        ),
+    )
+    parser.add_argument('--ncells', default=10000, type=int)
+    parser.add_argument('--ngenes', default=5000, type=int)
+    parser.add_argument('--num_cell_types', default=10, type=int)
+    parser.add_argument('--act_prog_genes', default=250, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument(
+        '--chunk_size',
+        default=None,
+        type=int,
+        help=(
+            "If given, also simulates counts in chunks of this many cells and "
+            "compares their summary statistics with the unchunked ones."
+        ),
+    )
+    parser.add_argument(
+        '--baseline_ref',
+        default=None,
+        help=(
+            "If given, the git reference (e.g., a commit hash) of the scsim "
+            "implementation to compare both runtime and summary statistics "
+            "against."
+        ),
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+
+    simulator, elapsed = run_simulation(scsim, args, seed=args.seed)
+    print(f"Simulated {args.ncells} cells x {args.ngenes} genes in {elapsed:.2f}s")
+
+    # Check that simulations are reproducible for a fixed seed
+    other, _ = run_simulation(scsim, args, seed=args.seed)
+    print(
+        "Bit-reproducible for a fixed seed:",
+        np.array_equal(simulator.counts.to_numpy(), other.counts.to_numpy()),
+    )
+
+    stats = summary_statistics(simulator)
+    if args.chunk_size is not None:
+        chunked, chunked_elapsed = run_simulation(
+            scsim,
+            args,
+            seed=args.seed,
+            chunk_size=args.chunk_size,
+        )
+        print(
+            f"Simulated in chunks of {args.chunk_size} cells in "
+            f"{chunked_elapsed:.2f}s"
+        )
+        chunked_stats = summary_statistics(chunked)
+        for name, value in stats.items():
+            print(f"\t{name}: {value:.4f} (chunked {chunked_stats[name]:.4f})")
+
+    if args.baseline_ref is not None:
+        baseline, baseline_elapsed = run_simulation(
+            load_baseline_scsim(args.baseline_ref),
+            args,
+            seed=args.seed,
+        )
+        print(
+            f"Baseline at {args.baseline_ref} took {baseline_elapsed:.2f}s "
+            f"({baseline_elapsed / elapsed:.1f}x speedup)"
+        )
+        baseline_stats = summary_statistics(baseline)
+        for name, value in stats.items():
+            print(f"\t{name}: {value:.4f} (baseline {baseline_stats[name]:.4f})")
+    elif args.chunk_size is None:
+        # Otherwise, these were already printed next to the other runs' stats
+        for name, value in stats.items():
+            print(f"\t{name}: {value:.4f}")
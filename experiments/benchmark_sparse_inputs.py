@@ -0,0 +1,225 @@
+import argparse
+import json
+import numpy as np
+import resource
+import scipy.sparse
+import subprocess
+import sys
+import tensorflow as tf
+import time
+
+import tabcbm.models.models as models
+import tabcbm.training.data_pipeline as data_pipeline
+
+from tabcbm.models.tabcbm import TabCBM
+
+################################################################################
+## HELPER FUNCTIONS
+################################################################################
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    def on_train_begin(self, logs=None):
+        self.epoch_times = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch_times.append(time.time() - self.start)
+
+
+def synthetic_counts(args):
+    # Random sparse matrix generated in chunks of cells so that we never need
+    # to sample over all ncells x ngenes entries at once
+    rng = np.random.default_rng(args.seed)
+    chunks = []
+    for start in range(0, args.ncells, args.chunk_size):
+        chunks.append(scipy.sparse.random(
+            min(args.chunk_size, args.ncells - start),
+            args.ngenes,
+            density=args.density,
+            format='csr',
+            dtype=np.float32,
+            random_state=rng,
+            data_rvs=lambda n: np.log1p(rng.poisson(5, size=n) + 1),
+        ))
+    x = scipy.sparse.vstack(chunks, format='csr')
+    y = rng.integers(0, args.num_classes, size=args.ncells).astype(np.int32)
+    return x, y
+
+
+def construct_tabcbm(args, encoder, decoder, loss_fn, sparse_inputs, x, y):
+    # TabCBM with its fused concept generator bank so that sparse inputs go
+    # through mask_sparse_features and the bank's sparse first layer. Masks
+    # are sampled independently through the low-rank sampler so that we never
+    # factorize the (identity) feature correlation matrix.
+    model = TabCBM(
+        features_to_concepts_model=encoder,
+        concepts_to_labels_model=decoder,
+        latent_dims=8,
+        n_concepts=args.n_concepts,
+        cov_mat=np.eye(args.ngenes, dtype=np.float32),
+        cov_rank=1,
+        cov_low_rank_factors=(
+            np.zeros((args.ngenes, 1), dtype=np.float32),
+            np.ones((args.ngenes,), dtype=np.float32),
+        ),
+        self_supervised_mode=False,
+        loss_fn=loss_fn,
+        concept_generator_units=[32, 16],
+        fused_concept_generators=True,
+        sparse_inputs=sparse_inputs,
+    )
+    model.compile(optimizer=tf.keras.optimizers.Adam(1e-3))
+    model._compute_supervised_loss(
+        data_pipeline.to_model_inputs(x[:2, :]),
+        y[:2],
+        c_true=None,
+    )
+    return model
+
+
+def run_path(args):
+    """
+    Trains either an encoder/decoder model (as used for TabCBM's pretraining
+    and its features to concepts model) or a full TabCBM on the synthetic
+    dataset using either the dense or the sparse input path. Returns the peak
+    RSS of this process and the time taken by each epoch.
+    """
+    x, y = synthetic_counts(args)
+    sparse_inputs = args.mode == "sparse"
+    if not sparse_inputs:
+        x = x.toarray()
+    model, encoder, decoder = models.construct_end_to_end_model(
+        input_shape=[args.ngenes],
+        num_outputs=args.num_classes,
+        encoder=models.construct_encoder(
+            input_shape=[args.ngenes],
+            units=[128, 64, 32],
+            latent_dims=8,
+            sparse_inputs=sparse_inputs,
+        ),
+        decoder=models.construct_decoder(
+            units=[16, 16],
+            num_outputs=args.num_classes,
+        ),
+        sparse_inputs=sparse_inputs,
+    )
+    if args.model == "tabcbm":
+        model = construct_tabcbm(
+            args,
+            encoder=encoder,
+            decoder=decoder,
+            loss_fn=model.loss,
+            sparse_inputs=sparse_inputs,
+            x=x,
+            y=y,
+        )
+    datasets = data_pipeline.TrialDatasets(
+        dict(
+            batch_size=args.batch_size,
+            holdout_fraction=0.2,
+            use_tf_data=args.use_tf_data,
+        ),
+        seed=args.seed,
+        x=x,
+        y=y,
+    )
+    timer = EpochTimer()
+    model.fit(
+        **datasets.fit_kwargs(x="x", y="y"),
+        epochs=args.epochs,
+        callbacks=[timer],
+        verbose=0,
+    )
+    return {
+        # ru_maxrss is given in kilobytes in Linux
+        'peak_rss_gb': resource.getrusage(
+            resource.RUSAGE_SELF
+        ).ru_maxrss / 2**20,
+        'epoch_times': timer.epoch_times,
+    }
+
+############################################
+## Arg Parser Function
+############################################
+
+def build_parser():
+    """
+    Helper function to build our program's argument parser.
+
+    :returns ArgumentParser: The parser for our program's configuration.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            'Compares the peak memory usage and epoch time of training on a '
+            'synthetic sparse cells x genes matrix using dense and sparse '
+            'inputs.'
+        ),
+    )
+    parser.add_argument('--ncells', default=100000, type=int)
+    parser.add_argument('--ngenes', default=20000, type=int)
+    parser.add_argument('--density', default=0.05, type=float)
+    parser.add_argument('--num_classes', default=10, type=int)
+    parser.add_argument('--batch_size', default=1024, type=int)
+    parser.add_argument('--epochs', default=3, type=int)
+    parser.add_argument('--chunk_size', default=10000, type=int)
+    parser.add_argument('--seed', default=42, type=int)
+    parser.add_argument(
+        '--model',
+        default='encoder',
+        choices=['encoder', 'tabcbm'],
+        help=(
+            "Model to train. \"tabcbm\" trains a TabCBM with fused concept "
+            "generators, whose copula sampler keeps a dense "
+            "ngenes x ngenes correlation matrix in both paths, so consider "
+            "using a smaller --ngenes with it."
+        ),
+    )
+    parser.add_argument('--n_concepts', default=4, type=int)
+    parser.add_argument(
+        '--use_tf_data',
+        action='store_true',
+        default=False,
+        help=(
+            "If set, the dense path is also fed through a tf.data pipeline "
+            "(the sparse path always is)."
+        ),
+    )
+    parser.add_argument(
+        '--mode',
+        default=None,
+        choices=['dense', 'sparse'],
+        help=(
+            "If given, only runs the given path in this process and prints "
+            "its results as JSON. Otherwise, each path is run in its own "
+            "subprocess so that their peak memory usages are independent."
+        ),
+    )
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+    if args.mode is not None:
+        print(json.dumps(run_path(args)))
+        sys.exit(0)
+
+    for mode in ['sparse', 'dense']:
+        output = subprocess.run(
+            [sys.executable, __file__, '--mode', mode] + sys.argv[1:],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+        # The first epoch includes tracing the model's functions
+        steady_epochs = results['epoch_times'][1:] or results['epoch_times']
+        print(
+            f"{args.model} with {mode} inputs ({args.ncells} cells x "
+            f"{args.ngenes} genes, density {args.density}):"
+        )
+        print(f"\tpeak RSS: {results['peak_rss_gb']:.2f} GB")
+        print(f"\tfirst epoch: {results['epoch_times'][0]:.2f}s")
+        print(f"\tmean epoch time: {np.mean(steady_epochs):.2f}s")
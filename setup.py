@@ -71,6 +71,7 @@ setuptools.setup(
         "tensorflow-io-gcs-filesystem>=0.22.0",
         "tensorflow-metadata>=1.4.0",
         "tensorflow-probability>=0.15.0",
+        "threadpoolctl>=2.0.0",
         "torch-vision>=0.1.6.dev0",
         "torchmetrics>=0.11.4",
         "torchvision>=0.12.0",
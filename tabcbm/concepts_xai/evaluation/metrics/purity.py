@@ -5,11 +5,14 @@ All credit due to Kazhdan et al. (arXiv:2104.06917) and
 Espinosa Zarlenta et al. (AAAI, 2023)
 """
 
+import concurrent.futures
+import multiprocessing
 import numpy as np
 import scipy
 import sklearn
 import tensorflow as tf
 
+from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
 from tensorflow.python.keras.engine import data_adapter
 
@@ -146,6 +149,253 @@ def max_alignment_matrix(matrix):
 ## Purity Matrix Computation
 ################################################################################
 
+def _purity_auc(probs, true_concepts, cardinality):
+    """
+    Computes the AUC of the given predicted probabilities (with shape
+    (n_samples, 1) for binary concepts or (n_samples, cardinality) for
+    categorical concepts) when predicting the given ground truth concept.
+    """
+    if cardinality > 2:
+        # Make sure we only compute the AUC of labels that are actually used
+        used_labels = np.sort(np.unique(true_concepts))
+
+        # And select just the labels that are in fact being used
+        true_concepts = tf.keras.utils.to_categorical(
+            true_concepts,
+            num_classes=cardinality,
+        )[:, used_labels]
+        probs = probs[:, used_labels]
+
+    return sklearn.metrics.roc_auc_score(
+        true_concepts,
+        probs,
+        multi_class='ovo',
+    )
+
+
+class _BatchedPurityPredictor(tf.keras.Model):
+    """
+    A wide model holding one independent ReLU MLP with a single hidden layer
+    for each (soft concept, true concept) pair. Its weights are block-diagonal across pairs,
+    so training it with the sum of all pair losses is equivalent to training
+    every predictor on its own, but it only requires a single call to `fit`.
+    """
+
+    def __init__(
+        self,
+        n_soft_concepts,
+        concept_label_cardinality,
+        units=32,
+        **kwargs,
+    ):
+        super(_BatchedPurityPredictor, self).__init__(**kwargs)
+        self.n_soft_concepts = n_soft_concepts
+        self.concept_label_cardinality = list(concept_label_cardinality)
+        self.n_true_concepts = len(self.concept_label_cardinality)
+        self.units = units
+        self.n_outputs = max(
+            [card if card > 2 else 1 for card in self.concept_label_cardinality]
+        )
+
+    def build(self, input_shape):
+        repr_size = input_shape[-1]
+        self.hidden_kernel = self.add_weight(
+            name="predictor_fc_1_kernel",
+            shape=(
+                self.n_soft_concepts,
+                self.n_true_concepts,
+                repr_size,
+                self.units,
+            ),
+            initializer='glorot_uniform',
+        )
+        self.hidden_bias = self.add_weight(
+            name="predictor_fc_1_bias",
+            shape=(self.n_soft_concepts, self.n_true_concepts, self.units),
+            initializer='zeros',
+        )
+        self.out_kernel = self.add_weight(
+            name="predictor_fc_out_kernel",
+            shape=(
+                self.n_soft_concepts,
+                self.n_true_concepts,
+                self.units,
+                self.n_outputs,
+            ),
+            initializer='glorot_uniform',
+        )
+        self.out_bias = self.add_weight(
+            name="predictor_fc_out_bias",
+            shape=(self.n_soft_concepts, self.n_true_concepts, self.n_outputs),
+            initializer='zeros',
+        )
+        super(_BatchedPurityPredictor, self).build(input_shape)
+
+    def call(self, inputs):
+        # inputs has shape (batch, n_soft_concepts, repr_size) and the output
+        # logits have shape (batch, n_soft_concepts, n_true_concepts, n_outputs)
+        hidden = tf.nn.relu(
+            tf.einsum('bsd,stdh->bsth', inputs, self.hidden_kernel) +
+            self.hidden_bias
+        )
+        return tf.einsum('bsth,stho->bsto', hidden, self.out_kernel) + \
+            self.out_bias
+
+    def pair_loss(self, y_true, logits):
+        y_true = tf.cast(y_true, tf.int32)
+        loss = 0.0
+        for j, cardinality in enumerate(self.concept_label_cardinality):
+            labels = tf.tile(
+                y_true[:, j:(j + 1)],
+                [1, self.n_soft_concepts],
+            )
+            if cardinality > 2:
+                pair_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=labels,
+                    logits=logits[:, :, j, :cardinality],
+                )
+            else:
+                pair_losses = tf.nn.sigmoid_cross_entropy_with_logits(
+                    labels=tf.cast(labels, logits.dtype),
+                    logits=logits[:, :, j, 0],
+                )
+            loss += tf.reduce_sum(tf.reduce_mean(pair_losses, axis=0))
+        return loss
+
+
+def _stack_soft_concepts(c_soft, indexes):
+    # Stacks all soft concept representations into a single array with shape
+    # (n_samples, n_soft_concepts, repr_size), zero-padding representations
+    # smaller than the largest one (padded inputs never affect the output of
+    # a dense layer)
+    flat = [
+        np.reshape(concept[indexes, ...], (len(indexes), -1))
+        for concept in c_soft
+    ]
+    repr_size = max([x.shape[-1] for x in flat])
+    result = np.zeros((len(indexes), len(flat), repr_size), dtype=np.float32)
+    for i, x in enumerate(flat):
+        result[:, i, :x.shape[-1]] = x
+    return result
+
+
+def _batched_mlp_purity_matrix(
+    c_soft,
+    c_true,
+    concept_label_cardinality,
+    train_indexes,
+    test_indexes,
+    predictor_train_kwags,
+):
+    n_soft_concepts = len(c_soft)
+    estimator = _BatchedPurityPredictor(
+        n_soft_concepts=n_soft_concepts,
+        concept_label_cardinality=concept_label_cardinality,
+    )
+    estimator.compile(optimizer='adam', loss=estimator.pair_loss)
+    estimator.fit(
+        _stack_soft_concepts(c_soft, train_indexes),
+        c_true[train_indexes, :],
+        **predictor_train_kwags,
+    )
+    logits = estimator.predict(
+        _stack_soft_concepts(c_soft, test_indexes),
+        batch_size=predictor_train_kwags.get('batch_size', None),
+    )
+
+    result = np.zeros(
+        (n_soft_concepts, len(concept_label_cardinality)),
+        dtype=np.float32,
+    )
+    for src_soft_concept in range(n_soft_concepts):
+        for tgt_true_concept, cardinality in enumerate(
+            concept_label_cardinality
+        ):
+            preds = logits[:, src_soft_concept, tgt_true_concept, :]
+            if cardinality > 2:
+                preds = scipy.special.softmax(preds[:, :cardinality], axis=-1)
+            else:
+                preds = preds[:, :1]
+            result[src_soft_concept, tgt_true_concept] = _purity_auc(
+                probs=preds,
+                true_concepts=c_true[test_indexes, tgt_true_concept],
+                cardinality=cardinality,
+            )
+    return result
+
+
+def _logistic_purity_row(
+    train_x,
+    train_c_true,
+    test_x,
+    test_c_true,
+    concept_label_cardinality,
+    skip_concept=None,
+):
+    # Computes the purity of a single soft concept w.r.t. all ground truth
+    # concepts so that its representation is only sent once to the worker
+    # computing it. The entry for skip_concept, if any, is set to one.
+    result = np.ones((len(concept_label_cardinality),), dtype=np.float32)
+    for tgt_true_concept, cardinality in enumerate(concept_label_cardinality):
+        if tgt_true_concept == skip_concept:
+            continue
+        if len(np.unique(train_c_true[:, tgt_true_concept])) < 2:
+            # Then there is nothing to learn from (e.g., a rare category was
+            # not sampled in the train split) and any predictor would output
+            # a constant, whose AUC is that of chance
+            result[tgt_true_concept] = 0.5
+            continue
+        estimator = LogisticRegression(max_iter=1000)
+        estimator.fit(train_x, train_c_true[:, tgt_true_concept])
+        probs = np.zeros((test_x.shape[0], max(cardinality, 2)))
+        probs[:, estimator.classes_.astype(np.int64)] = (
+            estimator.predict_proba(test_x)
+        )
+        if cardinality <= 2:
+            probs = probs[:, 1:2]
+        result[tgt_true_concept] = _purity_auc(
+            probs=probs,
+            true_concepts=test_c_true[:, tgt_true_concept],
+            cardinality=cardinality,
+        )
+    return result
+
+
+def _logistic_purity_matrix(
+    c_soft,
+    c_true,
+    concept_label_cardinality,
+    train_indexes,
+    test_indexes,
+    ignore_diags=False,
+    n_jobs=None,
+):
+    n_soft_concepts = len(c_soft)
+    n_true_concepts = len(concept_label_cardinality)
+    result = np.zeros((n_soft_concepts, n_true_concepts), dtype=np.float32)
+    # Spawn rather than fork the workers as the parent process may have
+    # already initialized TensorFlow's thread pools
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        futures = {}
+        for src_soft_concept in range(n_soft_concepts):
+            soft_x = np.reshape(c_soft[src_soft_concept], (c_true.shape[0], -1))
+            futures[src_soft_concept] = pool.submit(
+                _logistic_purity_row,
+                soft_x[train_indexes],
+                c_true[train_indexes, :],
+                soft_x[test_indexes],
+                c_true[test_indexes, :],
+                concept_label_cardinality,
+                skip_concept=src_soft_concept if ignore_diags else None,
+            )
+        for i, future in futures.items():
+            result[i, :] = future.result()
+    return result
+
+
 
 def concept_purity_matrix(
     c_soft,
@@ -155,6 +405,8 @@ def concept_purity_matrix(
     predictor_train_kwags=None,
     test_size=0.2,
     ignore_diags=False,
+    predictor="mlp",
+    n_jobs=None,
 ):
     """
     Computes a concept purity matrix where the (i,j)-th entry represents the
@@ -200,6 +452,14 @@ def concept_purity_matrix(
         given data that will be used to evaluate the trained concept-based
         classifier. The rest of the data will be used for training said
         classifier.
+    :param str predictor: How to train the default predictors. "mlp" trains
+        one MLP per (soft concept, true concept) pair sequentially,
+        "batched_mlp" trains all of these MLPs at once as a single wide model
+        with block-diagonal weights, and "logistic" fits a logistic regression
+        for every pair across a process pool. Only "mlp" supports a custom
+        predictor_model_fn.
+    :param int n_jobs: Number of worker processes used when predictor is
+        "logistic". If not given, we use as many as there are CPUs.
 
     :return np.ndarray: a matrix with shape (n_concepts, n_concepts)
         where the (i,j)-th entry specifies the testing AUC of using the i-th
@@ -207,6 +467,16 @@ def concept_purity_matrix(
     """
     # Start by handling default arguments
     predictor_train_kwags = predictor_train_kwags or {}
+    if predictor not in ["mlp", "batched_mlp", "logistic"]:
+        raise ValueError(
+            f'Unsupported purity predictor "{predictor}". Supported '
+            f'predictors are "mlp", "batched_mlp", and "logistic".'
+        )
+    if (predictor_model_fn is not None) and (predictor != "mlp"):
+        raise ValueError(
+            f'A custom predictor_model_fn can only be used with the "mlp" '
+            f'predictor but got predictor "{predictor}".'
+        )
 
     # Check that their rank is the expected one
     assert len(c_true.shape) == 2, (
@@ -327,6 +597,32 @@ def concept_purity_matrix(
         test_size=test_size,
     )
 
+    if predictor != "mlp":
+        if predictor == "batched_mlp":
+            result = _batched_mlp_purity_matrix(
+                c_soft=c_soft,
+                c_true=c_true,
+                concept_label_cardinality=concept_label_cardinality,
+                train_indexes=train_indexes,
+                test_indexes=test_indexes,
+                predictor_train_kwags=predictor_train_kwags,
+            )
+            if ignore_diags:
+                # Then for simplicity sake we will simply set these to one
+                # as they are expected to be perfectly predictable
+                np.fill_diagonal(result, 1)
+        else:
+            result = _logistic_purity_matrix(
+                c_soft=c_soft,
+                c_true=c_true,
+                concept_label_cardinality=concept_label_cardinality,
+                train_indexes=train_indexes,
+                test_indexes=test_indexes,
+                ignore_diags=ignore_diags,
+                n_jobs=n_jobs,
+            )
+        return result
+
     for src_soft_concept in range(n_soft_concepts):
         # Construct a test and training set of features for this concept
         concept_soft_train_x = c_soft[src_soft_concept][train_indexes, ...]
@@ -364,27 +660,14 @@ def concept_purity_matrix(
 
             # Compute the AUC of this classifier on the test data
             preds = estimator.predict(concept_soft_test_x)
-            true_concepts = c_true[test_indexes, tgt_true_concept]
             if concept_label_cardinality[tgt_true_concept] > 2:
                 # Then lets apply a softmax activation over all the probability
                 # classes
                 preds = scipy.special.softmax(preds, axis=-1)
-
-                # And make sure we only compute the AUC of labels that are
-                # actually used
-                used_labels = np.sort(np.unique(true_concepts))
-
-                # And select just the labels that are in fact being used
-                true_concepts = tf.keras.utils.to_categorical(
-                    true_concepts,
-                    num_classes=concept_label_cardinality[tgt_true_concept],
-                )[:, used_labels]
-                preds = preds[:, used_labels]
-
-            auc = sklearn.metrics.roc_auc_score(
-                true_concepts,
-                preds,
-                multi_class='ovo',
+            auc = _purity_auc(
+                probs=preds,
+                true_concepts=c_true[test_indexes, tgt_true_concept],
+                cardinality=concept_label_cardinality[tgt_true_concept],
             )
 
             # Finally, time to populate the actual entry of our resulting
@@ -1,14 +1,18 @@
 import anndata as ad
-import itertools
+import hashlib
 import joblib
+import json
+import logging
 import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pandas as pd
 import scanpy as sc
 import scipy
+import scipy.sparse
 import tensorflow as tf
 import tensorflow_datasets as tfds
+import time
 
 from pathlib import Path
 from sklearn.model_selection import train_test_split
@@ -19,6 +23,35 @@ import tabcbm.data.scsim as scsim
 ## Synthetic Tabular Dataset
 ###################################
 
+def _tabular_synth_concepts(latent, n_concepts, spacing, overlap):
+    # Shape: [B, n_concepts]
+    if (overlap == 0) and (n_concepts * spacing <= latent.shape[-1]):
+        # Then all concept windows are contiguous and non-overlapping so we
+        # can compute all of their sums with a single reduction
+        sums = np.sum(
+            np.reshape(
+                latent[:, :n_concepts * spacing],
+                (latent.shape[0], n_concepts, spacing),
+            ),
+            axis=-1,
+        )
+    else:
+        sums = np.stack(
+            [
+                np.sum(
+                    latent[
+                        :,
+                        max(i * spacing - overlap, 0):
+                        min((i + 1) * spacing + overlap, latent.shape[-1])
+                    ],
+                    axis=-1,
+                )
+                for i in range(n_concepts)
+            ],
+            axis=-1,
+        )
+    return (sums > 0).astype(np.int32)
+
 def generate_tabular_synth_data(
     n_features,
     spacing=10,
@@ -29,27 +62,49 @@ def generate_tabular_synth_data(
     test_percent=0.2,
     overlap=0,
     seed=0,
+    chunk_size=None,
 ):
+    # If chunk_size is given, samples are generated in chunks of chunk_size
+    # rows so that the full latent matrix is never kept in memory (this
+    # requires latent_map to operate on each sample independently). The
+    # generated dataset is the same regardless of the chunk size.
     np.random.seed(seed)
-    latent = np.random.normal(size=(dataset_size, n_features)).astype(np.float32)
-    X_train = latent_map(latent)
-    c_train = np.zeros((dataset_size, n_concepts), dtype=np.int32)
     ground_truth_concept_masks = np.zeros(shape=(n_concepts, n_features), dtype=np.int32)
     for i in range(n_concepts):
         start = i * spacing
         start = max(start - overlap, 0)
         end = (i + 1) * spacing
-        end = min(end + overlap, latent.shape[-1])
-        c_train[:, i] = (
-            np.sum(latent[:, start:end], axis=-1) > 0
-        ).astype(np.int32)
+        end = min(end + overlap, n_features)
         ground_truth_concept_masks[i, start:end] = 1
-    y_train = np.zeros((dataset_size,), dtype=np.int32)
-    for i in range(dataset_size):
-        bin_str = ''
-        for c in c_train[i, :]:
-            bin_str += str(c)
-        y_train[i] = int(bin_str, 2)
+    chunk_size = chunk_size or dataset_size
+    X_train = None
+    c_train = np.zeros((dataset_size, n_concepts), dtype=np.int32)
+    for start in range(0, dataset_size, chunk_size):
+        end = min(start + chunk_size, dataset_size)
+        latent = np.random.normal(size=(end - start, n_features)).astype(np.float32)
+        X_chunk = latent_map(latent)
+        if end - start == dataset_size:
+            X_train = X_chunk
+        else:
+            if X_train is None:
+                X_train = np.empty(
+                    (dataset_size,) + X_chunk.shape[1:],
+                    dtype=X_chunk.dtype,
+                )
+            X_train[start:end] = X_chunk
+        c_train[start:end, :] = _tabular_synth_concepts(
+            latent,
+            n_concepts=n_concepts,
+            spacing=spacing,
+            overlap=overlap,
+        )
+    # The label of each sample is the integer whose binary representation
+    # is given by its concept values (first concept being the most
+    # significant bit)
+    y_train = np.dot(
+        c_train,
+        2 ** np.arange(n_concepts - 1, -1, -1, dtype=np.int64),
+    ).astype(np.int32)
     if plot:
         plt.hist(y_train, bins=len(np.unique(y_train)), weights=np.ones(y_train.shape[0]) / y_train.shape[0])
         plt.show()
@@ -76,6 +131,102 @@ def generate_tabular_synth_data(
 ###################################
 
 
+# Fixed simulator parameters used by our synthetic single-cell dataset
+_SC_SIMULATOR_PARAMS = dict(
+    libloc=7.64,
+    libscale=0.78,
+    mean_rate=7.68,
+    mean_shape=0.34,
+    expoutprob=0.00286,
+    expoutloc=6.15,
+    expoutscale=0.49,
+    diffexpprob=0.025,
+    diffexpdownprob=0.,
+    diffexploc=1.0,
+    diffexpscale=1.0,
+    bcv_dispersion=0.448,
+    bcv_dof=22.087,
+    act_prog_down_prob=0.,
+    act_prog_de_loc=1.0,
+    act_prog_de_scale=1,
+    act_prog_cell_frac=0.3,
+    min_act_prog_usage=0.1,
+    max_act_prog_usage=0.7,
+)
+
+# Arrays stored in a synthetic single-cell dataset cache file
+_SC_DATASET_ARRAYS = [
+    'X_train',
+    'X_test',
+    'y_train',
+    'y_test',
+    'c_train',
+    'c_test',
+    'ground_truth_concept_masks',
+]
+
+# Bump whenever the simulation or preprocessing code changes its outputs
+_SC_DATASET_CACHE_VERSION = 2
+
+
+def _sc_dataset_cache_key(**params):
+    """
+    Returns a hash of all the given simulator and preprocessing parameters
+    (together with the fixed simulator parameters) used to address cached
+    synthetic single-cell datasets.
+    """
+    params = dict(
+        params,
+        simulator_params=_SC_SIMULATOR_PARAMS,
+        cache_version=_SC_DATASET_CACHE_VERSION,
+    )
+    serialized = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:32]
+
+
+def _plot_sc_dataset(adata, n_pcs, n_neighbors):
+    # Run PCA and make a scree plot to determine number of PCs to use for UMAP
+    if 'X_pca' not in adata.obsm:
+        sc.pp.pca(adata)
+    sc.pl.pca_variance_ratio(adata, log=True)
+
+    # Construct the nearest neighbor graph and run UMAP, which are only needed
+    # for these plots
+    if 'X_umap' not in adata.obsm:
+        sc.pp.neighbors(adata, n_neighbors=n_neighbors, n_pcs=n_pcs)
+        sc.tl.umap(adata)
+
+    # Plot the UMAP with some cannonical marker genes to see that the apparent clustering makes sense
+    sc.pl.umap(
+        adata,
+        color='cell_type_str_viz',
+        use_raw=True,
+        ncols=3,
+        title="Identity GEPs"
+    )
+    sc.pl.umap(
+        adata,
+        color='viz_label_str',
+        use_raw=True,
+        ncols=3,
+        title='Task Label Annotations',
+    )
+    sc.pl.umap(
+        adata,
+        color='activity_program_str',
+        use_raw=True,
+        ncols=3,
+        title="Activity Programs",
+    )
+    sc.pl.umap(
+        adata,
+        color='activity_program_str_viz',
+        use_raw=True,
+        ncols=3,
+        title="Activity GEP Status"
+    )
+
+
 def generate_synthetic_sc_dataset(
     num_cell_types=10,
     ndoublets=0,
@@ -92,102 +243,83 @@ def generate_synthetic_sc_dataset(
     min_counts=200,
     dataset_dir=None,
     act_prog_cell_types=None,
+    counts_chunk_size=None,
+    load_adata=True,
 ):
+    """
+    Simulates and preprocesses our synthetic single-cell dataset.
+
+    If dataset_dir is given, the resulting arrays are cached in a single file
+    in that directory addressed by a hash of all the simulator arguments, the
+    seed, and the preprocessing options, so that changing any of them
+    produces a new dataset. The processed AnnData is cached next to it and
+    only loaded from the cache if load_adata (or plot) is set; otherwise
+    None is returned in its place.
+    """
+    act_prog_cell_types = act_prog_cell_types or [
+        list(range(1, num_cell_types + 1, 1))
+        for _ in act_prog_gene_sizes
+    ]
     if dataset_dir is not None:
-        results = []
-        broken = False
-        for var_name in [
-            'X_train',
-            'X_test',
-            'y_train',
-            'y_test',
-            'c_train',
-            'c_test',
-            'ground_truth_concept_masks',
-        ]:
-            path = os.path.join(dataset_dir, var_name + f"_seed_{seed}.npy")
-            if os.path.exists(path):
-                results.append(np.load(path))
-            else:
-                broken = True
-                break
-        adata_path = os.path.join(dataset_dir, f"adata_seed_{seed}.joblib")
-        if (not broken) and os.path.exists(adata_path):
-            adata = joblib.load(adata_path)
-            results.append(adata)
-            if plot:
-                sc.pl.pca_variance_ratio(adata, log=True)
-                sc.pl.umap(
-                    adata,
-                    color='cell_type_str_viz',
-                    use_raw=True,
-                    ncols=3,
-                    title="Identity GEPs"
-                )
-                sc.pl.umap(
-                    adata,
-                    color='viz_label_str',
-                    use_raw=True,
-                    ncols=3,
-                    title='Task Label Annotations',
-                )
-                sc.pl.umap(
-                    adata,
-                    color='activity_program_str',
-                    use_raw=True,
-                    ncols=3,
-                    title="Activity Programs",
-                )
-                sc.pl.umap(
-                    adata,
-                    color='activity_program_str_viz',
-                    use_raw=True,
-                    ncols=3,
-                    title="Activity GEP Status"
-                )
-            return tuple(results)
+        cache_key = _sc_dataset_cache_key(
+            num_cell_types=num_cell_types,
+            ndoublets=ndoublets,
+            ngenes=ngenes,
+            ncells=ncells,
+            act_prog_gene_sizes=act_prog_gene_sizes,
+            act_prog_cell_types=act_prog_cell_types,
+            seed=seed,
+            n_pcs=n_pcs,
+            n_neighbors=n_neighbors,
+            test_percent=test_percent,
+            min_cells=min_cells,
+            min_genes=min_genes,
+            min_counts=min_counts,
+            counts_chunk_size=counts_chunk_size,
+        )
+        cache_path = os.path.join(dataset_dir, f"sc_dataset_{cache_key}.npz")
+        adata_path = os.path.join(dataset_dir, f"sc_adata_{cache_key}.joblib")
+        load_adata = load_adata or plot
+        if os.path.exists(cache_path) and (
+            (not load_adata) or os.path.exists(adata_path)
+        ):
+            with np.load(cache_path) as cached:
+                results = [cached[var_name] for var_name in _SC_DATASET_ARRAYS]
+            adata = None
+            if load_adata:
+                adata = joblib.load(adata_path)
+                if plot:
+                    _plot_sc_dataset(adata, n_pcs=n_pcs, n_neighbors=n_neighbors)
+            return tuple(results) + (adata,)
 
     simulator = scsim.scsim(
         ngenes=ngenes,
         ncells=ncells,
         n_cell_types=num_cell_types,
         ndoublets=ndoublets,
-
-        libloc=7.64,
-        libscale=0.78,
-        mean_rate=7.68,
-        mean_shape=0.34,
-        expoutprob=0.00286,
-        expoutloc=6.15,
-        expoutscale=0.49,
-        diffexpprob=0.025,
-        diffexpdownprob=0.,
-        diffexploc=1.0,
-        diffexpscale=1.0,
-        bcv_dispersion=0.448,
-        bcv_dof=22.087,
-
         act_prog_gene_sizes=act_prog_gene_sizes,
-        act_prog_down_prob=0.,
-        act_prog_de_loc=1.0,
-        act_prog_de_scale=1,
-        act_prog_cell_frac=0.3,
-        act_prog_cell_types=act_prog_cell_types or [
-            list(range(1, num_cell_types + 1, 1))
-            for _ in act_prog_gene_sizes
-        ],
-        min_act_prog_usage=0.1,
-        max_act_prog_usage=0.7,
+        act_prog_cell_types=act_prog_cell_types,
         seed=seed,
+        chunk_size=counts_chunk_size,
+        **_SC_SIMULATOR_PARAMS,
     )
     simulator.simulate()
 
-    simulator.cellparams['n_counts'] = np.sum(simulator.counts.to_numpy(), axis=-1)
+    if scipy.sparse.issparse(simulator.counts):
+        # Then counts were generated in chunks as a sparse matrix
+        n_counts = np.asarray(simulator.counts.sum(axis=-1)).ravel()
+    else:
+        n_counts = np.sum(simulator.counts.to_numpy(), axis=-1)
+    simulator.cellparams['n_counts'] = n_counts
     simulator.cellparams['cell_type_str'] = [
         f'cell_type_{i}' for i in simulator.cellparams['cell_type']
     ]
 
-    adata = ad.AnnData(simulator.counts, obs=simulator.cellparams)
+    adata = ad.AnnData(
+        simulator.counts,
+        obs=simulator.cellparams,
+        var=pd.DataFrame(index=simulator.genenames),
+    )
     # And add a label based on the activity and identity programs generates
     adata.obs['label'] = [0 if np.sum(x) == 0 else 1 for x in adata.obs['has_act_program']]
     adata.obs['label_str'] = [f'class_{0 if np.sum(x) == 0 else 1}' for x in adata.obs['has_act_program']]
@@ -201,21 +333,10 @@ def generate_synthetic_sc_dataset(
     sc.pp.log1p(adata)
 
     # Make combination labels
-    used_combos = set()
-    for i in range(adata.shape[0]):
-        used_combos.add((adata.obs.cell_type[i], tuple(adata.obs.has_act_program[i])))
-    combination_label_map = {}
-    inv_combination_label_map = {}
-    for cell_type in range(1, simulator.n_cell_types + 1):
-        for activity_program_combo in itertools.product(*[[0, 1] for _ in simulator.act_prog_gene_sizes]):
-            key = (cell_type, tuple(activity_program_combo))
-            if key in used_combos:
-                combination_label_map[key] = len(combination_label_map)
-                inv_combination_label_map[combination_label_map[key]] = key
-    adata.obs['combination_label'] = [
-        combination_label_map[(adata.obs.cell_type[i], tuple(adata.obs.has_act_program[i]))]
-        for i in range(adata.shape[0])
-    ]
+    adata.obs['combination_label'] = scsim.combination_labels(
+        cell_types=adata.obs['cell_type'].to_numpy(),
+        has_act_program=np.stack(adata.obs['has_act_program'].to_numpy()),
+    )
     adata.obs['combination_label_str'] = [f'comb_label_{x}' for x in adata.obs['combination_label']]
     adata.obs['viz_label_str'] = [f'{x+1}' for x in adata.obs['combination_label']]
 
@@ -226,59 +347,11 @@ def generate_synthetic_sc_dataset(
     # Run PCA
     sc.pp.pca(adata)
 
-    if plot:
-        # Make a scree plot to determine number of PCs to use for UMAP
-        sc.pl.pca_variance_ratio(adata, log=True)
-
-    # Construct the nearest neighbor graph for UMAP
-    sc.pp.neighbors(adata, n_neighbors=n_neighbors, n_pcs=n_pcs)
-
-    # Run UMAP
-    sc.tl.umap(adata)
-
-    # Plot the UMAP with some cannonical marker genes to see that the apparent clustering makes sense
     adata.obs['cell_type_str_viz'] = [f'Identity GEP {i}' for i in adata.obs['cell_type']]
-    if plot:
-        sc.pl.umap(
-            adata,
-            color='cell_type_str_viz',
-            use_raw=True,
-            ncols=3,
-            title="Identity GEPs"
-        )
-
-    # with rc_context({'figure.figsize': (8, 6)}):
-    # Plot the UMAP with some cannonical marker genes to see that the apparent clustering makes sense
-    if plot:
-        sc.pl.umap(
-            adata,
-            color='viz_label_str',
-            use_raw=True,
-            ncols=3,
-            title='Task Label Annotations',
-            gene_symbols=[str(i + 1) for i in range(len(combination_label_map))],
-        )
-
-    # Plot the UMAP with some cannonical marker genes to see that the apparent clustering makes sense
-    if plot:
-        sc.pl.umap(
-            adata,
-            color='activity_program_str',
-            use_raw=True,
-            ncols=3,
-            title="Activity Programs",
-        )
-
-    # Plot the UMAP with some cannonical marker genes to see that the apparent clustering makes sense
     adata.obs['activity_program_str_viz'] = ['True'if x[0] else 'False' for x in adata.obs['has_act_program']]
     if plot:
-        sc.pl.umap(
-            adata,
-            color='activity_program_str_viz',
-            use_raw=True,
-            ncols=3,
-            title="Activity GEP Status"
-        )
+        # The neighbor graph and UMAP embedding are only used for plotting
+        _plot_sc_dataset(adata, n_pcs=n_pcs, n_neighbors=n_neighbors)
 
     # And produce the training data we will all love and use
     X_train = adata.to_df().to_numpy()
@@ -295,20 +368,13 @@ def generate_synthetic_sc_dataset(
         axis=-1,
     )
 
-    # To Construct ground truth masks first look over all identity GEPs
-    ground_truth_concept_masks = []
-    for prog_idx in range(num_cell_types):
-        ground_truth_concept_masks.append(np.array([
-            1 if simulator.geneparams[f'cell_type_{prog_idx + 1}_gene_selection'][j]
-            else 0 for j in range(simulator.ngenes)
-            if kept_gene_mask[j]
-        ]))
-    # Then over all activity GEPs
-    for prog_idx in range(len(simulator.activity_program_genes)):
-        ground_truth_concept_masks.append(np.array([
-            1 if j in simulator.activity_program_genes[prog_idx] else 0 for j in range(simulator.ngenes)
-            if kept_gene_mask[j]
-        ]))
+    # To Construct ground truth masks first look over all identity GEPs and
+    # then over all activity GEPs
+    ground_truth_concept_masks = scsim.ground_truth_concept_masks(
+        simulator,
+        n_cell_types=num_cell_types,
+        kept_gene_mask=kept_gene_mask,
+    )
 
     # Split it up into test/train splits
     X_train, X_test, y_train, y_test, c_train, c_test = train_test_split(
@@ -321,23 +387,21 @@ def generate_synthetic_sc_dataset(
 
     if dataset_dir is not None:
         Path(dataset_dir).mkdir(parents=True, exist_ok=True)
-        for var_name, var in [
-            ('X_train', X_train),
-            ('X_test', X_test),
-            ('y_train', y_train),
-            ('y_test', y_test),
-            ('c_train', c_train),
-            ('c_test', c_test),
-            ('ground_truth_concept_masks', ground_truth_concept_masks),
-        ]:
-            np.save(
-                os.path.join(dataset_dir, var_name + f"_seed_{seed}.npy"),
-                var,
-            )
-        joblib.dump(
-            adata,
-            os.path.join(dataset_dir, f"adata_seed_{seed}.joblib")
+        joblib.dump(adata, adata_path)
+        # Written last (and atomically) so that a cache hit always has all
+        # of its arrays
+        tmp_path = cache_path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            X_train=X_train,
+            X_test=X_test,
+            y_train=y_train,
+            y_test=y_test,
+            c_train=c_train,
+            c_test=c_test,
+            ground_truth_concept_masks=np.array(ground_truth_concept_masks),
         )
+        os.replace(tmp_path, cache_path)
     return (
         X_train,
         X_test,
@@ -414,8 +478,19 @@ def generate_pbmc_data(
     n_pcs=32,
     n_neighbors=100,
     dataset_dir="data/pbmc/",
+    sparse=False,
 ):
-    counts = scipy.sparse.load_npz(os.path.join(dataset_dir, "X.npz")).toarray()
+    """
+    Loads and preprocesses the PBMC dataset. If sparse is True, the counts
+    are kept as a scipy CSR matrix all the way through preprocessing and the
+    returned X_train and X_test are float32 CSR matrices rather than dense
+    arrays.
+    """
+    counts = scipy.sparse.load_npz(os.path.join(dataset_dir, "X.npz"))
+    if sparse:
+        counts = counts.tocsr().astype(np.float32)
+    else:
+        counts = counts.toarray()
     labels = scipy.sparse.load_npz(os.path.join(dataset_dir, "y.npz")).toarray()
     labels = np.reshape(labels, -1)
     obs = pd.DataFrame(data=labels,columns=["label"])
@@ -458,7 +533,10 @@ def generate_pbmc_data(
         )
 
     # And produce the training data we will all love and use
-    X_train = adata.to_df().to_numpy()
+    if sparse:
+        X_train = scipy.sparse.csr_matrix(adata.X, dtype=np.float32)
+    else:
+        X_train = adata.to_df().to_numpy()
     y_train = adata.obs["label"].to_numpy().astype(np.int32)
 
     # Split it up into test/train splits
@@ -505,6 +583,241 @@ def generate_forest_cover_data(
 ## Higgs dataset
 ###################################
 
+def memmap_split_indices(n_samples, test_percent=0.2, seed=42):
+    """
+    Returns the (train_idxs, test_idxs) index arrays of a random train/test
+    split of n_samples. These are exactly the rows that train_test_split
+    would select when called with the same test size and seed.
+    """
+    return train_test_split(
+        np.arange(n_samples),
+        test_size=test_percent,
+        random_state=seed,
+    )
+
+def open_memmap_store(store_dir, mode='r'):
+    """
+    Opens all the arrays in a dataset store written with write_memmap_store
+    as memory-mapped arrays (no data is read into memory until it is
+    accessed).
+    """
+    return {
+        filename[:-len(".npy")]: np.load(
+            os.path.join(store_dir, filename),
+            mmap_mode=mode,
+        )
+        for filename in sorted(os.listdir(store_dir))
+        if filename.endswith(".npy")
+    }
+
+def write_memmap_store(store_dir, chunk_size=1000000, **array_parts):
+    """
+    Writes a dataset store in store_dir with one .npy file per given array.
+    Each array can be given as a list of parts (e.g., [X_train, X_test])
+    which are concatenated along their first dimension directly into the
+    file, chunk by chunk, so that no in-memory copy of the full array is ever
+    made. Returns the store opened in read-only memory-mapped mode.
+    """
+    Path(store_dir).mkdir(parents=True, exist_ok=True)
+    for name, parts in array_parts.items():
+        if not isinstance(parts, (list, tuple)):
+            parts = [parts]
+        n_rows = sum(part.shape[0] for part in parts)
+        # Write to a temporary file first so that an interrupted write never
+        # leaves a corrupted store behind
+        tmp_path = os.path.join(store_dir, f"{name}.npy.tmp")
+        out = np.lib.format.open_memmap(
+            tmp_path,
+            mode='w+',
+            dtype=parts[0].dtype,
+            shape=(n_rows,) + parts[0].shape[1:],
+        )
+        start = 0
+        for part in parts:
+            for i in range(0, part.shape[0], chunk_size):
+                chunk = part[i:i + chunk_size]
+                out[start:start + chunk.shape[0]] = chunk
+                start += chunk.shape[0]
+        out.flush()
+        del out
+        os.replace(tmp_path, os.path.join(store_dir, f"{name}.npy"))
+    return open_memmap_store(store_dir)
+
+def gather_memmap_rows(arrays, idxs, chunk_size=1000000):
+    """
+    Gathers rows idxs of all the given (possibly memory-mapped) 2D arrays and
+    concatenates them along their last axis into a single array. The output
+    is preallocated and filled chunk by chunk so that the only full-size
+    allocation is the output itself.
+    """
+    n_cols = [array.shape[-1] for array in arrays]
+    out = np.empty((len(idxs), sum(n_cols)), dtype=arrays[0].dtype)
+    for i in range(0, len(idxs), chunk_size):
+        chunk_idxs = idxs[i:i + chunk_size]
+        # Reading rows in order makes memory-mapped accesses sequential
+        order = np.argsort(chunk_idxs, kind='stable')
+        offset = 0
+        for array, n in zip(arrays, n_cols):
+            out[i + order, offset:offset + n] = array[chunk_idxs[order]]
+            offset += n
+    return out
+
+HIGGS_HIGH_LEVEL_FEATS = sorted([
+    'm_bb',
+    'm_jj',
+    'm_jjj',
+    'm_jlv',
+    'm_lv',
+    'm_wbb',
+    'm_wwbb',
+])
+
+def ingest_higgs_data(
+    store_dir=None,
+    load_batch_size=8096,
+    checkpoint_every=100,
+):
+    """
+    Streams the Higgs dataset from tensorflow_datasets directly into
+    preallocated X (low-level features), c (high-level features) and y
+    (labels) matrices. If store_dir is given, these matrices are
+    memory-mapped .npy files in that directory and ingestion can be resumed
+    from the last checkpoint (taken every checkpoint_every batches) if it is
+    interrupted. Returns the dictionary of ingested arrays.
+    """
+    prev = os.environ.get("CUDA_VISIBLE_DEVICES", None)
+    # Ignote GPU to avoid flooding it with data
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+
+    progress_file = None
+    rows_done = 0
+    if store_dir:
+        Path(store_dir).mkdir(parents=True, exist_ok=True)
+        progress_file = os.path.join(store_dir, "ingest_progress.json")
+        if os.path.exists(progress_file) and os.path.exists(
+            os.path.join(store_dir, "X.npy.partial")
+        ):
+            with open(progress_file, "r") as f:
+                rows_done = json.load(f)["rows_done"]
+            print(f"Resuming Higgs ingestion from row {rows_done}...")
+
+    print("Loading Higgs dataset...")
+    # Files are read in a fixed order so that we can resume ingestion from
+    # any given row
+    ds, info = tfds.load(
+        'higgs',
+        split=f'train[{rows_done}:]',
+        shuffle_files=False,
+        with_info=True,
+    )
+    print("\tDone")
+    n_rows = info.splits['train'].num_examples
+    # Compute our column order only once
+    feats = sorted(ds.element_spec.keys())
+    x_feats = [
+        feat_name for feat_name in feats
+        if (feat_name != "class_label") and (
+            feat_name not in HIGGS_HIGH_LEVEL_FEATS
+        )
+    ]
+    c_feats = [
+        feat_name for feat_name in feats
+        if feat_name in HIGGS_HIGH_LEVEL_FEATS
+    ]
+    shapes = dict(
+        X=(n_rows, len(x_feats)),
+        c=(n_rows, len(c_feats)),
+        y=(n_rows,),
+    )
+    dtypes = {
+        name: ds.element_spec[feat_names[0]].dtype.as_numpy_dtype
+        for name, feat_names in [
+            ("X", x_feats),
+            ("c", c_feats),
+            ("y", ["class_label"]),
+        ]
+    }
+    if store_dir:
+        outputs = {
+            name: np.lib.format.open_memmap(
+                os.path.join(store_dir, f"{name}.npy.partial"),
+                mode='r+' if rows_done else 'w+',
+                dtype=dtypes[name],
+                shape=shapes[name],
+            )
+            for name in shapes
+        }
+    else:
+        outputs = {
+            name: np.empty(shapes[name], dtype=dtypes[name])
+            for name in shapes
+        }
+
+    def _checkpoint(rows):
+        if progress_file is None:
+            return
+        for output in outputs.values():
+            output.flush()
+        with open(progress_file + ".tmp", "w") as f:
+            json.dump({"rows_done": rows}, f)
+        os.replace(progress_file + ".tmp", progress_file)
+
+    print("Generating Higgs matrices...")
+    start_time = time.time()
+    start_row = rows_done
+    n_batches = int(np.ceil((n_rows - rows_done) / load_batch_size))
+    for i, x in enumerate(tfds.as_numpy(ds.batch(load_batch_size))):
+        batch_size = x["class_label"].shape[0]
+        end = rows_done + batch_size
+        for j, feat_name in enumerate(x_feats):
+            outputs["X"][rows_done:end, j] = x[feat_name]
+        for j, feat_name in enumerate(c_feats):
+            outputs["c"][rows_done:end, j] = x[feat_name]
+        outputs["y"][rows_done:end] = x["class_label"]
+        rows_done = end
+        if (i + 1) % checkpoint_every == 0:
+            _checkpoint(rows_done)
+        rows_per_sec = (rows_done - start_row) / max(time.time() - start_time, 1e-8)
+        print(
+            f'{(i + 1)/n_batches * 100:.2f}% (size {i + 1}, '
+            f'{rows_per_sec:.0f} rows/s)',
+            end="\r",
+        )
+    elapsed = time.time() - start_time
+    rows_per_sec = (rows_done - start_row) / max(elapsed, 1e-8)
+    print(
+        f"\tDone! Ingested {rows_done - start_row} rows in {elapsed:.2f}s "
+        f"({rows_per_sec:.0f} rows/s)"
+    )
+    logging.info(f"Higgs ingestion throughput: {rows_per_sec:.0f} rows/s")
+    if prev is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = prev
+    else:
+        del os.environ["CUDA_VISIBLE_DEVICES"]
+
+    if not store_dir:
+        return outputs
+    _checkpoint(rows_done)
+    # Close our memory maps before moving them into their final location
+    outputs.clear()
+    for name in shapes:
+        os.replace(
+            os.path.join(store_dir, f"{name}.npy.partial"),
+            os.path.join(store_dir, f"{name}.npy"),
+        )
+    with open(os.path.join(store_dir, "ingest_stats.json"), "w") as f:
+        json.dump(
+            {
+                "rows": rows_done,
+                "rows_ingested": rows_done - start_row,
+                "seconds": elapsed,
+                "rows_per_second": rows_per_sec,
+            },
+            f,
+        )
+    os.remove(progress_file)
+    return open_memmap_store(store_dir)
+
 def generate_higgs_data(
     include_high_level=True,
     test_percent=0.2,
@@ -512,98 +825,55 @@ def generate_higgs_data(
     load_batch_size=8096,
     dataset_dir="data/higgs_numpy"
 ):
-    if os.path.exists(os.path.join(dataset_dir, "X_train.npy")):
-        X_train = np.load(os.path.join(dataset_dir, "X_train.npy"))
-        X_test = np.load(os.path.join(dataset_dir, "X_test.npy"))
-        y_train = np.load(os.path.join(dataset_dir, "y_train.npy"))
-        y_test = np.load(os.path.join(dataset_dir, "y_test.npy"))
-        c_train = np.load(os.path.join(dataset_dir, "c_train.npy"))
-        c_test = np.load(os.path.join(dataset_dir, "c_test.npy"))
-        # Redo the sampling to respect the seed selection and also
-        # any possible changes in test percents!
-        X_train, X_test, y_train, y_test, c_train, c_test = train_test_split(
-            np.concatenate([X_train, X_test], axis=0),
-            np.concatenate([y_train, y_test], axis=0),
-            np.concatenate([c_train, c_test], axis=0),
-            test_size=test_percent,
-            random_state=seed,
+    # All samples are stored once in a memory-mapped store and train/test
+    # splits are gathered from it using index arrays
+    store_dir = os.path.join(dataset_dir, "memmap_store") if dataset_dir else None
+    if store_dir and os.path.exists(os.path.join(store_dir, "X.npy")):
+        store = open_memmap_store(store_dir)
+    elif dataset_dir and os.path.exists(os.path.join(dataset_dir, "X_train.npy")):
+        # Then this dataset was serialized as separate train/test matrices so
+        # let's move it into our store (concatenating train and test as it
+        # used to be done before resampling the splits)
+        store = write_memmap_store(
+            store_dir,
+            **{
+                name: [
+                    np.load(
+                        os.path.join(dataset_dir, f"{name}_{split}.npy"),
+                        mmap_mode='r',
+                    )
+                    for split in ["train", "test"]
+                ]
+                for name in ["X", "y", "c"]
+            }
         )
     else:
         # Else let's generate the data from scratch
-        high_level_feats = sorted([
-            'm_bb',
-            'm_jj',
-            'm_jjj',
-            'm_jlv',
-            'm_lv',
-            'm_wbb',
-            'm_wwbb',
-        ])
-        prev = os.environ.get("CUDA_VISIBLE_DEVICES", None)
-        # Ignote GPU to avoid flooding it with data
-        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
-
-        print("Loading Higgs dataset...")
-        ds = tfds.load('higgs', split='train', shuffle_files=True)
-        print("\tDone")
-        ds = ds.batch(load_batch_size)
-        Xs = [None for _ in range(len(ds))]
-        ys = [None for _ in range(len(ds))]
-        Cs = [None for _ in range(len(ds))]
-
-        print("Generating Higgs matrices...")
-        ds_numpy = tfds.as_numpy(ds)
-        print("\tTurned to numpy")
-        for i, x in enumerate(ds_numpy):
-            print(f'{(i + 1)/len(ds) * 100:.2f}% (size {i + 1})', end="\r")
-            feats = sorted(x.keys())
-            tensor = []
-            concepts = []
-            for feat_name in feats:
-                if feat_name == "class_label":
-                    y = x[feat_name]
-                elif feat_name in high_level_feats:
-                    concepts.append(x[feat_name])
-                else:
-                    tensor.append(x[feat_name])
-            ys[i] = np.array(y)
-            Xs[i] = np.array(tensor).T
-            Cs[i] = np.array(concepts).T
-        print("\tDone!")
-        X = np.concatenate(Xs, axis=0)
-        y = np.concatenate(ys, axis=0)
-        C = np.concatenate(Cs, axis=0)
-        if prev is not None:
-            os.environ["CUDA_VISIBLE_DEVICES"] = prev
-        else:
-            del os.environ["CUDA_VISIBLE_DEVICES"]
-        X_train, X_test, y_train, y_test, c_train, c_test = train_test_split(
-            X,
-            y,
-            C,
-            test_size=test_percent,
-            random_state=seed,
+        store = ingest_higgs_data(
+            store_dir=store_dir,
+            load_batch_size=load_batch_size,
         )
-        if dataset_dir:
-            Path(dataset_dir).mkdir(parents=True, exist_ok=True)
-            for var_name, var in [
-                ('X_train', X_train),
-                ('X_test', X_test),
-                ('y_train', y_train),
-                ('y_test', y_test),
-                ('c_train', c_train),
-                ('c_test', c_test),
-            ]:
-                np.save(
-                    os.path.join(dataset_dir, var_name + f".npy"),
-                    var,
-                )
+
+    train_idxs, test_idxs = memmap_split_indices(
+        store["X"].shape[0],
+        test_percent=test_percent,
+        seed=seed,
+    )
+    y_train = store["y"][train_idxs]
+    y_test = store["y"][test_idxs]
     if not include_high_level:
-        return X_train, X_test, y_train.astype(np.int32), y_test.astype(np.int32), c_train, c_test
+        return (
+            gather_memmap_rows([store["X"]], train_idxs),
+            gather_memmap_rows([store["X"]], test_idxs),
+            y_train.astype(np.int32),
+            y_test.astype(np.int32),
+            gather_memmap_rows([store["c"]], train_idxs),
+            gather_memmap_rows([store["c"]], test_idxs),
+        )
 
     # Else let's put everything back into the same array
-    X_train = np.concatenate([X_train, c_train], axis=-1)
-    X_test = np.concatenate([X_test, c_test], axis=-1)
+    X_train = gather_memmap_rows([store["X"], store["c"]], train_idxs)
+    X_test = gather_memmap_rows([store["X"], store["c"]], test_idxs)
     return X_train, X_test, y_train, y_test
 
 
@@ -680,6 +950,7 @@ def generate_synth_sc_data(
     act_prog_size=250,
     act_prog_cell_types=None,
     plot=False,
+    counts_chunk_size=None,
 ):
     prev = os.environ.get("CUDA_VISIBLE_DEVICES", None)
     # Ignote GPU to avoid flooding it with data
@@ -700,14 +971,20 @@ def generate_synth_sc_data(
         min_counts=min_counts,
         dataset_dir=dataset_dir,
         act_prog_cell_types=act_prog_cell_types,
+        counts_chunk_size=counts_chunk_size,
+        load_adata=(include_adata or plot),
     )
     if prev is not None:
         os.environ["CUDA_VISIBLE_DEVICES"] = prev
     else:
         del os.environ["CUDA_VISIBLE_DEVICES"]
-    adata = result[-1]
+    # The first num_cell_types concepts are the one-hot encoded cell types
+    cell_type_counts = np.sum(
+        np.concatenate([result[4], result[5]], axis=0)[:, :num_cell_types],
+        axis=0,
+    )
     extra_hyperparameters = {
-        'avg_group_size': int(np.mean(np.unique(adata.obs['cell_type'], return_counts=True)[1])),
+        'avg_group_size': int(np.mean(cell_type_counts[cell_type_counts > 0])),
         'num_cell_types': num_cell_types,
         'n_act_progs': n_act_progs,
         'n_ground_truth_concepts': n_act_progs + num_cell_types,
@@ -7,6 +7,19 @@ All credit given to Kotliar et al.
 
 import pandas as pd
 import numpy as np
+import scipy.sparse
+
+# Independent random streams derived from a simulation's seed
+_PROGRAM_GENES_STREAM = 0
+_SIMULATION_STREAM = 1
+
+
+def _stream_random_state(seed, stream):
+    # Spawning child seeds rather than reusing the same seed makes every
+    # stream statistically independent from the others
+    child_seed = np.random.SeedSequence(seed).spawn(2)[stream]
+    return np.random.RandomState(np.random.MT19937(child_seed))
+
 
 class scsim:
     def __init__(
@@ -42,6 +55,8 @@ class scsim:
         act_prog_cell_frac=None,
         min_act_prog_usage=.2,
         max_act_prog_usage=.8,
+
+        chunk_size=None,
     ):
 
         if (
@@ -56,15 +71,11 @@ class scsim:
                     f'Expected as many lists in diff_exp_prob_genes (found {len(diff_exp_prob_genes)}) '
                     f'as the number of cell types ({n_cell_types})'
                 )
-            diffexpprob = [
-                [1 if i in cell_type_genes else 0 for i in range(ngenes)]
-                for cell_type_genes in diff_exp_prob_genes
-            ]
+            diffexpprob = np.zeros((n_cell_types, ngenes))
+            for i, cell_type_genes in enumerate(diff_exp_prob_genes):
+                diffexpprob[i, list(cell_type_genes)] = 1
         else:
-            diffexpprob = [
-                [diffexpprob for i in range(ngenes)]
-                for _ in range(n_cell_types)
-            ]
+            diffexpprob = np.full((n_cell_types, ngenes), diffexpprob, dtype=np.float64)
 
         if (
             (act_prog_gene_sizes is not None) and (act_prog_genes is not None)
@@ -95,6 +106,9 @@ class scsim:
         self.bcv_dof = bcv_dof
         self.ndoublets = ndoublets
         self.init_ncells = ncells + ndoublets
+        # If given, counts are generated for this many cells at a time and
+        # stored as a sparse CSR matrix
+        self.chunk_size = chunk_size
 
 
         # How many randomly selected genes will be involved in each activity program
@@ -107,10 +121,15 @@ class scsim:
             if act_prog_genes is not None:
                 self.activity_program_genes = act_prog_genes
             else:
+                # Seeded so that the whole simulation is reproducible for a given seed
+                program_random_state = _stream_random_state(
+                    seed,
+                    _PROGRAM_GENES_STREAM,
+                )
                 self.activity_program_genes = [None for _ in self.act_prog_gene_sizes]
                 for i, n_genes_in_act_prog in enumerate(self.act_prog_gene_sizes):
                     self.activity_program_genes[i] = np.sort(
-                        np.random.choice(self.ngenes, n_genes_in_act_prog, replace=False)
+                        program_random_state.choice(self.ngenes, n_genes_in_act_prog, replace=False)
                     )
         # The probability that a given activity program is downregulated
         self.act_prog_down_prob = act_prog_down_prob
@@ -208,142 +227,190 @@ class scsim:
 
 
     def simulate(self):
-        np.random.seed(self.seed)
+        # All draws come from a single random state so that simulations are
+        # bit-reproducible for a given seed. It is independent from the one
+        # used to select the activity program genes
+        self.random_state = _stream_random_state(
+            self.seed,
+            _SIMULATION_STREAM,
+        )
         print('Simulating cells')
         self.cellparams = self.get_cell_params()
         print('Simulating gene params')
         self.geneparams = self.get_gene_params()
 
-        if (self.act_prog_gene_sizes is not None) and (len(self.act_prog_gene_sizes) > 0):
+        # Dense activity program state: which programs each cell carries (and
+        # how much it uses them) and which genes belong to each program (and
+        # their mean expression under that program)
+        n_act_progs = 0 if self.act_prog_gene_sizes is None else len(self.act_prog_gene_sizes)
+        self.has_act_program = np.zeros((self.init_ncells, n_act_progs), dtype=np.int32)
+        self.act_program_usage = np.zeros((self.init_ncells, n_act_progs), dtype=np.float64)
+        self.act_prog_gene_mask = np.zeros((self.ngenes, n_act_progs), dtype=np.int32)
+        self.act_prog_gene_means = np.zeros((self.ngenes, n_act_progs), dtype=np.float64)
+        if n_act_progs > 0:
             print('Simulating activity programs')
             self.simulate_activity_programs()
 
         print('Simulating DE')
         self.sim_cell_type_DE()
 
-        print('Simulating cell-gene means')
-        self.cell_gene_mean = self.get_cell_gene_means()
+        # Per-cell parameters of all simulated cells (including the extra
+        # cells merged into doublets) used to compute cell-gene means
+        self._cell_type_idxs = np.searchsorted(self.cell_types, self.cellparams['cell_type'].values)
+        self._libsize = self.cellparams['libsize'].values.copy()
+        self._act_program_usage = self.act_program_usage
+        self.doublet_partners = None
         if self.ndoublets > 0:
             print('Simulating doublets')
             self.simulate_doublets()
 
-        print('Adjusting means')
-        self.adjust_means_bcv()
-        print('Simulating counts')
-        self.simulate_counts()
+        if n_act_progs > 0:
+            # Keep exposing the per-cell/per-gene program vectors as columns
+            self.cellparams['has_act_program'] = _row_arrays(self.has_act_program)
+            self.cellparams['act_program_usage'] = _row_arrays(self.act_program_usage)
+            self.geneparams['act_prog_gene'] = _row_arrays(self.act_prog_gene_mask)
+            self.geneparams['act_prog_gene_mean'] = _row_arrays(self.act_prog_gene_means)
+
+        if self.chunk_size is None:
+            print('Simulating cell-gene means')
+            self.cell_gene_mean = pd.DataFrame(
+                self.get_cell_gene_means(np.arange(self.ncells)),
+                index=self.cellnames,
+                columns=self.genenames,
+            )
+            print('Adjusting means')
+            self.adjust_means_bcv()
+            print('Simulating counts')
+            self.simulate_counts()
+        else:
+            print(f'Simulating counts in chunks of {self.chunk_size} cells')
+            self.simulate_counts_chunked()
 
     def simulate_counts(self):
         '''Sample read counts for each gene x cell from Poisson distribution
         using the variance-trend adjusted updated_mean value'''
         self.counts = pd.DataFrame(
-            np.random.poisson(lam=self.updated_mean),
+            self.random_state.poisson(lam=self.updated_mean.to_numpy()),
             index=self.cellnames,
             columns=self.genenames,
         )
 
     def adjust_means_bcv(self):
         '''Adjust cell_gene_mean to follow a mean-variance trend relationship'''
-        self.bcv = self.bcv_dispersion + (1 / np.sqrt(self.cell_gene_mean))
-        chisamp = np.random.chisquare(self.bcv_dof, size=self.ngenes)
-        self.bcv = self.bcv*np.sqrt(self.bcv_dof / chisamp)
-        self.updated_mean = np.random.gamma(
-            shape=1/(self.bcv**2),
-            scale=self.cell_gene_mean*(self.bcv**2),
+        chisamp = self.random_state.chisquare(self.bcv_dof, size=self.ngenes)
+        bcv, updated_mean = self._adjust_means_bcv(
+            self.cell_gene_mean.to_numpy(),
+            chisamp,
         )
-        self.bcv = pd.DataFrame(self.bcv, index=self.cellnames, columns=self.genenames)
+        self.bcv = pd.DataFrame(bcv, index=self.cellnames, columns=self.genenames)
         self.updated_mean = pd.DataFrame(
-            self.updated_mean,
+            updated_mean,
             index=self.cellnames,
             columns=self.genenames,
         )
 
+    def _adjust_means_bcv(self, cell_gene_mean, chisamp):
+        bcv = self.bcv_dispersion + (1 / np.sqrt(cell_gene_mean))
+        bcv *= np.sqrt(self.bcv_dof / chisamp)
+        updated_mean = self.random_state.gamma(
+            shape=1/(bcv**2),
+            scale=cell_gene_mean*(bcv**2),
+        )
+        return bcv, updated_mean
+
+    def simulate_counts_chunked(self):
+        '''Equivalent to adjust_means_bcv followed by simulate_counts, but
+        cell-gene means, their BCV adjustment, and counts are generated for
+        chunk_size cells at a time and counts are stored as a sparse CSR
+        matrix, so that peak memory is bounded by the chunk size rather than
+        by the number of cells'''
+        chisamp = self.random_state.chisquare(self.bcv_dof, size=self.ngenes)
+        chunks = []
+        for start in range(0, self.ncells, self.chunk_size):
+            cell_idxs = np.arange(start, min(start + self.chunk_size, self.ncells))
+            _, updated_mean = self._adjust_means_bcv(
+                self.get_cell_gene_means(cell_idxs),
+                chisamp,
+            )
+            chunks.append(scipy.sparse.csr_matrix(
+                self.random_state.poisson(lam=updated_mean)
+            ))
+        self.counts = scipy.sparse.vstack(chunks, format='csr')
+        # These are never materialized for all cells at once
+        self.cell_gene_mean = None
+        self.bcv = None
+        self.updated_mean = None
+
 
     def simulate_doublets(self):
         ## Select doublet cells and determine the second cell to merge with
-        d_ind = sorted(
-            np.random.choice(self.ncells, self.ndoublets, replace=False)
+        d_ind = np.sort(
+            self.random_state.choice(self.ncells, self.ndoublets, replace=False)
         )
-        d_ind = [f'Cell{x + 1}' for x in d_ind]
-        self.cellparams['is_doublet'] = False
-        self.cellparams.loc[d_ind, 'is_doublet'] = True
-        extra_ind = self.cellparams.index[-self.ndoublets:]
-        group2 = self.cellparams.ix[extra_ind, 'group'].values
-        self.cellparams['group2'] = -1
-        self.cellparams.loc[d_ind, 'group2'] = group2
+        extra_ind = np.arange(self.ncells, self.init_ncells)
+        is_doublet = np.zeros(self.init_ncells, dtype=bool)
+        is_doublet[d_ind] = True
+        self.cellparams['is_doublet'] = is_doublet
+        group2 = np.full(self.init_ncells, -1)
+        group2[d_ind] = self.cellparams['cell_type'].values[extra_ind]
+        self.cellparams['group2'] = group2
+        # The cell-gene means of each doublet are merged with those of its
+        # partner extra cell when computed (see get_cell_gene_means)
+        self.doublet_partners = np.full(self.init_ncells, -1)
+        self.doublet_partners[d_ind] = extra_ind
 
-        ## update the cell-gene means for the doublets while preserving the
-        ## same library size
-        dmean = self.cell_gene_mean.loc[d_ind,:].values
-        dmultiplier = 0.5 / dmean.sum(axis=1)
-        dmean = np.multiply(dmean, dmultiplier[:, np.newaxis])
-        omean = self.cell_gene_mean.loc[extra_ind,:].values
-        omultiplier = 0.5 / omean.sum(axis=1)
-        omean = np.multiply(omean, omultiplier[:,np.newaxis])
-        newmean = dmean + omean
-        libsize = self.cellparams.loc[d_ind, 'libsize'].values
-        newmean = np.multiply(newmean, libsize[:,np.newaxis])
-        self.cell_gene_mean.loc[d_ind,:] = newmean
         ## remove extra doublet cells from the data structures
-        self.cell_gene_mean.drop(extra_ind, axis=0, inplace=True)
-        self.cellparams.drop(extra_ind, axis=0, inplace=True)
         self.cellnames = self.cellnames[0:self.ncells]
+        self.cellparams = self.cellparams.iloc[:self.ncells].copy()
+        self.has_act_program = self.has_act_program[:self.ncells]
+        self.act_program_usage = self.act_program_usage[:self.ncells]
 
 
-    def get_cell_gene_means(self):
-        '''Calculate each gene's mean expression for each cell while adjusting
-        for the library size'''
+    def get_cell_gene_means(self, cell_idxs):
+        '''Calculate each gene's mean expression for each of the given cells
+        while adjusting for the library size'''
+        cell_gene_mean = self._identity_gene_means(cell_idxs)
+        if self.doublet_partners is None:
+            return cell_gene_mean
 
+        ## update the cell-gene means for the doublets while preserving the
+        ## same library size
+        partners = self.doublet_partners[cell_idxs]
+        is_doublet = partners >= 0
+        if np.any(is_doublet):
+            dmean = cell_gene_mean[is_doublet, :]
+            dmean = dmean * (0.5 / dmean.sum(axis=1))[:, np.newaxis]
+            omean = self._identity_gene_means(partners[is_doublet])
+            omean = omean * (0.5 / omean.sum(axis=1))[:, np.newaxis]
+            libsize = self._libsize[cell_idxs[is_doublet]]
+            cell_gene_mean[is_doublet, :] = (dmean + omean) * libsize[:, np.newaxis]
+        return cell_gene_mean
 
-        cell_type_gene_mean = self.geneparams.loc[
-            :,
-            [x for x in self.geneparams.columns if ('_gene_mean' in x) and ('cell_type' in x)]
-        ].T.astype(float)
-        cell_type_gene_mean = cell_type_gene_mean.div(cell_type_gene_mean.sum(axis=1), axis=0)
-        ind = self.cellparams['cell_type'].apply(lambda x: f'cell_type_{x}_gene_mean')
 
-        if (self.act_prog_gene_sizes is None) or (len(self.act_prog_gene_sizes) == 0):
-            cell_gene_mean = cell_type_gene_mean.loc[ind, :].astype(float)
-            cell_gene_mean.index = self.cellparams.index
-        else:
-            no_act_prog_cells = np.sum(
-                np.array(list(map(list, self.cellparams['has_act_program'].values))),
-                axis=-1,
-            ) == 0
-            has_act_prog_cells = np.sum(
-                np.array(list(map(list, self.cellparams['has_act_program'].values))),
-                axis=-1,
-            ) != 0
-
-            print('   - Getting mean for activity program carrying cells')
-            act_prog_cell_mean = cell_type_gene_mean.loc[ind[has_act_prog_cells], :]
-            act_prog_cell_mean.index = ind.index[has_act_prog_cells]
-            act_prog_cell_mean = act_prog_cell_mean.multiply(
-                1 - self.cellparams.loc[has_act_prog_cells, 'act_program_usage'],
-                axis=0,
-            )
-
-            act_prog_mean = self.geneparams.loc[:,['act_prog_gene_mean']]
-            act_prog_mean = act_prog_mean.div(act_prog_mean.sum(axis=0), axis=1)
-            act_prog_usage = self.cellparams.loc[act_prog_cell_mean.index, ['act_program_usage']]
-            act_prog_usage.columns = ['act_prog_gene_mean']
-            act_prog_cell_mean += act_prog_usage.dot(act_prog_mean.T)
+    def _identity_gene_means(self, cell_idxs):
+        cell_type_gene_mean = self.cell_type_gene_means / self.cell_type_gene_means.sum(
+            axis=1,
+            keepdims=True,
+        )
+        cell_gene_mean = cell_type_gene_mean[self._cell_type_idxs[cell_idxs], :]
+
+        n_act_progs = self._act_program_usage.shape[1]
+        if n_act_progs > 0:
+            # Each activity program p mixes a cell's identity profile with the
+            # program's profile using the cell's usage u_p of p (which is zero
+            # for cells not carrying it), and the gene means of all programs
+            # are then averaged:
+            #     mean_p[(1 - u_p) * identity_mean + u_p * program_mean_p]
             # TODO (verify this): if multiple identity programs use the same gene, then its resulting mean will be the
             #                     mean of the expected means of all identity programs
-            act_prog_cell_mean = act_prog_cell_mean.applymap(np.mean)
-            act_prog_cell_mean = act_prog_cell_mean.astype(float)
-
-            print('   - Getting mean for non activity program carrying cells')
-            no_act_prog_cell_mean = cell_type_gene_mean.loc[ind[no_act_prog_cells], :]
-            no_act_prog_cell_mean.index = ind.index[no_act_prog_cells]
-
-            cell_gene_mean = pd.concat([no_act_prog_cell_mean, act_prog_cell_mean], axis=0, verify_integrity=True)
-            # Sort them so that they are in the same order as before
-            cell_gene_mean.sort_index(inplace=True, key=lambda x: [int(y[len('Cell'):]) for y in x])
-
-        print('   - Normalizing by cell libsize')
-        normfac = (self.cellparams['libsize'] / cell_gene_mean.sum(axis=1)).values
-        for col in cell_gene_mean.columns:
-            cell_gene_mean[col] = cell_gene_mean[col].values * normfac
+            usage = self._act_program_usage[cell_idxs]
+            act_prog_mean = self.act_prog_gene_means / self.act_prog_gene_means.sum(axis=0, keepdims=True)
+            cell_gene_mean *= 1 - np.mean(usage, axis=1, keepdims=True)
+            cell_gene_mean += (usage @ act_prog_mean.T) / n_act_progs
+
+        # Normalize by cell libsize
+        normfac = self._libsize[cell_idxs] / cell_gene_mean.sum(axis=1)
+        cell_gene_mean *= normfac[:, np.newaxis]
         return cell_gene_mean
 
 
@@ -351,20 +418,16 @@ class scsim:
         '''Sample each genes mean expression from a gamma distribution as
         well as identifying outlier genes with expression drawn from a
         log-normal distribution'''
-        base_gene_mean = np.random.gamma(
+        base_gene_mean = self.random_state.gamma(
             shape=self.mean_shape,
             scale=1/self.mean_rate,
             size=self.ngenes,
         )
 
         # Figure out which cells will be considered to be outliers
-        is_outlier = np.random.choice(
-            [True, False],
-            size=self.ngenes,
-            p=[self.expoutprob, 1 - self.expoutprob],
-        )
+        is_outlier = self.random_state.random_sample(self.ngenes) < self.expoutprob
         outlier_ratio = np.ones(shape=self.ngenes)
-        outliers = np.random.lognormal(
+        outliers = self.random_state.lognormal(
             mean=self.expoutloc,
             sigma=self.expoutscale,
             size=is_outlier.sum(),
@@ -375,141 +438,74 @@ class scsim:
         gene_mean[is_outlier] = outliers * median
         self.genenames = [f'Gene{i}' for i in range(1, self.ngenes + 1)]
         geneparams = pd.DataFrame(
-            [base_gene_mean, is_outlier, outlier_ratio, gene_mean],
-            index=['BaseGeneMean', 'is_outlier', 'outlier_ratio', 'gene_mean'],
-            columns=self.genenames,
-        ).T
+            {
+                'BaseGeneMean': base_gene_mean,
+                'is_outlier': is_outlier,
+                'outlier_ratio': outlier_ratio,
+                'gene_mean': gene_mean,
+            },
+            index=self.genenames,
+        )
         return geneparams
 
 
     def get_cell_params(self):
         '''Sample cell type identities and library sizes'''
         cell_type_ids = self.simulate_cell_types()
-        libsize = np.random.lognormal(
+        libsize = self.random_state.lognormal(
             mean=self.libloc,
             sigma=self.libscale,
             size=self.init_ncells,
         )
         self.cellnames = [f'Cell{i}' for i in range(1, self.init_ncells + 1)]
         cellparams = pd.DataFrame(
-            [cell_type_ids, libsize],
-            index=['cell_type', 'libsize'],
-            columns=self.cellnames,
-        ).T
-        cellparams['cell_type'] = cellparams['cell_type'].astype(int)
+            {'cell_type': cell_type_ids.astype(int), 'libsize': libsize},
+            index=self.cellnames,
+        )
         return cellparams
 
 
     def simulate_activity_programs(self):
         ## Simulate expression of all requested activity programs
-        self.geneparams = self.geneparams.join(
-            pd.DataFrame(
-                {
-                    'act_prog_gene': [
-                        np.zeros((len(self.act_prog_gene_sizes),), dtype=np.int32)
-                        for _ in range(self.ngenes)
-                    ]
-                },
-                index=[f'Gene{i}' for i in range(1, self.geneparams.shape[0] + 1)]
-            ),
-        )
-        self.geneparams = self.geneparams.join(
-            pd.DataFrame(
-                {
-                    'act_prog_gene_mean': [
-                        np.zeros((len(self.act_prog_gene_sizes),), dtype=np.float32)
-                        for _ in range(self.ngenes)
-                    ]
-                },
-                index=[f'Gene{i}' for i in range(1, self.geneparams.shape[0] + 1)]
-            ),
-        )
-
-
-        self.cellparams = self.cellparams.join(
-            pd.DataFrame(
-                {
-                    'has_act_program': [
-                        np.zeros((len(self.act_prog_gene_sizes),), dtype=np.int32)
-                        for _ in range(self.ncells)
-                    ]
-                },
-                index=[f'Cell{i}' for i in range(1, self.cellparams.shape[0] + 1)]
-            ),
-        )
-        self.cellparams = self.cellparams.join(
-            pd.DataFrame(
-                {
-                    'act_program_usage': [
-                        np.zeros((len(self.act_prog_gene_sizes),), dtype=np.float32)
-                        for _ in range(self.ncells)
-                    ]
-                },
-                index=[f'Cell{i}' for i in range(1, self.cellparams.shape[0] + 1)]
-            ),
-        )
-
+        cell_types = self.cellparams['cell_type'].values
+        gene_mean = self.geneparams['gene_mean'].values
         for act_prog_idx, n_genes_in_act_prog in enumerate(self.act_prog_gene_sizes):
             act_prog_genes = self.activity_program_genes[act_prog_idx]
-            for vec in self.geneparams.loc[
-                [f'Gene{i + 1}' for i in act_prog_genes],
-                'act_prog_gene',
-            ]:
-                vec[act_prog_idx] = 1
-            DEratio = np.random.lognormal(
+            self.act_prog_gene_mask[act_prog_genes, act_prog_idx] = 1
+            DEratio = self.random_state.lognormal(
                 mean=self.act_prog_de_loc[act_prog_idx],
                 sigma=self.act_prog_de_scale[act_prog_idx],
                 size=n_genes_in_act_prog,
             )
             DEratio[DEratio < 1] = 1 / DEratio[DEratio < 1]
-            is_downregulated = np.random.choice(
-                [True, False],
-                size=len(DEratio),
-                p=[
-                    self.act_prog_down_prob[act_prog_idx],
-                    1 - self.act_prog_down_prob[act_prog_idx],
-                ],
-            )
+            is_downregulated = self.random_state.random_sample(len(DEratio)) < \
+                self.act_prog_down_prob[act_prog_idx]
             DEratio[is_downregulated] = 1 / DEratio[is_downregulated]
             all_DE_ratio = np.ones(self.ngenes)
             all_DE_ratio[act_prog_genes] = DEratio
-            act_prog_mean = self.geneparams['gene_mean'] * all_DE_ratio
-            for i, vec in enumerate(self.geneparams['act_prog_gene_mean']):
-                vec[act_prog_idx] = act_prog_mean[i]
-
-            for cell_type in self.act_prog_cell_types[act_prog_idx]:
-                # For each cell type, let's go ahead and simulate the activity of this program if it is
-                # relevant for this activity program at at all
-                group_cells = self.cellparams.index[self.cellparams['cell_type'] == cell_type]
-
-                # Determine which cells in this cell type group will have this specific activation program in it
-                # We do this using a random Bernoulli distribution using a given expected fraction of cell types
-                # that we expect to be activated
-                has_prog = np.random.choice(
-                    [True, False],
-                    size=len(group_cells),
-                    p=[
-                        self.act_prog_cell_frac[act_prog_idx],
-                        1 - self.act_prog_cell_frac[act_prog_idx],
-                    ],
-                )
-
-                for vec in self.cellparams.loc[group_cells[has_prog], 'has_act_program']:
-                    vec[act_prog_idx] = 1
-                # And simulate usuage from a uniform distribution
-                usages = np.random.uniform(
-                    low=self.min_act_prog_usage[act_prog_idx],
-                    high=self.max_act_prog_usage[act_prog_idx],
-                    size=len(group_cells[has_prog]),
-                )
-                for i, vec in enumerate(self.cellparams.loc[group_cells[has_prog], 'act_program_usage']):
-                    vec[act_prog_idx] = usages[i]
+            self.act_prog_gene_means[:, act_prog_idx] = gene_mean * all_DE_ratio
+
+            # Cells of the cell types involved in this program carry it
+            # following a Bernoulli distribution with the expected fraction of
+            # cells that we expect to be activated, and their usage follows a
+            # uniform distribution
+            has_prog = np.isin(cell_types, self.act_prog_cell_types[act_prog_idx]) & (
+                self.random_state.random_sample(self.init_ncells) <
+                self.act_prog_cell_frac[act_prog_idx]
+            )
+            usages = self.random_state.uniform(
+                low=self.min_act_prog_usage[act_prog_idx],
+                high=self.max_act_prog_usage[act_prog_idx],
+                size=self.init_ncells,
+            )
+            self.has_act_program[has_prog, act_prog_idx] = 1
+            self.act_program_usage[has_prog, act_prog_idx] = usages[has_prog]
 
 
 
     def simulate_cell_types(self):
         '''Sample cell type identities from a categorical distribution'''
-        cell_type_ids = np.random.choice(
+        cell_type_ids = self.random_state.choice(
             np.arange(1, self.n_cell_types + 1),
             size=self.init_ncells,
             p=self.cell_type_probs,
@@ -521,41 +517,77 @@ class scsim:
     def sim_cell_type_DE(self):
         '''Sample differentially expressed genes and the DE factor for each
         cell-type'''
-        cell_types = self.cellparams['cell_type'].unique()
-
         # Find out which genes are used for activity programs already to avoid differientating those
-        if (self.act_prog_gene_sizes is not None) and np.sum(self.act_prog_gene_sizes) > 0:
-            act_prog_genes = np.sum(
-                np.array(list(map(list, self.geneparams['act_prog_gene'].values))),
-                axis=-1,
-            ) > 0
-        else:
-            act_prog_genes = np.array([False] * self.geneparams.shape[0])
-
-        for cell_type in self.cell_types:
-            isDE = np.array([False for _ in range(self.ngenes)])
-            for gene_idx in range(self.ngenes):
-                isDE[gene_idx] = np.random.choice(
-                    [True, False],
-                    p=[self.diffexpprob[cell_type - 1][gene_idx], 1 - self.diffexpprob[cell_type - 1][gene_idx]],
-                )
+        act_prog_genes = np.sum(self.act_prog_gene_mask, axis=-1) > 0
+        gene_mean = self.geneparams['gene_mean'].values
+
+        self.cell_type_gene_means = np.zeros((len(self.cell_types), self.ngenes))
+        for i, cell_type in enumerate(self.cell_types):
+            # A single draw decides which genes are DE for this cell type
+            isDE = self.random_state.random_sample(self.ngenes) < self.diffexpprob[cell_type - 1]
             isDE[act_prog_genes] = False # Program genes shouldn't be differentially expressed between cell types
-            DEratio = np.random.lognormal(
+            DEratio = self.random_state.lognormal(
                 mean=self.diffexploc,
                 sigma=self.diffexpscale,
                 size=isDE.sum(),
             )
             DEratio[DEratio < 1] = 1 / DEratio[DEratio<1]
-            is_downregulated = np.random.choice(
-                [True, False],
-                size=len(DEratio),
-                p=[self.diffexpdownprob, 1 - self.diffexpdownprob],
-            )
+            is_downregulated = self.random_state.random_sample(len(DEratio)) < self.diffexpdownprob
             DEratio[is_downregulated] = 1 / DEratio[is_downregulated]
             all_DE_ratio = np.ones(self.ngenes)
             all_DE_ratio[isDE] = DEratio
-            cell_type_mean = self.geneparams['gene_mean'] * all_DE_ratio
+            cell_type_mean = gene_mean * all_DE_ratio
+            self.cell_type_gene_means[i, :] = cell_type_mean
 
             self.geneparams[f'cell_type_{cell_type}_DE_ratio'] = all_DE_ratio
             self.geneparams[f'cell_type_{cell_type}_gene_mean'] = cell_type_mean
             self.geneparams[f'cell_type_{cell_type}_gene_selection'] = isDE
+
+
+def _row_arrays(matrix):
+    # Object array whose i-th entry is the i-th row of the given matrix
+    rows = np.empty(matrix.shape[0], dtype=object)
+    for i in range(matrix.shape[0]):
+        rows[i] = matrix[i]
+    return rows
+
+
+def combination_labels(cell_types, has_act_program):
+    """
+    Returns, for every cell, the label of its (cell type, activity programs)
+    combination. Every distinct combination gets its own label, ordered first
+    by cell type and then by its activity programs, so that only combinations
+    which occur in the given cells are labelled.
+    """
+    cell_types = np.asarray(cell_types)
+    combos = np.concatenate(
+        [
+            cell_types.reshape(-1, 1),
+            np.asarray(has_act_program).reshape(cell_types.shape[0], -1),
+        ],
+        axis=-1,
+    )
+    _, labels = np.unique(combos, axis=0, return_inverse=True)
+    return labels.reshape(-1)
+
+
+def ground_truth_concept_masks(simulator, n_cell_types, kept_gene_mask=None):
+    """
+    Returns a [n_cell_types + n_act_programs, n_kept_genes] 0/1 matrix whose
+    rows mark the genes selected by each identity GEP followed by the genes in
+    each activity GEP of the given (already simulated) simulator. Only the
+    genes in kept_gene_mask are included if it is given.
+    """
+    masks = np.zeros(
+        (n_cell_types + len(simulator.activity_program_genes), simulator.ngenes),
+        dtype=np.int64,
+    )
+    for prog_idx in range(n_cell_types):
+        masks[prog_idx, :] = simulator.geneparams[
+            f'cell_type_{prog_idx + 1}_gene_selection'
+        ].to_numpy().astype(bool)
+    for prog_idx, act_prog_genes in enumerate(simulator.activity_program_genes):
+        masks[n_cell_types + prog_idx, act_prog_genes] = 1
+    if kept_gene_mask is not None:
+        masks = masks[:, kept_gene_mask]
+    return masks
@@ -1,11 +1,24 @@
+import functools
+import joblib
 import numpy as np
 import scipy
+import scipy.cluster.hierarchy
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.stats
 import sklearn
+import sklearn.inspection
+import sklearn.utils
+import threadpoolctl
+import xgboost as xgb
 
 from sklearn_extra.cluster import KMedoids
 from sklearn.ensemble import GradientBoostingClassifier
 from sklearn.ensemble import GradientBoostingRegressor
-from sklearn.linear_model import LinearRegression
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.isotonic import IsotonicRegression
 from sklearn.metrics import homogeneity_score
 from sklearn.metrics import mutual_info_score
 from sklearn.model_selection import train_test_split
@@ -60,24 +73,195 @@ def feature_selection(
     importance_masks = np.array(importance_masks)
     if len(importance_masks.shape) > 1:
         importance_masks = np.mean(np.array(importance_masks), axis=0)
+    # Threshold the global mask at every ratio at once and score all of the
+    # resulting selections in a single pass
+    threshs = np.max(importance_masks) * np.atleast_1d(threshold_ratio)
+    selections = (
+        importance_masks[:, None] > threshs[None, :]
+    ).astype(np.int32)
+    aucs = pairwise_auc_matrix(
+        scores=selections,
+        targets=ground_truth_global[:, None],
+    )[:, 0]
     if isinstance(threshold_ratio, (list, tuple, np.ndarray)):
-        best = 0.0
-        for ratio in threshold_ratio:
-            thresh = np.max(importance_masks) * ratio
-            best = max(
-                best,
-                sklearn.metrics.roc_auc_score(
-                    ground_truth_global,
-                    (importance_masks > thresh).astype(np.int32),
-                )
-            )
-        return best
-    thresh = np.max(importance_masks) * threshold_ratio
-    return sklearn.metrics.roc_auc_score(
-        ground_truth_global,
-        (importance_masks > thresh).astype(np.int32),
+        return np.max(aucs, initial=0.0)
+    return aucs[0]
+
+
+############################################
+## Pairwise AUC Kernel
+############################################
+
+def pairwise_auc_matrix(scores, targets):
+    """
+    Computes the [n_scores, n_targets] matrix whose (i, j)-th entry is the
+    ROC AUC of scores[:, i] when predicting the binary labels targets[:, j].
+
+    Rather than calling sklearn.metrics.roc_auc_score for every pair, we rank
+    each score column once (averaging ranks over ties) and obtain all AUCs
+    from the Mann-Whitney rank sums of the positive samples of each target,
+    which is equivalent to sklearn's AUC for binary targets.
+
+    :param np.ndarray scores: [n_samples, n_scores] matrix of scores.
+    :param np.ndarray targets: [n_samples, n_targets] matrix of binary labels
+        where 1 marks the positive class.
+    :return np.ndarray: [n_scores, n_targets] matrix of AUCs.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    targets = (np.asarray(targets) == 1).astype(np.float64)
+    if scores.ndim == 1:
+        scores = scores[:, None]
+    if targets.ndim == 1:
+        targets = targets[:, None]
+    n_samples = targets.shape[0]
+    n_pos = np.sum(targets, axis=0)
+    n_neg = n_samples - n_pos
+    if np.any(n_pos == 0) or np.any(n_neg == 0):
+        raise ValueError(
+            "Only one class present in y_true. ROC AUC score is not defined "
+            "in that case."
+        )
+    ranks = scipy.stats.rankdata(scores, axis=0)
+    rank_sums = ranks.T @ targets
+    return (rank_sums - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+############################################
+## Optimal Concept Alignment
+############################################
+
+def concept_auc_matrix(concept_scores, c_test):
+    """
+    Computes the [n_learned, n_true] matrix whose (i, j)-th entry is the AUC
+    of learnt concept i when predicting ground truth concept j. As concepts
+    may be learnt flipped, we take the max between the AUC and its
+    complement.
+    """
+    auc_matrix = pairwise_auc_matrix(scores=concept_scores, targets=c_test)
+    return np.maximum(auc_matrix, 1 - auc_matrix)
+
+def concept_mask_auc_matrix(
+    concept_importance_masks,
+    ground_truth_concept_masks,
+    thresh=None,
+):
+    """
+    Computes the [n_learned, n_true] matrix whose (i, j)-th entry is the AUC
+    of the i-th learnt concept mask when predicting the features in the j-th
+    ground truth concept mask.
+    """
+    concept_importance_masks = np.array(concept_importance_masks)
+    ground_truth_concept_masks = np.array(ground_truth_concept_masks)
+    if thresh is not None:
+        concept_importance_masks = (
+            concept_importance_masks >= thresh
+        ).astype(np.int32)
+    return pairwise_auc_matrix(
+        scores=concept_importance_masks.T,
+        targets=ground_truth_concept_masks.T,
+    )
+
+def _has_full_matching(feasible):
+    # Whether there is a matching using only feasible (learnt, true) pairs
+    # that covers all learnt or all true concepts
+    matching = scipy.sparse.csgraph.maximum_bipartite_matching(
+        scipy.sparse.csr_matrix(feasible.astype(np.int8)),
+        perm_type='column',
     )
+    return np.count_nonzero(matching >= 0) == min(feasible.shape)
 
+def bottleneck_assignment(auc_matrix):
+    """
+    Finds the assignment between learnt concepts (rows) and ground truth
+    concepts (columns) of size min(auc_matrix.shape) maximizing the smallest
+    AUC in it. Ties are broken by maximizing the sum of AUCs among all
+    assignments with the same bottleneck.
+
+    Returns a tuple (row_idxs, col_idxs) as in
+    scipy.optimize.linear_sum_assignment.
+    """
+    thresholds = np.unique(auc_matrix)
+    # Binary search for the largest threshold t such that there is a full
+    # assignment using only pairs with AUC >= t
+    low, high = 0, len(thresholds) - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _has_full_matching(auc_matrix >= thresholds[mid]):
+            low = mid
+        else:
+            high = mid - 1
+    feasible = auc_matrix >= thresholds[low]
+    # Infeasible pairs get a penalty larger than any achievable sum of AUCs
+    penalty = float(min(auc_matrix.shape) + 1)
+    return scipy.optimize.linear_sum_assignment(
+        np.where(feasible, auc_matrix, auc_matrix - penalty),
+        maximize=True,
+    )
+
+def max_pair_assignment(auc_matrix):
+    """
+    Finds an assignment between learnt concepts (rows) and ground truth
+    concepts (columns) of size min(auc_matrix.shape) maximizing the largest
+    AUC in it. This is achieved by the single best pair in auc_matrix, so we
+    fix it and complete the rest of the assignment by maximizing the sum of
+    the remaining AUCs.
+
+    Returns a tuple (row_idxs, col_idxs) as in
+    scipy.optimize.linear_sum_assignment.
+    """
+    best_row, best_col = np.unravel_index(
+        np.argmax(auc_matrix),
+        auc_matrix.shape,
+    )
+    other_rows = np.delete(np.arange(auc_matrix.shape[0]), best_row)
+    other_cols = np.delete(np.arange(auc_matrix.shape[1]), best_col)
+    rest_rows, rest_cols = scipy.optimize.linear_sum_assignment(
+        auc_matrix[np.ix_(other_rows, other_cols)],
+        maximize=True,
+    )
+    row_idxs = np.concatenate([[best_row], other_rows[rest_rows]])
+    col_idxs = np.concatenate([[best_col], other_cols[rest_cols]])
+    order = np.argsort(row_idxs)
+    return row_idxs[order], col_idxs[order]
+
+def optimal_alignment(auc_matrix, reduction=np.mean):
+    """
+    Finds the assignment between learnt concepts (rows of auc_matrix) and
+    ground truth concepts (columns of auc_matrix) that maximizes the
+    reduction of the AUCs of all assigned pairs. Supports np.mean/np.sum
+    (Hungarian algorithm), np.min (bottleneck assignment), and np.max.
+
+    Returns a tuple (row_idxs, col_idxs) as in
+    scipy.optimize.linear_sum_assignment, or None if the reduction is not
+    supported.
+    """
+    if reduction in [np.mean, np.sum]:
+        return scipy.optimize.linear_sum_assignment(auc_matrix, maximize=True)
+    if reduction is np.min:
+        return bottleneck_assignment(auc_matrix)
+    if reduction is np.max:
+        return max_pair_assignment(auc_matrix)
+    return None
+
+def _aligned_auc_result(auc_matrix, row_idxs, col_idxs, reduction):
+    # The assignment may have been found over a leading block of auc_matrix,
+    # whose indices are also valid in auc_matrix. Put it in the same format
+    # used by our brute force search:
+    # if there are fewer learnt than ground truth concepts, the permutation
+    # maps learnt concepts to ground truth concepts, otherwise it maps ground
+    # truth concepts to learnt concepts
+    if auc_matrix.shape[0] < auc_matrix.shape[1]:
+        order = np.argsort(row_idxs)
+        permutation = list(col_idxs[order])
+    else:
+        order = np.argsort(col_idxs)
+        permutation = list(row_idxs[order])
+    current_aucs = list(auc_matrix[row_idxs[order], col_idxs[order]])
+    return {
+        'best_reduced_auc': reduction(current_aucs),
+        'best_individual_auc': current_aucs,
+        'best_permutation': permutation,
+    }
 
 def brute_force_concept_mask_aucs(
     concept_importance_masks, # List[np.arrays of normalized scores for each feature] for each concept
@@ -85,10 +269,32 @@ def brute_force_concept_mask_aucs(
     reduction=np.mean,
     thresh=None,
     alignment=None,
+    solver="assignment",
 ):
     result = {}
     concept_importance_masks = np.array(concept_importance_masks)
     ground_truth_concept_masks = np.array(ground_truth_concept_masks)
+    # All pairwise AUCs are computed once and every alignment reads from them
+    auc_matrix = concept_mask_auc_matrix(
+        concept_importance_masks=concept_importance_masks,
+        ground_truth_concept_masks=ground_truth_concept_masks,
+        thresh=thresh,
+    )
+    if (alignment is None) and (solver == "assignment"):
+        # Solve for the best alignment exactly rather than trying all
+        # permutations. As in the permutation search below, if there are fewer
+        # learnt than ground truth concepts then only the first
+        # len(concept_importance_masks) ground truth concepts are candidates.
+        assignment = optimal_alignment(
+            auc_matrix[:, :auc_matrix.shape[0]],
+            reduction=reduction,
+        )
+        if assignment is not None:
+            return _aligned_auc_result(
+                auc_matrix,
+                *assignment,
+                reduction=reduction,
+            )
     if alignment is not None:
         perms = [alignment]
     else:
@@ -99,26 +305,20 @@ def brute_force_concept_mask_aucs(
                 concept_importance_masks.shape[0],
             ),
         )
+    n_pairs = min(
+        ground_truth_concept_masks.shape[0],
+        concept_importance_masks.shape[0],
+    )
     for permutation in perms:
+        permutation_idxs = np.array(permutation)[:n_pairs]
         if len(concept_importance_masks) < len(ground_truth_concept_masks):
-            reference_masks = ground_truth_concept_masks[permutation, :]
-            current_masks = concept_importance_masks
+            current_aucs = list(
+                auc_matrix[np.arange(n_pairs), permutation_idxs]
+            )
         else:
-            reference_masks = ground_truth_concept_masks
-            current_masks = concept_importance_masks[permutation, :]
-        current_aucs = []
-        for i in range(min(
-            ground_truth_concept_masks.shape[0],
-            concept_importance_masks.shape[0],
-        )):
-            mask = current_masks[i, :]
-            if thresh is not None:
-                mask = (mask >= thresh).astype(np.int32)
-            ground_truth = reference_masks[i, :]
-            current_aucs.append(sklearn.metrics.roc_auc_score(
-                ground_truth,
-                mask,
-            ))
+            current_aucs = list(
+                auc_matrix[permutation_idxs, np.arange(n_pairs)]
+            )
         red_score = reduction(current_aucs)
         if result.get('best_reduced_auc', 0.0) < red_score:
             result['best_reduced_auc'] = red_score
@@ -131,8 +331,29 @@ def brute_force_concept_aucs(
     c_test,
     reduction=np.mean,
     alignment=None,
+    solver="assignment",
 ):
     result = {}
+    # All pairwise AUCs are computed once and every alignment reads from them
+    auc_matrix = concept_auc_matrix(
+        concept_scores=concept_scores,
+        c_test=c_test,
+    )
+    if (alignment is None) and (solver == "assignment"):
+        # Solve for the best alignment exactly rather than trying all
+        # permutations. As in the permutation search below, if there are more
+        # learnt than ground truth concepts then only the first
+        # c_test.shape[-1] learnt concepts are candidates.
+        assignment = optimal_alignment(
+            auc_matrix[:auc_matrix.shape[1], :],
+            reduction=reduction,
+        )
+        if assignment is not None:
+            return _aligned_auc_result(
+                auc_matrix,
+                *assignment,
+                reduction=reduction,
+            )
     if alignment is not None:
         perms = [alignment]
     else:
@@ -144,29 +365,21 @@ def brute_force_concept_aucs(
             ),
         )
     for permutation in perms:
+        # Note that auc_matrix already accounts for concepts learnt flipped
         if concept_scores.shape[-1] < c_test.shape[-1]:
-            test_scores = c_test[:, list(filter(lambda x: x is not None, permutation))]
-            scores = concept_scores
+            true_idxs = np.array(
+                list(filter(lambda x: x is not None, permutation)),
+                dtype=np.int64,
+            )
+            n_pairs = min(len(true_idxs), concept_scores.shape[-1])
+            current_aucs = list(
+                auc_matrix[np.arange(n_pairs), true_idxs[:n_pairs]]
+            )
         else:
-            test_scores = c_test
-            scores = concept_scores[:, permutation]
-        current_aucs = []
-        for i in range(min(
-            test_scores.shape[-1],
-            concept_scores.shape[-1],
-        )):
-            # We take the max as the concept may be flipped
-            current_score = max(
-                sklearn.metrics.roc_auc_score(
-                    test_scores[:, i],
-                    scores[:, i],
-                ),
-                sklearn.metrics.roc_auc_score(
-                    test_scores[:, i],
-                    1 - scores[:, i],
-                ),
+            n_pairs = c_test.shape[-1]
+            current_aucs = list(
+                auc_matrix[np.array(permutation)[:n_pairs], np.arange(n_pairs)]
             )
-            current_aucs.append(current_score)
         red_score = reduction(current_aucs)
         if result.get('best_reduced_auc', 0.0) < red_score:
             result['best_reduced_auc'] = red_score
@@ -183,6 +396,30 @@ def correlation_alignment(scores, c_test):
     n_concepts = scores.shape[-1]
     return np.abs(np.corrcoef(np.hstack([scores, c_test]).T)[:n_concepts, n_concepts:])
 
+def _quantile_cluster_levels(scores, n_clusters):
+    # Exact 1-D clusterings are contiguous intervals of the sorted scores, so
+    # we rank the scores once and cut them into nc equal-frequency bins for
+    # every requested number of clusters. Tied scores share their lowest rank
+    # so that they always end up in the same cluster.
+    ranks = scipy.stats.rankdata(scores, method='min') - 1
+    for nc in n_clusters:
+        yield (ranks * nc) // len(scores)
+
+def _hierarchical_cluster_levels(features, n_clusters):
+    # Build a single Ward dendrogram and cut it at every requested level
+    linkage = scipy.cluster.hierarchy.linkage(features, method='ward')
+    cuts = scipy.cluster.hierarchy.cut_tree(
+        linkage,
+        n_clusters=n_clusters,
+    )
+    for i in range(len(n_clusters)):
+        yield cuts[:, i]
+
+def _kmedoids_cluster_levels(features, n_clusters):
+    for nc in n_clusters:
+        kmedoids = KMedoids(n_clusters=nc, random_state=0)
+        yield kmedoids.fit_predict(features)
+
 def embedding_homogeneity(
     c_vec,
     c_test,
@@ -190,6 +427,8 @@ def embedding_homogeneity(
     step,
     force_alignment=True,
     alignment=None,
+    method="kmedoids",
+    purity_predictor="mlp",
 ):
     """
     Computes the alignment between learnt concepts and labels.
@@ -198,8 +437,22 @@ def embedding_homogeneity(
     :param c_test: concept ground truth labels
     :param y_test: task ground truth labels
     :param step: integration step
+    :param method: how to cluster each concept representation. "kmedoids"
+        fits a KMedoids model from scratch for every number of clusters.
+        "scalable" clusters one-dimensional scores by cutting their sorted
+        order into quantile bins and builds a single hierarchical clustering
+        dendrogram for higher-dimensional representations, cutting both at
+        every number of clusters.
+    :param purity_predictor: the predictor used to compute the concept
+        purity matrix when no alignment is given (see
+        purity.concept_purity_matrix).
     :return: concept alignment AUC, task alignment AUC
     """
+    if method not in ["kmedoids", "scalable"]:
+        raise ValueError(
+            f'Unsupported CAS clustering method "{method}". Supported '
+            f'methods are "kmedoids" and "scalable".'
+        )
 
     # First lets compute an alignment between concept
     # scores and ground truth concepts
@@ -208,6 +461,7 @@ def embedding_homogeneity(
             purity_mat = purity.concept_purity_matrix(
                 c_soft=c_vec,
                 c_true=c_test,
+                predictor=purity_predictor,
             )
             alignment = purity.find_max_alignment(purity_mat)
         # And use the new vector with its corresponding alignment
@@ -229,22 +483,28 @@ def embedding_homogeneity(
     concept_auc, task_auc = [], []
     for concept_id in range(c_test.shape[1]):
         concept_homogeneity, task_homogeneity = [], []
-        for nc in n_clusters:
-            kmedoids = KMedoids(n_clusters=nc, random_state=0)
-            if c_vec.shape[1] != c_test.shape[1]:
-                c_cluster_labels = kmedoids.fit_predict(
-                    np.hstack([
-                        c_vec[:, concept_id][:, np.newaxis],
-                        c_vec[:, c_test.shape[1]:]
-                    ])
-                )
-            elif c_vec.shape[1] == c_test.shape[1] and len(c_vec.shape) == 2:
-                c_cluster_labels = kmedoids.fit_predict(
-                    c_vec[:, concept_id].reshape(-1, 1)
-                )
-            else:
-                c_cluster_labels = kmedoids.fit_predict(c_vec[:, concept_id])
-
+        if c_vec.shape[1] != c_test.shape[1]:
+            features = np.hstack([
+                c_vec[:, concept_id][:, np.newaxis],
+                c_vec[:, c_test.shape[1]:]
+            ])
+        elif c_vec.shape[1] == c_test.shape[1] and len(c_vec.shape) == 2:
+            features = c_vec[:, concept_id].reshape(-1, 1)
+        else:
+            features = c_vec[:, concept_id]
+        if method == "kmedoids":
+            cluster_levels = _kmedoids_cluster_levels(features, n_clusters)
+        elif features.shape[-1] == 1:
+            cluster_levels = _quantile_cluster_levels(
+                features[:, 0],
+                n_clusters,
+            )
+        else:
+            cluster_levels = _hierarchical_cluster_levels(
+                features,
+                n_clusters,
+            )
+        for c_cluster_labels in cluster_levels:
             # compute alignment with ground truth labels
             concept_homogeneity.append(
                 homogeneity_score(c_test[:, concept_id], c_cluster_labels)
@@ -264,6 +524,49 @@ def embedding_homogeneity(
         return concept_auc, task_auc, alignment
     return concept_auc, task_auc
 
+def embedding_homogeneity_agreement(
+    c_vec,
+    c_test,
+    y_test,
+    step,
+    alignment=None,
+    max_samples=None,
+    seed=42,
+):
+    """
+    Reports how closely the scalable CAS agrees with the KMedoids-based CAS.
+    As the latter does not scale to large datasets, both are computed on a
+    random subsample of at most max_samples test samples (if given).
+
+    :return: a dictionary with the concept and task alignment AUCs of both
+        methods and their absolute differences.
+    """
+    if (max_samples is not None) and (c_vec.shape[0] > max_samples):
+        rng = np.random.default_rng(seed)
+        selected = rng.choice(c_vec.shape[0], size=max_samples, replace=False)
+        c_vec, c_test, y_test = c_vec[selected], c_test[selected], y_test[selected]
+    if alignment is None:
+        alignment = purity.find_max_alignment(
+            purity.concept_purity_matrix(c_soft=c_vec, c_true=c_test)
+        )
+    result = {}
+    for method in ["kmedoids", "scalable"]:
+        concept_auc, task_auc, _ = embedding_homogeneity(
+            c_vec=c_vec,
+            c_test=c_test,
+            y_test=y_test,
+            step=step,
+            alignment=alignment,
+            method=method,
+        )
+        result[f'{method}_cas'] = concept_auc
+        result[f'{method}_cas_task'] = task_auc
+    result['cas_diff'] = abs(result['kmedoids_cas'] - result['scalable_cas'])
+    result['cas_task_diff'] = abs(
+        result['kmedoids_cas_task'] - result['scalable_cas_task']
+    )
+    return result
+
 
 ##############
 ## R4
@@ -296,12 +599,19 @@ def is_categorical(v, max_uniq=10):
     # hierarchy object instead.
     return len(np.unique(v)) <= max_uniq and np.allclose(v.astype(int), v)
 
-def sample_R2_oneway(inputs, targets, reg=GradientBoostingRegressor, kls=GradientBoostingClassifier):
+def sample_R2_oneway(inputs, targets, reg=GradientBoostingRegressor, kls=GradientBoostingClassifier, split=None):
     if len(inputs) < 2:
         # Handle edge case of nearly empty input
         return 0
 
-    x_train, x_test, y_train, y_test = train_test_split(inputs.reshape(-1,1), targets)
+    if split is None:
+        x_train, x_test, y_train, y_test = train_test_split(inputs.reshape(-1,1), targets)
+    else:
+        # Reuse a precomputed (train_idxs, test_idxs) split
+        train_idxs, test_idxs = split
+        x_train = inputs[train_idxs].reshape(-1, 1)
+        x_test = inputs[test_idxs].reshape(-1, 1)
+        y_train, y_test = targets[train_idxs], targets[test_idxs]
     n_uniq = min(len(np.unique(y_train)), len(np.unique(y_test)))
 
     if n_uniq == 1:
@@ -319,27 +629,66 @@ def sample_R2_oneway(inputs, targets, reg=GradientBoostingRegressor, kls=Gradien
     # Return the R^2 (or accuracy) score
     return model.fit(x_train, y_train).score(x_test, y_test)
 
-def R2_oneway(inputs, targets, iters=5, **kw):
-    # Repeatedly compute R^2 over random splits
+def R2_oneway(inputs, targets, iters=5, splits=None, **kw):
+    # Repeatedly compute R^2 over random splits (or the given ones)
+    if splits is not None:
+        return np.mean([
+            sample_R2_oneway(inputs, targets, split=split, **kw)
+            for split in splits
+        ])
     return np.mean([sample_R2_oneway(inputs, targets, **kw) for _ in range(iters)])
 
-def R2_bothways(x, y):
+def R2_bothways(x, y, **kw):
     # Take the geometric mean of R^2 in both directions
-    r1 = max(0, R2_oneway(x,y))
-    r2 = max(0, R2_oneway(y,x))
+    r1 = max(0, R2_oneway(x,y, **kw))
+    r2 = max(0, R2_oneway(y,x, **kw))
     return np.sqrt(r1*r2)
 
-def R4_scores(V, Z):
-    # For each dimension, find the best R2_bothways
-    scores = []
-
-    for i in range(V.shape[1]):
-        best = 0
-        for j in range(Z.shape[1]):
-            best = max(best, R2_bothways(V[:,i], Z[:,j]))
-        scores.append(best)
-
-    return np.mean(scores)
+# Regressor and classifier used by R4_scores for each estimator option. The
+# isotonic option fits a monotonic map, which is all an invertible function
+# between two 1-D variables can be. Categorical targets are still scored by a
+# classifier's accuracy so that R4 means the same for every option.
+_R4_ESTIMATORS = {
+    "gbt": (GradientBoostingRegressor, GradientBoostingClassifier),
+    "hist": (HistGradientBoostingRegressor, HistGradientBoostingClassifier),
+    "isotonic": (
+        functools.partial(
+            IsotonicRegression,
+            increasing='auto',
+            out_of_bounds='clip',
+        ),
+        HistGradientBoostingClassifier,
+    ),
+}
+
+def R4_scores(V, Z, estimator="gbt", iters=5, n_jobs=None, random_state=None):
+    # For each dimension, find the best R2_bothways. All pairs share the same
+    # precomputed random splits and they are evaluated in parallel.
+    if estimator not in _R4_ESTIMATORS:
+        raise ValueError(
+            f'Unsupported R4 estimator "{estimator}". Supported estimators '
+            f'are {list(_R4_ESTIMATORS.keys())}.'
+        )
+    reg, kls = _R4_ESTIMATORS[estimator]
+    # Falls back to NumPy's global RNG so that seeding it makes R4 reproducible
+    rng = sklearn.utils.check_random_state(random_state)
+    splits = [
+        train_test_split(np.arange(V.shape[0]), random_state=rng)
+        for _ in range(iters)
+    ]
+    pair_scores = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(R2_bothways)(
+            V[:, i],
+            Z[:, j],
+            splits=splits,
+            reg=reg,
+            kls=kls,
+        )
+        for i in range(V.shape[1])
+        for j in range(Z.shape[1])
+    )
+    pair_scores = np.reshape(pair_scores, (V.shape[1], Z.shape[1]))
+    return np.mean(np.maximum(np.max(pair_scores, axis=1), 0))
 
 
 ###############################################################################
@@ -359,15 +708,65 @@ def estimate_mutual_information(X, Y, bins=20):
 def estimate_entropy(X, **kw):
   return estimate_mutual_information(X, X, **kw)
 
-def MIG(Z_true, Z_learned, **kw):
+def _histogram_codes(X, bins=20):
+  # Discretizes every column of X into the same equal-width bins that
+  # np.histogram2d would use for it
+  codes = np.zeros(X.shape, dtype=np.int64)
+  for j in range(X.shape[1]):
+    low, high = np.min(X[:, j]), np.max(X[:, j])
+    if low == high:
+      low, high = low - 0.5, high + 0.5
+    edges = np.linspace(low, high, bins + 1)
+    codes[:, j] = np.minimum(
+      np.searchsorted(edges, X[:, j], side='right') - 1,
+      bins - 1,
+    )
+  return codes
+
+def _mutual_information_from_counts(counts):
+  # counts: [..., bins, bins] joint histograms. Returns their MI in nats.
+  total = np.sum(counts, axis=(-2, -1), keepdims=True)
+  p_joint = counts / total
+  p_outer = (
+    np.sum(p_joint, axis=-1, keepdims=True) *
+    np.sum(p_joint, axis=-2, keepdims=True)
+  )
+  nonzero = p_joint > 0
+  terms = np.zeros(p_joint.shape)
+  terms[nonzero] = p_joint[nonzero] * np.log(
+    p_joint[nonzero] / p_outer[nonzero]
+  )
+  return np.sum(terms, axis=(-2, -1))
+
+def _entropy_from_counts(counts):
+  p = counts / np.sum(counts)
+  p = p[p > 0]
+  return -np.sum(p * np.log(p))
+
+def MIG(Z_true, Z_learned, bins=20):
+    # Every column is discretized once and, for each true factor, the joint
+    # histograms against all learned dimensions come from a single bincount
+    # over combined bin codes
     K = Z_true.shape[1]
+    J = Z_learned.shape[1]
+    true_codes = _histogram_codes(Z_true, bins=bins)
+    # Offset each learned dimension so that all pairs get disjoint codes
+    learned_codes = (
+      _histogram_codes(Z_learned, bins=bins) * bins +
+      np.arange(J)[None, :] * bins * bins
+    )
     gap = 0
     for k in range(K):
-        H = estimate_entropy(Z_true[:,k], **kw)
-        MIs = sorted([
-          estimate_mutual_information(Z_learned[:,j], Z_true[:,k], **kw)
-          for j in range(Z_learned.shape[1])
-        ], reverse=True)
+        H = _entropy_from_counts(
+          np.bincount(true_codes[:, k], minlength=bins)
+        ) / np.log(2)
+        counts = np.bincount(
+          (learned_codes + true_codes[:, k:(k + 1)]).ravel(),
+          minlength=J * bins * bins,
+        ).reshape(J, bins, bins)
+        MIs = np.sort(
+          _mutual_information_from_counts(counts) / np.log(2)
+        )[::-1]
         if len(MIs) > 1:
             gap += (MIs[0] - MIs[1]) / (H * K)
         else:
@@ -380,21 +779,41 @@ def MIG(Z_true, Z_learned, **kw):
 #
 ###############################################################################
 
+def _pairwise_r2(V, Z):
+    # In-sample R^2 of a 1-D linear regression of every column of V on every
+    # column of Z, which is their squared Pearson correlation
+    V_centered = V - np.mean(V, axis=0)
+    Z_centered = Z - np.mean(Z, axis=0)
+    V_norms = np.sqrt(np.sum(V_centered ** 2, axis=0))
+    Z_norms = np.sqrt(np.sum(Z_centered ** 2, axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (V_centered.T @ Z_centered) / np.outer(V_norms, Z_norms)
+    r2 = np.nan_to_num(corr ** 2, nan=0.0)
+    # As in sklearn, a constant target is perfectly predicted
+    r2[V_norms == 0, :] = 1.0
+    return r2
+
 def SAP(V, Z):
     saps = []
+    # Regression scores of all continuous factors are computed in one shot
+    categorical = [is_categorical(V[:, i]) for i in range(V.shape[1])]
+    regression_scores = _pairwise_r2(
+        V.astype(np.float64),
+        Z.astype(np.float64),
+    )
 
     for i in range(V.shape[1]):
         v = V[:,i]
 
-        scores = []
-        for j in range(Z.shape[1]):
-            if is_categorical(v):
+        if categorical[i]:
+            scores = []
+            v = v.astype(int)
+            for j in range(Z.shape[1]):
                 model = LinearSVC(C=0.01, class_weight="balanced")
-                v = v.astype(int)
-            else:
-                model = LinearRegression()
-            z = Z[:,j].reshape(-1,1)
-            scores.append(model.fit(z,v).score(z,v))
+                z = Z[:,j].reshape(-1,1)
+                scores.append(model.fit(z,v).score(z,v))
+        else:
+            scores = list(regression_scores[i, :])
         scores = list(sorted(scores))
         if len(scores) > 1:
             saps.append(scores[-1] - scores[-2])
@@ -412,11 +831,27 @@ def SAP(V, Z):
 #
 ###############################################################################
 
-def DCI(gen_factors, latents):
-  """Computes score based on both training and testing codes and factors."""
+def DCI(gen_factors, latents, backend="gbt", max_rows=None, n_jobs=None):
+  """Computes score based on both training and testing codes and factors.
+
+  backend selects the gradient boosted trees used to compute importances
+  (see compute_importance_gbt). If max_rows is given, at most that many
+  randomly selected training points are used to fit them, while the
+  informativeness is still evaluated on the full test split.
+  """
   mus_train, mus_test, ys_train, ys_test = train_test_split(gen_factors, latents, test_size=0.1)
+  if (max_rows is not None) and (mus_train.shape[0] > max_rows):
+    selected = np.random.choice(mus_train.shape[0], size=max_rows, replace=False)
+    mus_train, ys_train = mus_train[selected], ys_train[selected]
   scores = {}
-  importance_matrix, train_err, test_err = compute_importance_gbt(mus_train, ys_train, mus_test, ys_test)
+  importance_matrix, train_err, test_err = compute_importance_gbt(
+    mus_train,
+    ys_train,
+    mus_test,
+    ys_test,
+    backend=backend,
+    n_jobs=n_jobs,
+  )
   assert importance_matrix.shape[0] == mus_train.shape[1]
   assert importance_matrix.shape[1] == ys_train.shape[1]
   scores["informativeness_train"] = train_err
@@ -425,20 +860,79 @@ def DCI(gen_factors, latents):
   scores["completeness"] = completeness(importance_matrix)
   return scores["disentanglement"], scores["completeness"], scores["informativeness_test"]
 
-def compute_importance_gbt(x_train, y_train, x_test, y_test):
-  """Compute importance based on gradient boosted trees."""
+def _fit_factor_importance(x_train, y_train, x_test, y_test, backend, n_threads):
+  """Fits a single factor's regressor and returns its importances and scores."""
+  if backend == "gbt":
+    model = GradientBoostingRegressor()
+  elif backend == "hist":
+    model = HistGradientBoostingRegressor()
+  else:
+    model = xgb.XGBRegressor(tree_method="hist", n_jobs=n_threads)
+  # Histogram GBTs use all OpenMP threads by default, so we also limit them to
+  # this worker's share of threads
+  with threadpoolctl.threadpool_limits(limits=n_threads, user_api="openmp"):
+    model.fit(x_train, y_train)
+    if backend == "hist":
+      # Histogram GBTs expose no impurity-based importances so we use the
+      # permutation importance on (at most 10k randomly selected) training
+      # points
+      rng = np.random.RandomState(0)
+      selected = rng.choice(
+        x_train.shape[0],
+        size=min(10000, x_train.shape[0]),
+        replace=False,
+      )
+      importances = sklearn.inspection.permutation_importance(
+        model,
+        x_train[selected],
+        y_train[selected],
+        n_repeats=5,
+        random_state=rng,
+      ).importances_mean
+    else:
+      importances = model.feature_importances_
+    train_score = model.score(x_train, y_train)
+    test_score = model.score(x_test, y_test)
+  # Negative permutation importances are noise, not anti-importance
+  return np.clip(importances, 0, None), train_score, test_score
+
+def compute_importance_gbt(x_train, y_train, x_test, y_test, backend="gbt", n_jobs=None):
+  """Compute importance based on gradient boosted trees.
+
+  backend is one of "gbt" (sklearn's exact-split GBRT), "hist" (sklearn's
+  histogram GBRT) or "xgboost" (multi-threaded XGBoost with its "hist"
+  method). Factors are fitted in parallel across n_jobs workers.
+  """
+  if backend not in ["gbt", "hist", "xgboost"]:
+    raise ValueError(
+      f'Unsupported DCI backend "{backend}". Supported backends are "gbt", '
+      f'"hist", and "xgboost".'
+    )
   num_factors = y_train.shape[1]
   num_codes = x_train.shape[1]
   importance_matrix = np.zeros(shape=[num_codes, num_factors],
                                dtype=np.float64)
+  # XGBoost and histogram GBTs are multi-threaded themselves, so we split the
+  # available threads between the factors being fitted at the same time
+  n_workers = joblib.effective_n_jobs(n_jobs)
+  n_threads = max(1, joblib.cpu_count() // n_workers)
+  results = joblib.Parallel(n_jobs=n_jobs)(
+    joblib.delayed(_fit_factor_importance)(
+      x_train,
+      y_train[:, i],
+      x_test,
+      y_test[:, i],
+      backend=backend,
+      n_threads=n_threads,
+    )
+    for i in range(num_factors)
+  )
   train_loss = []
   test_loss = []
-  for i in range(num_factors):
-    model = GradientBoostingRegressor()
-    model.fit(x_train, y_train[:,i])
-    importance_matrix[:, i] = np.abs(model.feature_importances_)
-    train_loss.append(model.score(x_train, y_train[:,i]))
-    test_loss.append(model.score(x_test, y_test[:,i]))
+  for i, (importances, train_score, test_score) in enumerate(results):
+    importance_matrix[:, i] = importances
+    train_loss.append(train_score)
+    test_loss.append(test_score)
   return importance_matrix, np.mean(train_loss), np.mean(test_loss)
 
 
@@ -517,10 +1011,12 @@ def FactorVAE(ground_truth_X,
     scores_dict["num_active_dims"] = 0
     return scores_dict
 
+  factor_groups = _factor_groups(ground_truth_Z)
   training_votes = _generate_training_batch(ground_truth_X, ground_truth_Z,
                                             representation_function, batch_size,
                                             num_train, random_state,
-                                            global_variances, active_dims)
+                                            global_variances, active_dims,
+                                            factor_groups=factor_groups)
   classifier = np.argmax(training_votes, axis=0)
   other_index = np.arange(training_votes.shape[1])
 
@@ -530,7 +1026,8 @@ def FactorVAE(ground_truth_X,
   eval_votes = _generate_training_batch(ground_truth_X, ground_truth_Z,
                                         representation_function, batch_size,
                                         num_eval, random_state,
-                                        global_variances, active_dims)
+                                        global_variances, active_dims,
+                                        factor_groups=factor_groups)
 
   eval_accuracy = np.sum(eval_votes[classifier,
                                     other_index]) * 1. / np.sum(eval_votes)
@@ -645,11 +1142,73 @@ def _generate_training_sample(ground_truth_X, ground_truth_Z, representation_fun
   return factor_index, argmin
 
 
+def _factor_groups(ground_truth_Z):
+  """Sorts the observations along every factor once.
+
+  Returns:
+    List with, for each factor, a tuple (order, sorted_values, starts, counts)
+    where order sorts the observations by their value of the factor and
+    starts/counts give the position in the sorted order and size of every
+    group of observations sharing the same factor value.
+  """
+  groups = []
+  for factor_index in range(ground_truth_Z.shape[1]):
+    order = np.argsort(ground_truth_Z[:, factor_index], kind='stable')
+    sorted_values = ground_truth_Z[order, factor_index]
+    _, starts, counts = np.unique(
+        sorted_values,
+        return_index=True,
+        return_counts=True,
+    )
+    groups.append((order, sorted_values, starts, counts))
+  return groups
+
+
+def _closest_windows(sorted_values, values, window):
+  """Start of the `window` consecutive sorted values closest to each value."""
+  low = np.zeros(len(values), dtype=np.int64)
+  high = np.full(len(values), len(sorted_values) - window, dtype=np.int64)
+  while np.any(low < high):
+    active = low < high
+    mid = (low + high) // 2
+    right = sorted_values[np.minimum(mid + window, len(sorted_values) - 1)]
+    go_right = (values - sorted_values[mid]) > (right - values)
+    low = np.where(active & go_right, mid + 1, low)
+    high = np.where(active & (~go_right), mid, high)
+  return low
+
+
+def _sample_without_replacement(counts, size, random_state):
+  """Draws, for each count, `size` distinct offsets in [0, count)."""
+  offsets = np.floor(
+      random_state.random_sample((len(counts), size)) * counts[:, None]
+  ).astype(np.int64)
+  # Small populations are shuffled directly, large ones are redrawn in the
+  # (unlikely) event of a repeated offset
+  for i in np.where(counts < size * size)[0]:
+    offsets[i] = random_state.permutation(counts[i])[:size]
+  while True:
+    sorted_offsets = np.sort(offsets, axis=1)
+    repeated = np.any(sorted_offsets[:, 1:] == sorted_offsets[:, :-1], axis=1)
+    if not np.any(repeated):
+      return offsets
+    offsets[repeated] = np.floor(
+        random_state.random_sample((np.sum(repeated), size)) *
+        counts[repeated, None]
+    ).astype(np.int64)
+
+
 def _generate_training_batch(ground_truth_X, ground_truth_Z, representation_function,
                              batch_size, num_points, random_state,
-                             global_variances, active_dims):
+                             global_variances, active_dims,
+                             factor_groups=None, max_batch_rows=2**20):
   """Sample a set of training samples based on a batch of ground-truth data.
 
+  Equivalent to calling _generate_training_sample num_points times, but the
+  observations of many training samples are gathered and passed through the
+  representation function at once, in chunks of at most max_batch_rows
+  observations.
+
   Args:
     ground_truth_data: GroundTruthData to be sampled from.
     representation_function: Function that takes observations as input and
@@ -660,17 +1219,53 @@ def _generate_training_batch(ground_truth_X, ground_truth_Z, representation_func
     global_variances: Numpy vector with variances for all dimensions of
       representation.
     active_dims: Indexes of active dimensions.
+    factor_groups: Output of _factor_groups(ground_truth_Z), if already
+      computed.
+    max_batch_rows: Maximum number of observations per chunk.
 
   Returns:
     (num_factors, dim_representation)-sized numpy array with votes.
   """
+  if factor_groups is None:
+    factor_groups = _factor_groups(ground_truth_Z)
+  n_observations = ground_truth_Z.shape[0]
+  window = min(batch_size, n_observations)
   votes = np.zeros((ground_truth_Z.shape[1], global_variances.shape[0]),
                    dtype=np.int64)
-  for _ in range(num_points):
-    factor_index, argmin = _generate_training_sample(ground_truth_X, ground_truth_Z,
-                                                     representation_function,
-                                                     batch_size, random_state,
-                                                     global_variances,
-                                                     active_dims)
-    votes[factor_index, argmin] += 1
+  chunk_size = max(1, max_batch_rows // window)
+  for chunk_start in range(0, num_points, chunk_size):
+    n_samples = min(chunk_size, num_points - chunk_start)
+    # Select random coordinates to keep fixed.
+    factor_indexes = random_state.randint(ground_truth_Z.shape[1], size=n_samples)
+    observation_indexes = np.zeros((n_samples, window), dtype=np.int64)
+    for factor_index in np.unique(factor_indexes):
+      selected = np.where(factor_indexes == factor_index)[0]
+      order, sorted_values, starts, counts = factor_groups[factor_index]
+      # Pick fixed factor values by picking a random position in the
+      # sorted order
+      positions = random_state.randint(n_observations, size=len(selected))
+      groups = np.searchsorted(starts, positions, side='right') - 1
+      # If not enough examples are exactly equal, just pick all of the
+      # closest ones
+      sorted_positions = (
+          _closest_windows(sorted_values, sorted_values[positions], window)[:, None] +
+          np.arange(window)[None, :]
+      )
+      # If there are enough which are exactly equal, pick a random subset
+      exact = counts[groups] >= window
+      if np.any(exact):
+        sorted_positions[exact] = starts[groups[exact], None] + \
+            _sample_without_replacement(counts[groups[exact]], window,
+                                        random_state)
+      observation_indexes[selected] = order[sorted_positions]
+
+    # Obtain the observations and their local variances.
+    representations = representation_function(
+        ground_truth_X[observation_indexes.ravel()]
+    )
+    representations = np.reshape(representations, (n_samples, window, -1))
+    local_variances = np.var(representations, axis=1, ddof=1)
+    argmins = np.argmin(local_variances[:, active_dims] /
+                        global_variances[active_dims], axis=1)
+    np.add.at(votes, (factor_indexes, argmins), 1)
   return votes
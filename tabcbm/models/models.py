@@ -49,6 +49,29 @@ def replace_with_embedding(
         axis=-1,
     )
 
+@tf.keras.utils.register_keras_serializable(package="tabcbm")
+class SparseDense(tf.keras.layers.Dense):
+    """
+    Dense layer that multiplies tf.SparseTensor inputs with its kernel through
+    tf.sparse.sparse_dense_matmul so that high-dimensional sparse inputs
+    (e.g., cells x genes count matrices) never need to be densified. Dense
+    inputs are handled exactly as in tf.keras.layers.Dense.
+    """
+
+    def call(self, inputs):
+        if not isinstance(inputs, tf.SparseTensor):
+            return super().call(inputs)
+        outputs = tf.sparse.sparse_dense_matmul(
+            tf.cast(inputs, self.compute_dtype),
+            self.kernel,
+        )
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, self.bias)
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+
 def construct_encoder(
     input_shape,
     units,
@@ -59,8 +82,16 @@ def construct_encoder(
     emb_in_size=None,
     emb_out_size=1,
     return_embedding_extractor=False,
+    sparse_inputs=False,
 ):
-    encoder_inputs = tf.keras.Input(shape=input_shape)
+    if sparse_inputs and (
+        include_bn or ((emb_dims is not None) and (emb_in_size is not None))
+    ):
+        raise ValueError(
+            "Sparse inputs cannot be used together with input batch "
+            "normalization nor with categorical feature embeddings."
+        )
+    encoder_inputs = tf.keras.Input(shape=input_shape, sparse=sparse_inputs)
     encoder_compute_graph = encoder_inputs
     if (emb_dims is not None) and (emb_in_size is not None):
         encoder_compute_graph = replace_with_embedding(
@@ -86,13 +117,16 @@ def construct_encoder(
             scale=False,
         )(encoder_compute_graph)
 
-    # Include the fully connected bottleneck here
+    # Include the fully connected bottleneck here. If our inputs are sparse,
+    # then the first layer multiplies them directly without densifying them
+    dense_cls = SparseDense if sparse_inputs else tf.keras.layers.Dense
     for i, units in enumerate(units):
-        encoder_compute_graph = tf.keras.layers.Dense(
+        encoder_compute_graph = dense_cls(
             units,
             activation='relu',
             name=f"encoder_dense_{i}",
         )(encoder_compute_graph)
+        dense_cls = tf.keras.layers.Dense
         if include_bn:
             encoder_compute_graph = tf.keras.layers.BatchNormalization(
                 axis=-1,
@@ -103,7 +137,7 @@ def construct_encoder(
             )(encoder_compute_graph)
 
     # TIme to generate the latent code here
-    encoder_compute_graph = tf.keras.layers.Dense(
+    encoder_compute_graph = dense_cls(
         latent_dims,
         activation=latent_act,
         name="encoder_bypass_channel",
@@ -151,8 +185,9 @@ def construct_end_to_end_model(
     decoder,
     num_outputs,
     learning_rate=1e-3,
+    sparse_inputs=False,
 ):
-    model_inputs = tf.keras.Input(shape=input_shape)
+    model_inputs = tf.keras.Input(shape=input_shape, sparse=sparse_inputs)
     latent = encoder(model_inputs)
     if isinstance(latent, list):
         if len(latent) > 1:
@@ -6,12 +6,17 @@ SEFS work.
 Everything else is writen by the TabCBM's authors.
 """
 
+import hashlib
 import logging
 import numpy as np
+import os
 import scipy
+import scipy.sparse
+import scipy.stats
 import tensorflow as tf
 
 import tabcbm.concepts_xai.evaluation.metrics.completeness as completeness
+import tabcbm.models.models as models
 
 ################################################################################
 ## Helper functions
@@ -35,6 +40,389 @@ def copula_generation(X, batch_size):
     g = np.matmul(L, epsilon)
     return g.T
 
+def data_fingerprint(X):
+    # Content-based hash of an array (including its shape and dtype) which we
+    # use to key cached copula factors
+    if scipy.sparse.issparse(X):
+        # Hash the CSR representation rather than densifying the matrix
+        X = X.tocsr()
+        digest = hashlib.sha1(f"csr-{X.shape}-{X.dtype}".encode("utf-8"))
+        for part in [X.data, X.indices, X.indptr]:
+            digest.update(memoryview(np.ascontiguousarray(part)).cast("B"))
+        return digest.hexdigest()
+    X = np.ascontiguousarray(X)
+    digest = hashlib.sha1(f"{X.shape}-{X.dtype}".encode("utf-8"))
+    digest.update(memoryview(X).cast("B"))
+    return digest.hexdigest()
+
+def sparse_corrcoef(X):
+    # Same as np.corrcoef(X.T) for a sparse [n_samples, n_features] matrix X
+    # but computed from X.T @ X so that X is never densified
+    X = scipy.sparse.csr_matrix(X, dtype=np.float64)
+    mean = np.asarray(X.mean(axis=0)).reshape(-1)
+    cov = (X.T @ X).toarray() / X.shape[0] - np.outer(mean, mean)
+    std = np.sqrt(np.maximum(np.diag(cov), 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cov / np.outer(std, std)
+
+def low_rank_copula_factors(cov_mat, rank):
+    """
+    Computes a low-rank-plus-diagonal approximation of the correlation matrix
+    cov_mat using its top `rank` eigenpairs:
+
+        cov_mat ~= W @ W.T + diag(diag_std**2)
+
+    where W has shape [d, rank]. The diagonal term restores the unit variance
+    of every feature so that the marginal Bernoulli probabilities of the
+    copula sampler remain exact and only the cross-feature correlations are
+    approximated. Correlated Gaussian samples can then be drawn in
+    O(d * rank) per sample rather than O(d^2).
+
+    Returns the tuple (W, diag_std).
+    """
+    d = cov_mat.shape[-1]
+    rank = min(rank, d)
+    eig_vals, eig_vecs = scipy.linalg.eigh(
+        cov_mat,
+        subset_by_index=[d - rank, d - 1],
+    )
+    eig_vals = np.maximum(eig_vals, 0)
+    W = eig_vecs * np.sqrt(eig_vals)[None, :]
+    diag_std = np.sqrt(
+        np.maximum(np.diag(cov_mat) - np.sum(W**2, axis=-1), 0)
+    )
+    return W.astype(np.float32), diag_std.astype(np.float32)
+
+def copula_factors(X=None, cov_mat=None, cache_dir=None, rank=None):
+    """
+    Returns the correlation matrix of the features in X (or the given
+    covariance matrix cov_mat) together with the factors used by TabCBM's
+    Gaussian-copula mask sampler. If rank is None, these factors are the
+    lower Cholesky factor of the correlation matrix. Otherwise, they are the
+    tuple (W, diag_std) of its low-rank-plus-diagonal approximation (see
+    low_rank_copula_factors).
+
+    If cache_dir is given, all matrices are stored there in a file named
+    after a fingerprint of X (or cov_mat if given) so that any other model
+    built on the same data can reuse them rather than recomputing them.
+    If the matrix is not decomposable, we fall back to assuming full
+    independence between features.
+    """
+    assert (X is not None) or (cov_mat is not None), (
+        "Expected either a data matrix X or a covariance matrix cov_mat"
+    )
+    cache_file = None
+    cached = {}
+    if cache_dir is not None:
+        cache_file = os.path.join(
+            cache_dir,
+            f"copula_{data_fingerprint(X if cov_mat is None else cov_mat)}.npz",
+        )
+        if os.path.exists(cache_file):
+            logging.debug(f"Loading copula factors from {cache_file}")
+            with np.load(cache_file) as cached_file:
+                cached = dict(cached_file)
+    if rank is None:
+        factor_keys = ["L"]
+    else:
+        factor_keys = [f"W_{rank}", f"diag_std_{rank}"]
+    if all(key in cached for key in ["cov_mat"] + factor_keys):
+        factors = tuple(cached[key] for key in factor_keys)
+        return cached["cov_mat"], factors[0] if rank is None else factors
+
+    if "cov_mat" in cached:
+        cov_mat = cached["cov_mat"]
+    elif cov_mat is None:
+        if scipy.sparse.issparse(X):
+            cov_mat = sparse_corrcoef(X)
+        else:
+            cov_mat = np.corrcoef(X.T)
+    if rank is None:
+        try:
+            factors = (
+                scipy.linalg.cholesky(cov_mat, lower=True).astype(np.float32),
+            )
+        except:
+            # Else, if it is not decomposable, assume full independence
+            print(
+                "[WARNING] Assuming independence between features in TabCBM "
+                "training."
+            )
+            cov_mat = np.eye(cov_mat.shape[-1], dtype=np.float32)
+            factors = (np.eye(cov_mat.shape[-1], dtype=np.float32),)
+            # Factors cached for other ranks are no longer valid
+            cached = {}
+    else:
+        factors = low_rank_copula_factors(cov_mat, rank)
+
+    if cache_file is not None:
+        cached["cov_mat"] = cov_mat
+        cached.update(zip(factor_keys, factors))
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to a temporary file first so that concurrent runs never see a
+        # partially written cache
+        tmp_file = cache_file[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+        np.savez(tmp_file, **cached)
+        os.replace(tmp_file, cache_file)
+    return cov_mat, factors[0] if rank is None else factors
+
+def compare_copula_samplers(
+    cov_mat,
+    rank,
+    probs=0.5,
+    n_samples=10000,
+    seed=0,
+):
+    """
+    Compares the masks sampled by the exact Gaussian-copula Bernoulli sampler
+    (using the Cholesky factor of cov_mat) against those sampled using its
+    rank-`rank` low-rank-plus-diagonal approximation. Both samplers are fed
+    with the same standard Gaussian noise where possible.
+
+    Returns a dictionary with the relative Frobenius error of the approximated
+    correlation matrix and the maximum/mean absolute errors between the
+    empirical mask activation rates and mask correlation matrices of both
+    samplers.
+    """
+    rng = np.random.default_rng(seed)
+    d = cov_mat.shape[-1]
+    L = scipy.linalg.cholesky(cov_mat, lower=True)
+    W, diag_std = low_rank_copula_factors(cov_mat, rank)
+    probs = np.broadcast_to(probs, (d,))
+
+    epsilon = rng.standard_normal((d, n_samples))
+    exact_masks = scipy.stats.norm.cdf((L @ epsilon).T) <= probs
+    epsilon_k = rng.standard_normal((W.shape[-1], n_samples))
+    approx_masks = scipy.stats.norm.cdf(
+        (W @ epsilon_k + diag_std[:, None] * epsilon).T
+    ) <= probs
+
+    # Constant masks have an undefined correlation so we ignore them
+    with np.errstate(invalid='ignore', divide='ignore'):
+        exact_corr = np.corrcoef(exact_masks.T)
+        approx_corr = np.corrcoef(approx_masks.T)
+    corr_diff = np.abs(exact_corr - approx_corr)
+    rate_diff = np.abs(
+        np.mean(exact_masks, axis=0) - np.mean(approx_masks, axis=0)
+    )
+    return dict(
+        cov_rel_error=(
+            np.linalg.norm(cov_mat - (W @ W.T + np.diag(diag_std**2))) /
+            np.linalg.norm(cov_mat)
+        ),
+        max_rate_error=np.max(rate_diff),
+        mean_rate_error=np.mean(rate_diff),
+        max_mask_corr_error=np.nanmax(corr_diff),
+        mean_mask_corr_error=np.nanmean(corr_diff),
+    )
+
+
+def mask_sparse_features(x, gate_vector):
+    """
+    Masks the sparse [B, n_features] batch x with the given gates by scaling
+    each of its stored entries by its corresponding gate value. gate_vector
+    may either be shared across the batch (shape [n_features]) or be
+    sample-specific (shape [B, n_features]). As masked-out features are
+    replaced with zeros, the result keeps the sparsity pattern of x.
+    """
+    if gate_vector.shape.rank == 1:
+        gates = tf.gather(gate_vector, x.indices[:, 1])
+    else:
+        gates = tf.gather_nd(gate_vector, x.indices)
+    return tf.SparseTensor(
+        indices=x.indices,
+        values=x.values * gates,
+        dense_shape=x.dense_shape,
+    )
+
+
+################################################################################
+## Fused Concept Generators
+################################################################################
+
+
+def _stacked_initializer(initializer_cls):
+    # Keras' fan-based initializers treat all leading dimensions as part of the
+    # receptive field. To match the scale of a standalone Dense layer, we
+    # initialize each concept's kernel independently (using a fresh initializer
+    # for each concept as unseeded initializers may return identical values
+    # when called more than once)
+    def _init(shape, dtype=None):
+        return tf.stack(
+            [initializer_cls()(shape[1:], dtype=dtype) for _ in range(shape[0])],
+            axis=0,
+        )
+    return _init
+
+
+class ConceptGeneratorBank(tf.keras.layers.Layer):
+    """
+    Bank of n_concepts independent concept generator MLPs whose weights are
+    kept stacked in [n_concepts, in, out] tensors so that all concepts can be
+    evaluated with a single batched matmul per layer. This is numerically
+    equivalent to having one tf.keras.models.Sequential per concept.
+
+    Inputs must have shape [n_concepts, B, in] and outputs will have shape
+    [n_concepts, B, latent_dims]. Inputs may also be given as a list of
+    n_concepts sparse [B, in] tf.SparseTensors, in which case each of them is
+    multiplied with its concept's first kernel via
+    tf.sparse.sparse_dense_matmul.
+    """
+
+    def __init__(
+        self,
+        n_concepts,
+        units,
+        latent_dims,
+        include_bn=False,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.n_concepts = n_concepts
+        self.units = list(units)
+        self.latent_dims = latent_dims
+        self.include_bn = include_bn
+        self.bn = None
+        if include_bn:
+            # Normalize over the batch dimension only so that each concept
+            # keeps its own statistics, as it would with independent models
+            self.bn = tf.keras.layers.BatchNormalization(
+                axis=[0, 2],
+                momentum=0.99,
+                epsilon=0.001,
+                center=False,
+                scale=False,
+            )
+        self.kernels = []
+        self.biases = []
+
+    def build(self, input_shape):
+        if isinstance(input_shape, list) and isinstance(
+            input_shape[0],
+            tf.TensorShape,
+        ):
+            # Then we were given one sparse input per concept
+            input_shape = input_shape[0]
+        in_dims = int(input_shape[-1])
+        if self.bn is not None:
+            self.bn.build((self.n_concepts, None, in_dims))
+        for i, out_dims in enumerate(self.units + [self.latent_dims]):
+            self.kernels.append(self.add_weight(
+                name=f"kernel_{i}",
+                shape=(self.n_concepts, in_dims, out_dims),
+                dtype=tf.float32,
+                initializer=_stacked_initializer(
+                    tf.keras.initializers.GlorotUniform
+                ),
+                trainable=True,
+            ))
+            self.biases.append(self.add_weight(
+                name=f"bias_{i}",
+                shape=(self.n_concepts, out_dims),
+                dtype=tf.float32,
+                initializer=tf.keras.initializers.Zeros(),
+                trainable=True,
+            ))
+            in_dims = out_dims
+        super().build(input_shape)
+
+    def call(self, inputs, training=None):
+        outputs = inputs
+        start = 0
+        if isinstance(inputs, (list, tuple)):
+            # Shape: [n_concepts, B, out_dims]
+            outputs = tf.stack(
+                [
+                    tf.sparse.sparse_dense_matmul(x, self.kernels[0][i])
+                    for i, x in enumerate(inputs)
+                ],
+                axis=0,
+            ) + tf.expand_dims(self.biases[0], axis=1)
+            if len(self.kernels) > 1:
+                outputs = tf.nn.relu(outputs)
+            start = 1
+        elif self.bn is not None:
+            outputs = self.bn(outputs, training=training)
+        for i in range(start, len(self.kernels)):
+            # Shape: [n_concepts, B, out_dims]
+            outputs = tf.linalg.matmul(outputs, self.kernels[i]) + tf.expand_dims(
+                self.biases[i],
+                axis=1,
+            )
+            if i < (len(self.kernels) - 1):
+                outputs = tf.nn.relu(outputs)
+        return outputs
+
+    def set_weights_from_generators(self, concept_generators):
+        """
+        Copies the weights of a list of n_concepts per-concept Sequential
+        generators (as built by TabCBM when fused_concept_generators=False)
+        into this bank. The given generators must have already been built.
+        """
+        assert len(concept_generators) == self.n_concepts, (
+            f"Expected {self.n_concepts} concept generators but got "
+            f"{len(concept_generators)} instead."
+        )
+        dense_layers = [
+            [
+                layer for layer in generator.layers
+                if isinstance(layer, tf.keras.layers.Dense)
+            ]
+            for generator in concept_generators
+        ]
+        if not self.built:
+            self.build(
+                (self.n_concepts, None, dense_layers[0][0].kernel.shape[0])
+            )
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            kernel.assign(np.stack(
+                [layers[i].kernel.numpy() for layers in dense_layers],
+                axis=0,
+            ))
+            bias.assign(np.stack(
+                [layers[i].bias.numpy() for layers in dense_layers],
+                axis=0,
+            ))
+        if self.bn is not None:
+            bn_layers = [
+                [
+                    layer for layer in generator.layers
+                    if isinstance(layer, tf.keras.layers.BatchNormalization)
+                ][0]
+                for generator in concept_generators
+            ]
+            for name in ["moving_mean", "moving_variance"]:
+                var = getattr(self.bn, name)
+                var.assign(np.reshape(
+                    np.stack(
+                        [getattr(bn, name).numpy() for bn in bn_layers],
+                        axis=0,
+                    ),
+                    var.shape,
+                ))
+
+    @classmethod
+    def from_generators(cls, concept_generators, include_bn=False, **kwargs):
+        """
+        Conversion helper that builds a bank holding the same weights as the
+        given list of per-concept Sequential generators. This allows models
+        restored from checkpoints produced with separate concept generators to
+        be used with the fused bank.
+        """
+        dense_layers = [
+            layer for layer in concept_generators[0].layers
+            if isinstance(layer, tf.keras.layers.Dense)
+        ]
+        bank = cls(
+            n_concepts=len(concept_generators),
+            units=[layer.units for layer in dense_layers[:-1]],
+            latent_dims=dense_layers[-1].units,
+            include_bn=include_bn,
+            **kwargs,
+        )
+        bank.set_weights_from_generators(concept_generators)
+        return bank
+
 
 ################################################################################
 ## Main TabCBM Class
@@ -51,6 +439,14 @@ class TabCBM(tf.keras.Model):
         n_concepts,
         features_to_embeddings_model=None,
         cov_mat=None,
+        # Lower Cholesky factor of cov_mat. If not given, it is computed here
+        cov_cholesky=None,
+        # If given, the copula mask sampler uses a low-rank-plus-diagonal
+        # approximation of cov_mat with this rank rather than its Cholesky
+        # factor (see low_rank_copula_factors)
+        cov_rank=None,
+        # Precomputed (W, diag_std) factors for the approximation above
+        cov_low_rank_factors=None,
         masking_values=None,
 
         # Self-supervised (SS) related arguments
@@ -78,6 +474,22 @@ class TabCBM(tf.keras.Model):
         rec_model_units=[64],
         concept_generators=None,
         prior_masks=None, # If provided, it must have as many elements as concepts
+        # If True, all concept generators are evaluated at once through a
+        # single ConceptGeneratorBank rather than n_concepts Sequential models
+        fused_concept_generators=False,
+        # If True, all masked inputs are built in a single tensor and passed
+        # through the features to concepts model in one call
+        batched_concept_scores=False,
+        # If True, train/test steps are compiled with XLA and the supervised
+        # concept loss is computed with static shapes (dense NaN masks)
+        jit_compile_steps=False,
+        # If True, the gate noise of all concepts is drawn at once and
+        # transformed with a single matmul rather than once per concept
+        shared_noise_draw=False,
+        # If True, inputs are expected to be tf.SparseTensors which are masked
+        # and passed through the first layer of the concept generators and
+        # the features to concepts model without ever being densified
+        sparse_inputs=False,
 
         # Evaluation-related arguments
         acc_metric=None,
@@ -192,25 +604,76 @@ class TabCBM(tf.keras.Model):
                 "TabCBM training."
             )
             self.cov_mat = np.eye(input_shape[-1], dtype=np.float32)
-        try:
-            self.L = scipy.linalg.cholesky(self.cov_mat, lower=True).astype(
-                np.float32
-            )
-        except:
-            # Else, if it is not decomposable, assume full independence
-            print(
-                "[WARNING] Assuming independence between features in TabCBM "
-                "training."
-            )
-            self.cov_mat = np.eye(input_shape[-1], dtype=np.float32)
-            self.L = scipy.linalg.cholesky(self.cov_mat, lower=True).astype(
-                np.float32
-            )
+        self.L = None
+        self.cov_factor, self.cov_diag_std = None, None
+        if cov_rank is not None:
+            if (cov_low_rank_factors is None) or (cov_mat is None):
+                cov_low_rank_factors = low_rank_copula_factors(
+                    self.cov_mat,
+                    cov_rank,
+                )
+            # Shape: [n_features, cov_rank] and [n_features]
+            self.cov_factor, self.cov_diag_std = cov_low_rank_factors
+        elif (cov_cholesky is not None) and (cov_mat is not None):
+            # Then the factorization was precomputed (e.g., cached)
+            self.L = np.asarray(cov_cholesky, dtype=np.float32)
+        else:
+            try:
+                self.L = scipy.linalg.cholesky(
+                    self.cov_mat,
+                    lower=True,
+                ).astype(np.float32)
+            except:
+                # Else, if it is not decomposable, assume full independence
+                print(
+                    "[WARNING] Assuming independence between features in "
+                    "TabCBM training."
+                )
+                self.cov_mat = np.eye(input_shape[-1], dtype=np.float32)
+                self.L = scipy.linalg.cholesky(
+                    self.cov_mat,
+                    lower=True,
+                ).astype(np.float32)
         if masking_values is None:
             masking_values = np.zeros(input_shape, dtype=np.float32)
         self.masking_values = masking_values
         given = concept_generators is not None
-        self.concept_generators = concept_generators or []
+        self.fused_concept_generators = fused_concept_generators
+        self.batched_concept_scores = batched_concept_scores
+        self.jit_compile_steps = jit_compile_steps
+        self.shared_noise_draw = shared_noise_draw
+        self.sparse_inputs = sparse_inputs
+        if sparse_inputs and (
+            include_bn or
+            jit_compile_steps or
+            (features_to_embeddings_model is not None) or
+            np.any(np.asarray(masking_values) != 0)
+        ):
+            raise ValueError(
+                "TabCBM's sparse inputs require zero masking values and "
+                "cannot be used together with batch normalization, XLA "
+                "compiled steps, or categorical feature embeddings."
+            )
+        if fused_concept_generators:
+            if not given:
+                concept_generators = ConceptGeneratorBank(
+                    n_concepts=self.n_concepts,
+                    units=concept_generator_units,
+                    latent_dims=self.latent_dims,
+                    include_bn=include_bn,
+                    name="concept_generators",
+                )
+            elif not isinstance(concept_generators, ConceptGeneratorBank):
+                # Then we were given a list of per-concept generators (e.g.,
+                # restored from an older checkpoint) so let's fuse them
+                concept_generators = ConceptGeneratorBank.from_generators(
+                    concept_generators,
+                    include_bn=include_bn,
+                    name="concept_generators",
+                )
+            self.concept_generators = concept_generators
+        else:
+            self.concept_generators = concept_generators or []
         self.rec_values_models = []
         self.rec_mask_models = []
 
@@ -239,7 +702,7 @@ class TabCBM(tf.keras.Model):
             # the masked input to the concept's input latent space. This will
             # then used to produce a score for the input of interest for
             # each concept
-            if not given:
+            if (not given) and (not fused_concept_generators):
                 layers = [
                     tf.keras.layers.Dense(
                         acts,
@@ -253,6 +716,19 @@ class TabCBM(tf.keras.Model):
                         activation=None,
                     ),
                 ]
+                if sparse_inputs:
+                    # Then the first layer takes the sparse masked inputs
+                    # directly
+                    layers[0] = models.SparseDense(
+                        layers[0].units,
+                        activation=layers[0].activation,
+                    )
+                    layers = [
+                        tf.keras.layers.InputLayer(
+                            input_shape=input_shape,
+                            sparse=True,
+                        )
+                    ] + layers
 
                 if include_bn:
                     # Then include a batch normalization layer at the begining
@@ -329,23 +805,97 @@ class TabCBM(tf.keras.Model):
     def metrics(self):
         return [self.metrics_dict[name] for name in self.metric_names]
 
+    def compile(self, *args, **kwargs):
+        if self.jit_compile_steps:
+            kwargs['jit_compile'] = kwargs.get('jit_compile', True)
+        return super().compile(*args, **kwargs)
+
     def update_metrics(self, losses):
         for (loss_name, loss) in losses:
             self.metrics_dict[loss_name].update_state(loss)
 
-    def _multi_bernoulli_sample(self, pi, shape):
+    def concept_generator_variables(self):
+        if self.fused_concept_generators:
+            return self.concept_generators.trainable_variables
+        trainable_vars = []
+        for generator in self.concept_generators:
+            trainable_vars += generator.trainable_variables
+        return trainable_vars
+
+    def generate_concept_vectors(self, masked_xs):
+        # Returns a tensor with shape [n_concepts, B, latent_dims] whose i-th
+        # entry is the output of the i-th concept generator when given the
+        # i-th masked input. The masked inputs may be given as a list of
+        # n_concepts [B, n_features] tensors (dense or sparse) or as a single
+        # [n_concepts, B, n_features] tensor
+        if self.fused_concept_generators:
+            if isinstance(masked_xs, (list, tuple)) and (
+                not self.sparse_inputs
+            ):
+                masked_xs = tf.stack(masked_xs, axis=0)
+            return self.concept_generators(masked_xs)
+        return tf.stack(
+            [
+                self.concept_generators[i](masked_xs[i])
+                for i in range(self.n_concepts)
+            ],
+            axis=0,
+        )
+
+    def _correlated_normal_sample(self, shape):
         # Sample from a standard Gaussian first to perform the
         # reparameterization trick
         epsilon = tf.random.normal(shape, 0, 1)
-        v = tf.transpose(tf.linalg.matmul(self.L, epsilon))
+        if self.L is not None:
+            return tf.transpose(tf.linalg.matmul(self.L, epsilon))
+        # Else we use the low-rank-plus-diagonal factors which only need
+        # O(n_features * cov_rank) operations per sample
+        epsilon_k = tf.random.normal(
+            tf.stack([self.cov_factor.shape[-1], shape[1]], axis=0),
+            0,
+            1,
+        )
+        return tf.transpose(
+            tf.linalg.matmul(self.cov_factor, epsilon_k) +
+            tf.expand_dims(self.cov_diag_std, axis=-1) * epsilon
+        )
+
+    def _correlated_normal_samples(self, batch_size):
+        # Same as _correlated_normal_sample but draws the noise of all
+        # concepts at once so that a single RNG call and a single matmul are
+        # needed for all of them
+        n_features = self.cov_mat.shape[0]
+        # Shape: [B * n_concepts, n_features]
+        v = self._correlated_normal_sample(
+            tf.stack([n_features, batch_size * self.n_concepts], axis=0)
+        )
+        # Shape: [n_concepts, B, n_features]
+        return tf.reshape(v, [self.n_concepts, batch_size, n_features])
+
+    def _multi_bernoulli_samples(self, pis, batch_size):
+        # Samples all concept masks at once for the given selection
+        # probabilities pis with shape [n_concepts, n_features]
+        # Shape: [n_concepts, B, n_features]
+        u = Gaussian_CDF(self._correlated_normal_samples(batch_size))
+        return tf.cast(u <= tf.expand_dims(pis, axis=1), tf.float32)
+
+    def _relaxed_multi_bernoulli_samples(self, pis, batch_size):
+        # Shape: [n_concepts, B, n_features]
+        u = Gaussian_CDF(self._correlated_normal_samples(batch_size))
+        pis = tf.expand_dims(pis, axis=1)
+        return tf.nn.sigmoid(
+            1.0/self.temperature * (
+                log(pis) - log(1. - pis) + log(u) - log(1. - u)
+            )
+        )
+
+    def _multi_bernoulli_sample(self, pi, shape):
+        v = self._correlated_normal_sample(shape)
         u = Gaussian_CDF(v)
         return tf.cast(u <= pi, tf.float32)
 
     def _relaxed_multi_bernoulli_sample(self, pi, shape):
-        # Sample from a standard Gaussian first to perform the
-        # reparameterization trick
-        epsilon = tf.random.normal(shape, 0, 1)
-        v = tf.transpose(tf.linalg.matmul(self.L, epsilon))
+        v = self._correlated_normal_sample(shape)
         u = Gaussian_CDF(v)
         return tf.nn.sigmoid(
             1.0/self.temperature * (
@@ -359,16 +909,28 @@ class TabCBM(tf.keras.Model):
             # Then let's apply our embedding generator as we may have
             # some variables which are categorical in nature
             x = self.features_to_embeddings_model(x)
+        sample_gates = training or (not self.forward_deterministic)
+        if sample_gates and self.shared_noise_draw:
+            # Shape: [n_concepts, B, n_features]
+            gate_vectors = self._relaxed_multi_bernoulli_samples(
+                tf.nn.sigmoid(self.feature_probabilities),
+                batch_size=tf.shape(x)[0],
+            )
         for i in range(self.n_concepts):
-            if training or (not self.forward_deterministic):
+            if sample_gates and self.shared_noise_draw:
+                gate_vector = gate_vectors[i]
+            elif sample_gates:
                 gate_vector = self._relaxed_multi_bernoulli_sample(
                     tf.nn.sigmoid(self.feature_probabilities[i, :]),
-                    shape=tf.stack([tf.shape(self.L)[0], tf.shape(x)[0]], axis=0),
+                    shape=tf.stack([self.cov_mat.shape[0], tf.shape(x)[0]], axis=0),
                 )
             else:
                 # Else we do a deterministic non-differientable unit mask
                 gate_vector = tf.nn.sigmoid(self.feature_probabilities[i, :])
 
+            if self.sparse_inputs:
+                masked_xs.append(mask_sparse_features(x, gate_vector))
+                continue
             # Extend gate vector so that it can be broadcasted across all
             # samples in the batch of x
             masked_xs.append(
@@ -379,19 +941,93 @@ class TabCBM(tf.keras.Model):
             )
         return masked_xs
 
-    def compute_concept_matrix(self, x, training=False):
-        masked_xs = self.mask_features(x, training=training)
-        concept_vectors = []
-        for concept_generator, masked_x in zip(
-            self.concept_generators,
-            masked_xs,
+    def batched_mask_features(self, x, training=False):
+        # Same as mask_features but all masked copies of x are produced at
+        # once in a tensor with shape [n_concepts, B, n_features] (or in a
+        # list of n_concepts sparse [B, n_features] tensors if our inputs are
+        # sparse)
+        if self.features_to_embeddings_model is not None:
+            # Then let's apply our embedding generator as we may have
+            # some variables which are categorical in nature
+            x = self.features_to_embeddings_model(x)
+        if (training or (not self.forward_deterministic)) and (
+            self.shared_noise_draw
         ):
-            # This will be a sample of size [B, latent_dims]
-            concept_vectors.append(concept_generator(masked_x))
+            # Shape: [n_concepts, B, n_features]
+            gate_vectors = self._relaxed_multi_bernoulli_samples(
+                tf.nn.sigmoid(self.feature_probabilities),
+                batch_size=tf.shape(x)[0],
+            )
+        elif training or (not self.forward_deterministic):
+            # Shape: [n_concepts, B, n_features]
+            gate_vectors = tf.stack(
+                [
+                    self._relaxed_multi_bernoulli_sample(
+                        tf.nn.sigmoid(self.feature_probabilities[i, :]),
+                        shape=tf.stack(
+                            [self.cov_mat.shape[0], tf.shape(x)[0]],
+                            axis=0,
+                        ),
+                    )
+                    for i in range(self.n_concepts)
+                ],
+                axis=0,
+            )
+        else:
+            # Else we do a deterministic non-differientable unit mask
+            # Shape: [n_concepts, 1, n_features]
+            gate_vectors = tf.expand_dims(
+                tf.nn.sigmoid(self.feature_probabilities),
+                axis=1,
+            )
+            if self.sparse_inputs:
+                gate_vectors = gate_vectors[:, 0, :]
+        if self.sparse_inputs:
+            return [
+                mask_sparse_features(x, gate_vectors[i])
+                for i in range(self.n_concepts)
+            ]
+        return gate_vectors * tf.expand_dims(x, axis=0) + (
+            (1 - gate_vectors) * tf.expand_dims(self.masking_values, axis=0)
+        )
+
+    def _batched_concept_similarities(self, concept_matrix_norm, masked_xs):
+        # Runs the features to concepts model once over all masked inputs
+        # and computes both the raw and normalized similarity scores with
+        # a single contraction. Returns two tensors with shape [B, n_concepts]
+        if self.sparse_inputs:
+            # Stacking along the batch dimension keeps the same concept-major
+            # order as reshaping the dense masked inputs
+            flat_xs = tf.sparse.concat(axis=0, sp_inputs=list(masked_xs))
+        else:
+            flat_xs = tf.reshape(masked_xs, [-1, masked_xs.shape[-1]])
+        # Shape: [n_concepts * B, latent_dims]
+        latent = self.features_to_concepts_model(flat_xs)
+        # Shape: [B, n_concepts, latent_dims]
+        latent = tf.transpose(
+            tf.reshape(latent, [self.n_concepts, -1, latent.shape[-1]]),
+            perm=[1, 0, 2],
+        )
+        latent_norm = tf.math.l2_normalize(latent, axis=-1)
+        # Shape: [B, n_concepts, 2]
+        scores = tf.einsum(
+            'bnl,bnkl->bnk',
+            concept_matrix_norm,
+            tf.stack([latent, latent_norm], axis=2),
+        )
+        return scores[:, :, 0], scores[:, :, 1]
+
+    def compute_concept_matrix(self, x, training=False):
+        if self.batched_concept_scores:
+            masked_xs = self.batched_mask_features(x, training=training)
+        else:
+            masked_xs = self.mask_features(x, training=training)
+        # Shape: [n_concepts, B, latent_dims]
+        concept_vectors = self.generate_concept_vectors(masked_xs)
 
-        # We need to stack them all in the first dimension so that
-        # we obtain a variable with size [B, n_concepts, latent_dims]
-        return tf.stack(concept_vectors, axis=1), masked_xs
+        # We need to move the concept dimension after the batch dimension so
+        # that we obtain a variable with size [B, n_concepts, latent_dims]
+        return tf.transpose(concept_vectors, perm=[1, 0, 2]), masked_xs
 
     def _emb_concept_scores(self, x, compute_reg_terms=False, training=False):
         # First we compute the concept matrix
@@ -406,6 +1042,71 @@ class TabCBM(tf.keras.Model):
         # Then for each concept, we have a corresponding masked inputs which we
         # will pass through the feature to concepts model (which cannot be
         # trained)
+        if self.batched_concept_scores:
+            # Shape: [B, n_concepts] (both)
+            concept_prob, concept_prob_norm = \
+                self._batched_concept_similarities(
+                    concept_matrix_norm,
+                    masked_xs,
+                )
+            concept_prob = tf.sigmoid(concept_prob)
+            concept_prob_norm = tf.sigmoid(concept_prob_norm)
+            # Shape: [B, n_concepts, 1]
+            broad_prob = tf.expand_dims(concept_prob, axis=-1)
+            # Add in the bottleneck the linear combination of the two semantic
+            # embeddings
+            # Shape: [B, n_concepts, latent_dims//2]
+            bottleneck = (
+                broad_prob * concept_matrix_norm[:, :, concept_matrix_norm.shape[-1]//2:] +
+                (1 - broad_prob) * concept_matrix_norm[:, :, :concept_matrix_norm.shape[-1]//2]
+            )
+        else:
+            concept_prob, bottleneck, concept_prob_norm = \
+                self._looped_emb_concept_scores(
+                    concept_matrix_norm,
+                    masked_xs,
+                )
+        # Shape: [B, n_concepts * (latent_dim//2)]
+        bottleneck = tf.reshape(bottleneck, [tf.shape(bottleneck)[0], -1])
+
+        if not compute_reg_terms:
+            return concept_prob, bottleneck
+
+        # Compute the regularization loss terms
+        # Shape: [n_concepts, B]
+        reshaped_concept_probs = tf.transpose(concept_prob_norm)
+        completement_shape = tf.math.maximum(
+            tf.shape(reshaped_concept_probs)[-1] - self.top_k,
+            0,
+        )
+
+        reg_loss_closest = tf.reduce_mean(
+            tf.nn.top_k(
+                reshaped_concept_probs,
+                k=tf.math.minimum(
+                    self.top_k,
+                    tf.shape(reshaped_concept_probs)[-1]
+                ),
+                sorted=True,
+            ).values
+        )
+        reg_loss_similarity = tf.reduce_mean(
+            tf.math.abs(
+                tf.linalg.matmul(
+                    concept_matrix_norm,
+                    tf.transpose(concept_matrix_norm, perm=[0, 2, 1]),
+                ) - tf.expand_dims(tf.eye(self.n_concepts), axis=0)
+            )
+        )
+
+        return (
+            concept_prob,
+            bottleneck,
+            reg_loss_closest/self.n_concepts,
+            reg_loss_similarity/self.n_concepts,
+        )
+
+    def _looped_emb_concept_scores(self, concept_matrix_norm, masked_xs):
         concept_probs = []
         bottleneck_acts = []
         concept_prob_norms = []
@@ -452,13 +1153,46 @@ class TabCBM(tf.keras.Model):
         concept_prob = tf.concat(concept_probs, axis=1)
         # Shape: [B, n_concepts, latent_dim//2]
         bottleneck = tf.concat(bottleneck_acts, axis=1)
-        # Shape: [B, n_concepts * (latent_dim//2)]
-        bottleneck = tf.reshape(bottleneck, [tf.shape(bottleneck)[0], -1])
         # Shape: [B, n_concepts]
         concept_prob_norm = tf.concat(concept_prob_norms, axis=1)
+        return concept_prob, bottleneck, concept_prob_norm
+
+    def _concept_scores(self, x, compute_reg_terms=False, training=False):
+        # First we compute the concept matrix
+        # Shape: [B, n_concepts, latent_dims]
+        concept_matrix, masked_xs = self.compute_concept_matrix(
+            x,
+            training=training,
+        )
+        # Shape: [B, n_concepts, latent_dims]
+        concept_matrix_norm = tf.math.l2_normalize(concept_matrix, axis=1)
+
+        # Then for each concept, we have a corresponding masked inputs which we
+        # will pass through the feature to concepts model (which cannot be
+        # trained)
+        if self.batched_concept_scores:
+            # Shape: [B, n_concepts] (both)
+            concept_prob, concept_prob_norm = \
+                self._batched_concept_similarities(
+                    concept_matrix_norm,
+                    masked_xs,
+                )
+        else:
+            concept_prob, concept_prob_norm = self._looped_concept_scores(
+                concept_matrix_norm,
+                masked_xs,
+            )
+        # Threshold them if they are below the given threshold value
+        if self.normalized_scores:
+            concept_prob = tf.sigmoid(concept_prob)
+        elif self.threshold is not None:
+            concept_prob = concept_prob * tf.cast(
+                (concept_prob_norm > self.threshold),
+                tf.float32,
+            )
 
         if not compute_reg_terms:
-            return concept_prob, bottleneck
+            return concept_prob, concept_prob
 
         # Compute the regularization loss terms
         # Shape: [n_concepts, B]
@@ -489,24 +1223,12 @@ class TabCBM(tf.keras.Model):
 
         return (
             concept_prob,
-            bottleneck,
+            concept_prob, # Bottleneck
             reg_loss_closest/self.n_concepts,
             reg_loss_similarity/self.n_concepts,
         )
 
-    def _concept_scores(self, x, compute_reg_terms=False, training=False):
-        # First we compute the concept matrix
-        # Shape: [B, n_concepts, latent_dims]
-        concept_matrix, masked_xs = self.compute_concept_matrix(
-            x,
-            training=training,
-        )
-        # Shape: [B, n_concepts, latent_dims]
-        concept_matrix_norm = tf.math.l2_normalize(concept_matrix, axis=1)
-
-        # Then for each concept, we have a corresponding masked inputs which we
-        # will pass through the feature to concepts model (which cannot be
-        # trained)
+    def _looped_concept_scores(self, concept_matrix_norm, masked_xs):
         concept_probs = []
         concept_prob_norms = []
 
@@ -543,51 +1265,7 @@ class TabCBM(tf.keras.Model):
         concept_prob = tf.concat(concept_probs, axis=1)
         # Shape: [B, n_concepts]
         concept_prob_norm = tf.concat(concept_prob_norms, axis=1)
-        # Threshold them if they are below the given threshold value
-        if self.normalized_scores:
-            concept_prob = tf.sigmoid(concept_prob)
-        elif self.threshold is not None:
-            concept_prob = concept_prob * tf.cast(
-                (concept_prob_norm > self.threshold),
-                tf.float32,
-            )
-
-        if not compute_reg_terms:
-            return concept_prob, concept_prob
-
-        # Compute the regularization loss terms
-        # Shape: [n_concepts, B]
-        reshaped_concept_probs = tf.transpose(concept_prob_norm)
-        completement_shape = tf.math.maximum(
-            tf.shape(reshaped_concept_probs)[-1] - self.top_k,
-            0,
-        )
-
-        reg_loss_closest = tf.reduce_mean(
-            tf.nn.top_k(
-                reshaped_concept_probs,
-                k=tf.math.minimum(
-                    self.top_k,
-                    tf.shape(reshaped_concept_probs)[-1]
-                ),
-                sorted=True,
-            ).values
-        )
-        reg_loss_similarity = tf.reduce_mean(
-            tf.math.abs(
-                tf.linalg.matmul(
-                    concept_matrix_norm,
-                    tf.transpose(concept_matrix_norm, perm=[0, 2, 1]),
-                ) - tf.expand_dims(tf.eye(self.n_concepts), axis=0)
-            )
-        )
-
-        return (
-            concept_prob,
-            concept_prob, # Bottleneck
-            reg_loss_closest/self.n_concepts,
-            reg_loss_similarity/self.n_concepts,
-        )
+        return concept_prob, concept_prob_norm
 
     def concept_scores(self, x, compute_reg_terms=False, training=False):
         return self._concept_scores(
@@ -605,22 +1283,47 @@ class TabCBM(tf.keras.Model):
             # Then let's apply our embedding generator as we may have
             # some variables which are categorical in nature
             x = self.features_to_embeddings_model(x)
-        for i in range(self.n_concepts):
-            mask = self._multi_bernoulli_sample(
-                self.self_supervised_selection_prob[i, :],
-                shape=tf.stack([tf.shape(self.L)[0], tf.shape(x)[0]], axis=0),
+        masks = []
+        masked_xs = []
+        if self.shared_noise_draw:
+            # Shape: [n_concepts, B, n_features]
+            all_masks = self._multi_bernoulli_samples(
+                self.self_supervised_selection_prob,
+                batch_size=tf.shape(x)[0],
             )
+        for i in range(self.n_concepts):
+            if self.shared_noise_draw:
+                mask = all_masks[i]
+            else:
+                mask = self._multi_bernoulli_sample(
+                    self.self_supervised_selection_prob[i, :],
+                    shape=tf.stack(
+                        [self.cov_mat.shape[0], tf.shape(x)[0]],
+                        axis=0,
+                    ),
+                )
+            masks.append(mask)
+            if self.sparse_inputs:
+                masked_xs.append(mask_sparse_features(x, mask))
+                continue
             # Extend gate vector so that it can be broadcasted across all
             # samples in the batch of x
-            masked_x = (
+            masked_xs.append(
                 mask * x + (1 - mask) * tf.expand_dims(
                     self.masking_values,
                     axis=0,
                 )
             )
 
-            # Now let's generate the concept vector for this concept
-            concept_vector = self.concept_generators[i](masked_x)
+        # Now let's generate the concept vectors for all concepts
+        # Shape: [n_concepts, B, latent_dims]
+        concept_vectors = self.generate_concept_vectors(masked_xs)
+        if self.sparse_inputs:
+            # Only this batch is densified as the target of the feature
+            # reconstruction models
+            x = tf.sparse.to_dense(x)
+        for i, mask in enumerate(masks):
+            concept_vector = concept_vectors[i]
 
             # Try and predict the original mask from this concept vector
             mask_pred = self.rec_mask_models[i](concept_vector)
@@ -703,36 +1406,12 @@ class TabCBM(tf.keras.Model):
                 "Expected concepts to be provided during training if the "
                 "concept prediction weight is non-zero!"
             )
-            concept_pred_loss = 0
-            seen_concepts = 0
-            for aligned_idx, concept_idx in enumerate(range(c_true.shape[-1])):
-                selected_samples = tf.math.logical_not(
-                    tf.math.is_nan(c_true[:, concept_idx])
-                )
-                seen_concepts += 1
-                concept_pred_loss += tf.cond(
-                    tf.math.reduce_any(selected_samples),
-                    lambda: tf.keras.metrics.binary_crossentropy(
-                        tf.cast(
-                            tf.boolean_mask(
-                                c_true[:, concept_idx],
-                                selected_samples,
-                                axis=0,
-                            ),
-                            tf.float32,
-                        ),
-                        tf.cast(
-                            tf.boolean_mask(
-                                scores[:, aligned_idx],
-                                selected_samples,
-                                axis=0,
-                            ),
-                            tf.float32,
-                        ),
-                    ),
-                    lambda: 0.0,
-                )
-            concept_pred_loss = concept_pred_loss / (seen_concepts + 1e-15)
+            if self.jit_compile_steps:
+                concept_pred_loss, concept_acc = \
+                    self._dense_concept_supervision_terms(c_true, scores)
+            else:
+                concept_pred_loss, concept_acc = \
+                    self._masked_concept_supervision_terms(c_true, scores)
         else:
             concept_pred_loss = 0
 
@@ -756,37 +1435,6 @@ class TabCBM(tf.keras.Model):
             ("accuracy", task_acc),
         ]
         if self.n_supervised_concepts != 0:
-            avg_concept_acc = 0
-            seen_concepts = 0
-            for aligned_idx, concept_idx in enumerate(range(c_true.shape[-1])):
-                selected_samples = tf.math.logical_not(
-                    tf.math.is_nan(c_true[:, concept_idx])
-                )
-                seen_concepts += 1
-                avg_concept_acc += tf.cond(
-                    tf.math.reduce_any(selected_samples),
-                    lambda: tf.keras.metrics.binary_accuracy(
-                        tf.cast(
-                            tf.boolean_mask(
-                                c_true[:, concept_idx],
-                                selected_samples,
-                                axis=0,
-                            ),
-                            tf.float32
-                        ),
-                        tf.cast(
-                            tf.boolean_mask(
-                                scores[:, aligned_idx],
-                                selected_samples,
-                                axis=0,
-                            ),
-                            tf.float32
-                        ),
-                    ),
-                    lambda: 0.0,
-                )
-
-            concept_acc = avg_concept_acc/(seen_concepts + 1e-15)
             total_metrics += [
                 ("concept_pred_loss", concept_pred_loss),
                 ("avg_concept_accuracy", concept_acc),
@@ -815,6 +1463,119 @@ class TabCBM(tf.keras.Model):
 
         return total_loss, total_metrics
 
+    def _masked_concept_supervision_terms(self, c_true, scores):
+        # Computes the average concept prediction loss and accuracy over all
+        # supervised concepts ignoring samples whose concept label is NaN
+        concept_pred_loss = 0
+        seen_concepts = 0
+        for aligned_idx, concept_idx in enumerate(range(c_true.shape[-1])):
+            selected_samples = tf.math.logical_not(
+                tf.math.is_nan(c_true[:, concept_idx])
+            )
+            seen_concepts += 1
+            concept_pred_loss += tf.cond(
+                tf.math.reduce_any(selected_samples),
+                lambda: tf.keras.metrics.binary_crossentropy(
+                    tf.cast(
+                        tf.boolean_mask(
+                            c_true[:, concept_idx],
+                            selected_samples,
+                            axis=0,
+                        ),
+                        tf.float32,
+                    ),
+                    tf.cast(
+                        tf.boolean_mask(
+                            scores[:, aligned_idx],
+                            selected_samples,
+                            axis=0,
+                        ),
+                        tf.float32,
+                    ),
+                ),
+                lambda: 0.0,
+            )
+        concept_pred_loss = concept_pred_loss / (seen_concepts + 1e-15)
+
+        avg_concept_acc = 0
+        seen_concepts = 0
+        for aligned_idx, concept_idx in enumerate(range(c_true.shape[-1])):
+            selected_samples = tf.math.logical_not(
+                tf.math.is_nan(c_true[:, concept_idx])
+            )
+            seen_concepts += 1
+            avg_concept_acc += tf.cond(
+                tf.math.reduce_any(selected_samples),
+                lambda: tf.keras.metrics.binary_accuracy(
+                    tf.cast(
+                        tf.boolean_mask(
+                            c_true[:, concept_idx],
+                            selected_samples,
+                            axis=0,
+                        ),
+                        tf.float32
+                    ),
+                    tf.cast(
+                        tf.boolean_mask(
+                            scores[:, aligned_idx],
+                            selected_samples,
+                            axis=0,
+                        ),
+                        tf.float32
+                    ),
+                ),
+                lambda: 0.0,
+            )
+
+        concept_acc = avg_concept_acc/(seen_concepts + 1e-15)
+        return concept_pred_loss, concept_acc
+
+    def _dense_concept_supervision_terms(self, c_true, scores):
+        # Same as _masked_concept_supervision_terms but NaN labels are
+        # handled with a dense multiplicative mask rather than with
+        # tf.boolean_mask/tf.cond so that all shapes remain static (which is
+        # required when compiling the training step with XLA)
+        n_supervised = c_true.shape[-1]
+        # Shape: [B, n_supervised_concepts]
+        c_true = tf.cast(c_true, tf.float32)
+        selected_samples = tf.cast(
+            tf.math.logical_not(tf.math.is_nan(c_true)),
+            tf.float32,
+        )
+        c_true = tf.where(
+            selected_samples > 0,
+            c_true,
+            tf.zeros_like(c_true),
+        )
+        # Shape: [B, n_supervised_concepts]
+        c_pred = tf.cast(scores[:, :n_supervised], tf.float32)
+        # Shape: [n_supervised_concepts]
+        n_selected = tf.math.reduce_sum(selected_samples, axis=0)
+        denominator = tf.math.maximum(n_selected, 1)
+
+        # Shape: [n_supervised_concepts]
+        concept_losses = tf.math.reduce_sum(
+            selected_samples * tf.keras.backend.binary_crossentropy(
+                c_true,
+                c_pred,
+            ),
+            axis=0,
+        ) / denominator
+        concept_accs = tf.math.reduce_sum(
+            selected_samples * tf.cast(
+                tf.math.equal(c_true, tf.cast(c_pred > 0.5, tf.float32)),
+                tf.float32,
+            ),
+            axis=0,
+        ) / denominator
+        concept_pred_loss = tf.math.reduce_sum(concept_losses) / (
+            n_supervised + 1e-15
+        )
+        concept_acc = tf.math.reduce_sum(concept_accs) / (
+            n_supervised + 1e-15
+        )
+        return concept_pred_loss, concept_acc
+
     def train_step(self, inputs):
         if self.n_supervised_concepts != 0:
             # Then we expect some sort of concept supervision!
@@ -830,9 +1591,8 @@ class TabCBM(tf.keras.Model):
         with tf.GradientTape() as tape:
             if self.self_supervise_mode:
                 loss, metrics = self._compute_self_supervised_loss(x)
-                trainable_vars = []
-                for i, generator in enumerate(self.concept_generators):
-                    trainable_vars += generator.trainable_variables
+                trainable_vars = self.concept_generator_variables()
+                for i in range(self.n_concepts):
                     trainable_vars += \
                         self.rec_mask_models[i].trainable_variables
                     trainable_vars += \
@@ -859,8 +1619,7 @@ class TabCBM(tf.keras.Model):
                         if self.end_to_end_training else []
                     ) + embedding_vars
                 )
-                for generator in self.concept_generators:
-                    trainable_vars += generator.trainable_variables
+                trainable_vars += self.concept_generator_variables()
 
         gradients = tape.gradient(loss, trainable_vars)
         self.optimizer.apply_gradients(
@@ -0,0 +1,231 @@
+import logging
+import numpy as np
+import scipy.sparse
+import tensorflow as tf
+
+############################################
+## Input Pipelines
+############################################
+
+def holdout_split(n_samples, holdout_fraction):
+    """
+    Returns the indices of the training and holdout samples for a dataset
+    with n_samples. As in Keras' `validation_split`, the holdout set is made
+    of the last `holdout_fraction` samples (before any shuffling).
+    """
+    split_at = int(n_samples * (1 - holdout_fraction))
+    return np.arange(split_at), np.arange(split_at, n_samples)
+
+
+def to_model_inputs(x):
+    """
+    Converts a scipy sparse matrix into a tf.SparseTensor so that it can be
+    fed directly to our models. Any other input is returned unchanged.
+    """
+    if not scipy.sparse.issparse(x):
+        return x
+    x = x.tocoo()
+    return tf.sparse.reorder(tf.SparseTensor(
+        indices=np.stack([x.row, x.col], axis=-1).astype(np.int64),
+        values=x.data,
+        dense_shape=x.shape,
+    ))
+
+
+def _batch_loader(arrays):
+    # Returns a function mapping a batch of sample indices into a dictionary
+    # with the corresponding rows of all the given arrays. Rows of scipy
+    # sparse matrices are sliced from their CSR representation and returned
+    # as tf.SparseTensors so that they are never densified
+    arrays = {
+        name: (array.tocsr() if scipy.sparse.issparse(array) else array)
+        for (name, array) in arrays.items()
+    }
+    names = list(arrays.keys())
+    out_types = []
+    for name in names:
+        if scipy.sparse.issparse(arrays[name]):
+            out_types += [tf.int64, tf.as_dtype(arrays[name].dtype)]
+        else:
+            out_types.append(tf.as_dtype(arrays[name].dtype))
+
+    def _load_rows(idxs):
+        outputs = []
+        for name in names:
+            rows = arrays[name][idxs]
+            if scipy.sparse.issparse(rows):
+                rows = rows.tocoo()
+                outputs += [
+                    np.stack([rows.row, rows.col], axis=-1).astype(np.int64),
+                    rows.data,
+                ]
+            else:
+                outputs.append(rows)
+        return outputs
+
+    def _load_fn(idxs):
+        flat_outputs = tf.numpy_function(_load_rows, [idxs], out_types)
+        batch_size = tf.cast(tf.shape(idxs)[0], tf.int64)
+        values = {}
+        for name in names:
+            array = arrays[name]
+            if scipy.sparse.issparse(array):
+                indices, data = flat_outputs[0], flat_outputs[1]
+                flat_outputs = flat_outputs[2:]
+                indices.set_shape([None, 2])
+                data.set_shape([None])
+                # Keeping the number of features static lets Keras check
+                # this batch against the model's sparse input
+                values[name] = tf.SparseTensor(
+                    indices=indices,
+                    values=data,
+                    dense_shape=tf.stack(
+                        [batch_size, tf.constant(array.shape[1], tf.int64)],
+                        axis=0,
+                    ),
+                )
+            else:
+                rows = flat_outputs[0]
+                flat_outputs = flat_outputs[1:]
+                rows.set_shape([None] + list(array.shape[1:]))
+                values[name] = rows
+        return values
+
+    return _load_fn
+
+
+class TrialDatasets(object):
+    """
+    Input pipeline shared by all training stages of a single trial.
+
+    All the given arrays (e.g., x=x_train, y=y_train, c=c_train) are split
+    once into a training and a holdout set and wrapped into cached and
+    prefetched tf.data.Datasets of dictionaries. Each stage then selects the
+    arrays it needs as its inputs/targets through `fit_kwargs`, which returns
+    the arguments to be passed to `model.fit`.
+
+    If `use_tf_data` is not set in the experiment config, `fit_kwargs`
+    returns the raw numpy arrays together with `batch_size` and
+    `validation_split` instead, so that training proceeds exactly as if
+    `model.fit` had been called with the arrays directly.
+
+    If any of the arrays is a scipy sparse matrix, a tf.data pipeline is
+    always used. It shuffles and batches sample indices and slices each batch
+    from the CSR matrix as a tf.SparseTensor, so that the full matrix is never
+    densified.
+    """
+
+    def __init__(self, experiment_config, seed=0, **arrays):
+        self.arrays = {
+            name: array for (name, array) in arrays.items()
+            if array is not None
+        }
+        self.batch_size = experiment_config["batch_size"]
+        self.holdout_fraction = experiment_config["holdout_fraction"]
+        self.sparse = any(
+            scipy.sparse.issparse(array) for array in self.arrays.values()
+        )
+        # Keras cannot split nor batch scipy sparse matrices on its own
+        self.use_tf_data = (
+            experiment_config.get("use_tf_data", False) or self.sparse
+        )
+        self.train_ds = None
+        self.val_ds = None
+        if not self.use_tf_data:
+            return
+
+        n_samples = next(iter(self.arrays.values())).shape[0]
+        train_idxs, val_idxs = holdout_split(n_samples, self.holdout_fraction)
+        shuffle_buffer_size = experiment_config.get(
+            "shuffle_buffer_size",
+            len(train_idxs),
+        )
+        logging.debug(
+            f"\tBuilding tf.data pipeline with {len(train_idxs)} training and "
+            f"{len(val_idxs)} holdout samples (shuffle buffer size of "
+            f"{shuffle_buffer_size})"
+        )
+        if self.sparse:
+            load_fn = _batch_loader(self.arrays)
+            self.train_ds = tf.data.Dataset.from_tensor_slices(
+                train_idxs
+            ).shuffle(
+                buffer_size=max(shuffle_buffer_size, 1),
+                seed=seed,
+                reshuffle_each_iteration=True,
+            ).batch(
+                self.batch_size,
+            ).map(
+                load_fn,
+                num_parallel_calls=tf.data.AUTOTUNE,
+            ).prefetch(tf.data.AUTOTUNE)
+            if len(val_idxs):
+                self.val_ds = tf.data.Dataset.from_tensor_slices(
+                    val_idxs
+                ).batch(
+                    self.batch_size,
+                ).map(
+                    load_fn,
+                    num_parallel_calls=tf.data.AUTOTUNE,
+                ).prefetch(tf.data.AUTOTUNE)
+            return
+        self.train_ds = tf.data.Dataset.from_tensor_slices({
+            name: array[train_idxs] for (name, array) in self.arrays.items()
+        }).cache().shuffle(
+            buffer_size=max(shuffle_buffer_size, 1),
+            seed=seed,
+            reshuffle_each_iteration=True,
+        ).batch(
+            self.batch_size,
+        ).prefetch(tf.data.AUTOTUNE)
+        if len(val_idxs):
+            self.val_ds = tf.data.Dataset.from_tensor_slices({
+                name: array[val_idxs] for (name, array) in self.arrays.items()
+            }).batch(
+                self.batch_size,
+            ).cache().prefetch(tf.data.AUTOTUNE)
+
+    def _select(self, values, keys):
+        if keys is None:
+            return None
+        if isinstance(keys, (list, tuple)):
+            return tuple(values[key] for key in keys)
+        return values[keys]
+
+    def fit_kwargs(self, x="x", y="y"):
+        """
+        Returns the keyword arguments to be passed to `model.fit` so that the
+        model is trained with the array(s) named x as its inputs and the
+        array(s) named y as its targets. Both x and y can be either a single
+        name or a tuple of names (for models with multiple inputs/targets).
+        y can also be None for models trained only from their inputs.
+        """
+        if not self.use_tf_data:
+            kwargs = dict(
+                x=self._select(self.arrays, x),
+                batch_size=self.batch_size,
+                validation_split=self.holdout_fraction,
+            )
+            if y is not None:
+                kwargs['y'] = self._select(self.arrays, y)
+            return kwargs
+
+        if y is None:
+            select_fn = lambda values: self._select(values, x)
+        else:
+            select_fn = lambda values: (
+                self._select(values, x),
+                self._select(values, y),
+            )
+        kwargs = dict(
+            x=self.train_ds.map(
+                select_fn,
+                num_parallel_calls=tf.data.AUTOTUNE,
+            ),
+        )
+        if self.val_ds is not None:
+            kwargs['validation_data'] = self.val_ds.map(
+                select_fn,
+                num_parallel_calls=tf.data.AUTOTUNE,
+            )
+        return kwargs
@@ -0,0 +1,202 @@
+import numpy as np
+import scipy.special
+
+import tabcbm.training.utils as utils
+
+############################################
+## Concept Interventions
+############################################
+
+def intervention_anchors(
+    train_concept_scores,
+    c_train,
+    learnt_concept_idxs,
+    real_concept_idxs,
+):
+    """
+    Computes, for every learnt concept in learnt_concept_idxs, the score we
+    will use when intervening on it to signal that its aligned ground truth
+    concept (given in real_concept_idxs) is active/inactive.
+
+    We need to figure out the "direction" of the intervention:
+        There is not reason why a learnt concept aligned such that its
+        corresponding ground truth concept is high when the learnt concept
+        is high. Because they are binary, it could perfectly be the case
+        that the alignment happend with the complement.
+
+    Returns a tuple (pos_scores, neg_scores, positive_alignment), each with
+    one entry per learnt concept.
+    """
+    learnt_concept_idxs = np.array(learnt_concept_idxs, dtype=np.int64)
+    # Shape: [2, n_selected_concepts]
+    pos_scores, neg_scores = np.percentile(
+        train_concept_scores[:, learnt_concept_idxs],
+        [95, 5],
+        axis=0,
+    )
+    positive_alignment = np.array([
+        np.corrcoef(
+            train_concept_scores[:, learnt_concept_idx],
+            c_train[:, real_concept_idx],
+        )[0, 1] > 0
+        for learnt_concept_idx, real_concept_idx in zip(
+            learnt_concept_idxs,
+            real_concept_idxs,
+        )
+    ], dtype=bool)
+    return pos_scores, neg_scores, positive_alignment
+
+def intervention_accuracies(
+    model,
+    test_bottleneck,
+    y_test,
+    c_test,
+    train_concept_scores,
+    c_train,
+    learnt_concept_idxs,
+    real_concept_idxs,
+    max_intervened_concepts=None,
+    trials=5,
+    max_batch_rows=2**20,
+):
+    """
+    Computes the task accuracy of model after intervening on 1, 2, ...,
+    max_intervened_concepts randomly selected concepts out of
+    learnt_concept_idxs (averaged over `trials` random selections each).
+
+    The intervention anchors are computed once and all intervened
+    bottlenecks are stacked together so that model.from_bottleneck is called
+    on batches of up to max_batch_rows samples rather than once per
+    (number of concepts, trial) pair. Random concept selections are drawn in
+    the same order as if each pair was evaluated one after the other.
+
+    Returns a dictionary mapping each number of intervened concepts to its
+    mean accuracy.
+    """
+    learnt_concept_idxs = np.array(learnt_concept_idxs, dtype=np.int64)
+    real_concept_idxs = np.array(real_concept_idxs, dtype=np.int64)
+    n_selectable = len(learnt_concept_idxs)
+    if max_intervened_concepts is None:
+        max_intervened_concepts = n_selectable
+    if (max_intervened_concepts < 1) or (n_selectable == 0):
+        return {}
+    test_bottleneck = np.asarray(test_bottleneck)
+    pos_scores, neg_scores, positive_alignment = intervention_anchors(
+        train_concept_scores=train_concept_scores,
+        c_train=c_train,
+        learnt_concept_idxs=learnt_concept_idxs,
+        real_concept_idxs=real_concept_idxs,
+    )
+
+    # Bottleneck where every selectable concept has been intervened on
+    # Shape: [B, n_bottleneck]
+    c_real = c_test[:, real_concept_idxs]
+    active = np.where(positive_alignment[None, :], c_real, 1 - c_real)
+    full_intervention = test_bottleneck.copy()
+    full_intervention[:, learnt_concept_idxs] = (
+        active * pos_scores[None, :] + (1 - active) * neg_scores[None, :]
+    )
+
+    # Which bottleneck dimensions are intervened on in each of our
+    # (number of concepts, trial) pairs
+    # Shape: [max_intervened_concepts * trials, n_bottleneck]
+    intervention_masks = np.zeros(
+        (max_intervened_concepts * trials, test_bottleneck.shape[-1]),
+        dtype=bool,
+    )
+    for num_intervened_concepts in range(1, max_intervened_concepts + 1):
+        for i in range(trials):
+            current_sel = np.random.permutation(
+                list(range(n_selectable))
+            )[:num_intervened_concepts]
+            intervention_masks[
+                (num_intervened_concepts - 1) * trials + i,
+                learnt_concept_idxs[current_sel],
+            ] = True
+
+    # Now evaluate all interventions in as few calls as possible
+    n_samples = test_bottleneck.shape[0]
+    interventions_per_batch = max(max_batch_rows // max(n_samples, 1), 1)
+    accuracies = np.zeros((intervention_masks.shape[0],))
+    for start in range(0, intervention_masks.shape[0], interventions_per_batch):
+        masks = intervention_masks[start:start + interventions_per_batch]
+        # Shape: [n_interventions * B, n_bottleneck]
+        new_test_bottleneck = np.where(
+            masks[:, None, :],
+            full_intervention[None, :, :],
+            test_bottleneck[None, :, :],
+        ).reshape((-1, test_bottleneck.shape[-1]))
+        preds = np.argmax(
+            scipy.special.softmax(
+                model.from_bottleneck(new_test_bottleneck),
+                axis=-1,
+            ),
+            axis=-1,
+        ).reshape((masks.shape[0], n_samples))
+        accuracies[start:start + masks.shape[0]] = np.mean(
+            preds == np.reshape(y_test, (1, -1)),
+            axis=-1,
+        )
+    accuracies = np.reshape(accuracies, (max_intervened_concepts, trials))
+    return {
+        num_intervened_concepts: np.mean(
+            accuracies[num_intervened_concepts - 1]
+        )
+        for num_intervened_concepts in range(1, max_intervened_concepts + 1)
+    }
+
+def intervention_sweep(
+    model,
+    test_bottleneck,
+    y_test,
+    c_test,
+    train_concept_scores,
+    c_train,
+    learnt_concept_idxs,
+    real_concept_idxs,
+    key_prefix,
+    key_suffix="",
+    old_results=None,
+    load_from_cache=False,
+    trials=5,
+    max_batch_rows=2**20,
+):
+    """
+    Computes the task accuracy of model after intervening on 1, 2, ...,
+    len(learnt_concept_idxs) of the given learnt concepts (see
+    intervention_accuracies) and returns a dictionary mapping each result
+    key f"{key_prefix}{num_intervened_concepts}{key_suffix}" to its
+    accuracy.
+
+    Results found in old_results are loaded following the semantics of
+    `utils.posible_load`. All other interventions of this sweep are
+    evaluated together the first time any of their results is needed.
+    """
+    sweep_results = {}
+
+    def _run_sweep():
+        if not sweep_results:
+            sweep_results.update(intervention_accuracies(
+                model=model,
+                test_bottleneck=test_bottleneck,
+                y_test=y_test,
+                c_test=c_test,
+                train_concept_scores=train_concept_scores,
+                c_train=c_train,
+                learnt_concept_idxs=learnt_concept_idxs,
+                real_concept_idxs=real_concept_idxs,
+                trials=trials,
+                max_batch_rows=max_batch_rows,
+            ))
+        return sweep_results
+
+    results = {}
+    for num_intervened_concepts in range(1, len(learnt_concept_idxs) + 1):
+        key = f"{key_prefix}{num_intervened_concepts}{key_suffix}"
+        results[key] = utils.posible_load(
+            key=key,
+            old_results=old_results,
+            load_from_cache=load_from_cache,
+            run_fn=lambda: _run_sweep()[num_intervened_concepts],
+        )
+    return results
@@ -0,0 +1,158 @@
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import numpy as np
+
+import tabcbm.training.utils as utils
+
+############################################
+## Metric Scheduling
+############################################
+
+# Sentinel returned by utils.posible_load when a metric is not cached
+_NOT_CACHED = object()
+
+
+class MetricTask(object):
+    """
+    A metric to be computed by `run_metrics`.
+
+    `fn` must be a module-level function (so that it can be sent to a worker
+    process) and it is called as `fn(**arrays, **kwargs)`, where `arrays`
+    maps each of its arguments to the name of one of the shared input arrays
+    given to `run_metrics`. `key` is the key (or list of keys) under which
+    the metric's result(s) are cached, exactly as in `utils.posible_load`.
+    If `seed` is given, all global RNGs are reset with `utils.restart_seeds`
+    right before calling `fn` so that its result does not depend on whether
+    it runs in this process or in a worker.
+    """
+
+    def __init__(self, key, fn, arrays=None, kwargs=None, seed=None):
+        self.key = key
+        self.fn = fn
+        self.arrays = arrays or {}
+        self.kwargs = kwargs or {}
+        self.seed = seed
+
+
+def _to_shared_memory(array):
+    array = np.ascontiguousarray(array)
+    shm = multiprocessing.shared_memory.SharedMemory(
+        create=True,
+        size=max(array.nbytes, 1),
+    )
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _call_task(fn, arrays, kwargs, seed=None):
+    if seed is not None:
+        utils.restart_seeds(seed)
+    return fn(**arrays, **kwargs)
+
+
+def _run_shared_task(fn, array_specs, kwargs, seed=None):
+    # Runs in a worker process: attach to the parent's shared memory blocks
+    # and wrap them into read-only arrays without copying them
+    blocks = []
+    arrays = {}
+    try:
+        for arg_name, (shm_name, shape, dtype) in array_specs.items():
+            shm = multiprocessing.shared_memory.SharedMemory(name=shm_name)
+            blocks.append(shm)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            array.flags.writeable = False
+            arrays[arg_name] = array
+        result = _call_task(fn, arrays, kwargs, seed=seed)
+        # Make sure nothing returned still points to the shared buffers
+        del arrays
+        return result
+    finally:
+        for shm in blocks:
+            shm.close()
+
+
+def run_metrics(
+    tasks,
+    arrays,
+    old_results=None,
+    load_from_cache=True,
+    max_workers=None,
+    mp_start_method="spawn",
+):
+    """
+    Computes all the given independent MetricTasks and returns a dictionary
+    mapping each task's key (as a tuple if it is a list of keys) to its
+    result.
+
+    Metrics already found in old_results are loaded following the same
+    semantics as `utils.posible_load`. If max_workers is greater than one,
+    the remaining metrics are run concurrently on a process pool where all
+    the input arrays are passed through shared memory rather than pickled
+    for every task. Otherwise, they are run one after another in this
+    process.
+    """
+    results = {}
+    pending = []
+    for task in tasks:
+        result_key = tuple(task.key) if isinstance(task.key, list) else task.key
+        result = utils.posible_load(
+            key=task.key,
+            old_results=old_results,
+            load_from_cache=load_from_cache,
+            run_fn=lambda: _NOT_CACHED,
+        )
+        if result is _NOT_CACHED:
+            pending.append((result_key, task))
+        else:
+            results[result_key] = result
+
+    if (max_workers is None) or (max_workers <= 1) or (len(pending) <= 1):
+        for result_key, task in pending:
+            results[result_key] = _call_task(
+                task.fn,
+                {
+                    arg_name: arrays[array_name]
+                    for arg_name, array_name in task.arrays.items()
+                },
+                task.kwargs,
+                seed=task.seed,
+            )
+        return results
+
+    used_arrays = set(
+        array_name
+        for _, task in pending
+        for array_name in task.arrays.values()
+    )
+    blocks = {}
+    try:
+        specs = {}
+        for array_name in used_arrays:
+            blocks[array_name], specs[array_name] = _to_shared_memory(
+                arrays[array_name]
+            )
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(max_workers, len(pending)),
+            mp_context=multiprocessing.get_context(mp_start_method),
+        ) as pool:
+            futures = {
+                result_key: pool.submit(
+                    _run_shared_task,
+                    task.fn,
+                    {
+                        arg_name: specs[array_name]
+                        for arg_name, array_name in task.arrays.items()
+                    },
+                    task.kwargs,
+                    seed=task.seed,
+                )
+                for result_key, task in pending
+            }
+            for result_key, future in futures.items():
+                results[result_key] = future.result()
+    finally:
+        for shm in blocks.values():
+            shm.close()
+            shm.unlink()
+    return results
@@ -1,10 +1,22 @@
 import logging
 import numpy as np
-import sklearn
 
 import tabcbm.metrics as metrics
+import tabcbm.training.metric_scheduler as metric_scheduler
 import tabcbm.training.utils as utils
 
+def _factor_vae(test_concept_scores, c_test, batch_size):
+    return metrics.FactorVAE(
+        ground_truth_X=test_concept_scores,
+        ground_truth_Z=c_test,
+        representation_function=lambda x: x,
+        random_state=np.random.RandomState(0),
+        batch_size=batch_size,
+        num_train=int(test_concept_scores.shape[0] * 0.7),
+        num_eval=int(test_concept_scores.shape[0] * 0.3),
+        num_variance_estimate=int(test_concept_scores.shape[0] * 0.3),
+    )
+
 def evaluate_concept_representations(
     end_results,
     experiment_config,
@@ -14,6 +26,7 @@ def evaluate_concept_representations(
     old_results=None,
     load_from_cache=True,
     prefix="",
+    seed=None,
 ):
     if (c_test is not None) and (
         (experiment_config.get("n_supervised_concepts", 0) != 0) and
@@ -21,16 +34,13 @@ def evaluate_concept_representations(
     ):
         # Then compute the mean concept predictive accuracy
         supervised_concept_idxs = experiment_config['supervised_concept_idxs']
-        avg = 0.0
-        for learnt_concept_idx, real_concept_idx in enumerate(
-            supervised_concept_idxs
-        ):
-            # And select just the labels that are in fact being used
-            avg += sklearn.metrics.roc_auc_score(
-                c_test[:, real_concept_idx],
-                test_concept_scores[:, learnt_concept_idx],
-            )
-        end_results['avg_concept_auc'] = avg / len(supervised_concept_idxs)
+        # And select just the labels that are in fact being used, scoring the
+        # i-th learnt concept against the i-th supervised concept
+        auc_matrix = metrics.pairwise_auc_matrix(
+            scores=test_concept_scores[:, :len(supervised_concept_idxs)],
+            targets=c_test[:, supervised_concept_idxs],
+        )
+        end_results['avg_concept_auc'] = np.mean(np.diagonal(auc_matrix))
         logging.debug(
             prefix +
             f"\t\tMean Concept AUC is {end_results['avg_concept_auc']*100:.2f}%"
@@ -41,86 +51,143 @@ def evaluate_concept_representations(
         # Then nothing else to do in here
         return
     if not experiment_config.get('continuous_concepts', False):
-        # Compute the CAS score
-        logging.debug(prefix + "\t\tComputing CAS...")
-        end_results['cas'], end_results['cas_task'], end_results['best_alignment'] = utils.posible_load(
-            key=['cas', 'cas_task', 'best_alignment'],
-            old_results=old_results,
-            load_from_cache=load_from_cache,
-            run_fn=lambda: metrics.embedding_homogeneity(
-                c_vec=test_concept_scores,
+        # CAS, MIG, SAP, FactorVAE, DCI, and R4 are independent of each other
+        # so we schedule them together, possibly across a process pool
+        logging.debug(
+            prefix + "\t\tComputing CAS, MIG, SAP, FactorVAE, DCI, and R4..."
+        )
+        scheduled = metric_scheduler.run_metrics(
+            tasks=[
+                metric_scheduler.MetricTask(
+                    seed=seed,
+                    key=['cas', 'cas_task', 'best_alignment'],
+                    fn=metrics.embedding_homogeneity,
+                    arrays=dict(
+                        c_vec='test_concept_scores',
+                        c_test='c_test',
+                        y_test='y_test',
+                    ),
+                    kwargs=dict(
+                        step=experiment_config.get('cas_step', 2),
+                        method=experiment_config.get('cas_method', 'kmedoids'),
+                        purity_predictor=experiment_config.get(
+                            'purity_predictor',
+                            'mlp',
+                        ),
+                    ),
+                ),
+                metric_scheduler.MetricTask(
+                    seed=seed,
+                    key='mig',
+                    fn=metrics.MIG,
+                    arrays=dict(Z_true='c_test', Z_learned='test_concept_scores'),
+                    kwargs=dict(bins=experiment_config.get('num_bins', 10)),
+                ),
+                metric_scheduler.MetricTask(
+                    seed=seed,
+                    key='sap',
+                    fn=metrics.SAP,
+                    arrays=dict(V='c_test', Z='test_concept_scores'),
+                ),
+                metric_scheduler.MetricTask(
+                    seed=seed,
+                    key='factor_vae',
+                    fn=_factor_vae,
+                    arrays=dict(
+                        test_concept_scores='test_concept_scores',
+                        c_test='c_test',
+                    ),
+                    kwargs=dict(
+                        batch_size=experiment_config.get('batch_size', 64),
+                    ),
+                ),
+                metric_scheduler.MetricTask(
+                    seed=seed,
+                    key=[
+                        'dci_disentanglement',
+                        'dci_completeness',
+                        'dci_informativeness',
+                    ],
+                    fn=metrics.DCI,
+                    arrays=dict(
+                        gen_factors='c_test',
+                        latents='test_concept_scores',
+                    ),
+                    kwargs=dict(
+                        backend=experiment_config.get('dci_backend', 'gbt'),
+                        max_rows=experiment_config.get('dci_max_rows', None),
+                        n_jobs=experiment_config.get('dci_jobs', None),
+                    ),
+                ),
+                metric_scheduler.MetricTask(
+                    seed=seed,
+                    key='r4',
+                    fn=metrics.R4_scores,
+                    arrays=dict(V='c_test', Z='test_concept_scores'),
+                    kwargs=dict(
+                        estimator=experiment_config.get('r4_estimator', 'gbt'),
+                        n_jobs=experiment_config.get('r4_jobs', None),
+                    ),
+                ),
+            ],
+            arrays=dict(
+                test_concept_scores=test_concept_scores,
                 c_test=c_test,
                 y_test=y_test,
-                step=experiment_config.get('cas_step', 2),
             ),
+            old_results=old_results,
+            load_from_cache=load_from_cache,
+            max_workers=experiment_config.get('metric_workers', 1),
         )
+
+        end_results['cas'], end_results['cas_task'], end_results['best_alignment'] = \
+            scheduled[('cas', 'cas_task', 'best_alignment')]
         logging.debug(
             prefix + f"\t\t\tDone with CAS = {end_results['cas'] * 100:.2f}%"
         )
+        if experiment_config.get('cas_agreement_samples') is not None:
+            # Check how closely the scalable CAS matches the KMedoids one
+            logging.debug(prefix + "\t\tComputing CAS method agreement...")
+            end_results['cas_agreement'] = utils.posible_load(
+                key='cas_agreement',
+                old_results=old_results,
+                load_from_cache=load_from_cache,
+                run_fn=lambda: metrics.embedding_homogeneity_agreement(
+                    c_vec=test_concept_scores,
+                    c_test=c_test,
+                    y_test=y_test,
+                    step=experiment_config.get('cas_step', 2),
+                    alignment=end_results['best_alignment'],
+                    max_samples=experiment_config['cas_agreement_samples'],
+                ),
+            )
+            logging.debug(
+                prefix +
+                f"\t\t\tDone with CAS difference = "
+                f"{end_results['cas_agreement']['cas_diff'] * 100:.2f}%"
+            )
 
-        # Now compute MIG
-        logging.debug(prefix + "\t\tComputing MIG...")
-        end_results['mig'] = utils.posible_load(
-            key='mig',
-            old_results=old_results,
-            load_from_cache=load_from_cache,
-            run_fn=lambda: metrics.MIG(
-                Z_true=c_test,
-                Z_learned=test_concept_scores,
-                bins=experiment_config.get('num_bins', 10)
-            ),
-        )
+        end_results['mig'] = scheduled['mig']
         logging.debug(
             prefix + f"\t\t\tDone with MIG = {end_results['mig'] * 100:.2f}%"
         )
 
-        # Now compute SAP
-        logging.debug(prefix + "\t\tComputing SAP...")
-        end_results['sap'] = utils.posible_load(
-            key='sap',
-            old_results=old_results,
-            load_from_cache=load_from_cache,
-            run_fn=lambda: metrics.SAP(
-                V=c_test,
-                Z=test_concept_scores,
-            ),
-        )
+        end_results['sap'] = scheduled['sap']
         logging.debug(
             prefix + f"\t\t\tDone with SAP = {end_results['sap'] * 100:.2f}%"
         )
 
-        # And go for FactorVAE
-        logging.debug(prefix + "\t\tComputing FactorVAE Scores...")
-        end_results['factor_vae'] = utils.posible_load(
-            key='factor_vae',
-            old_results=old_results,
-            load_from_cache=load_from_cache,
-            run_fn=lambda: metrics.FactorVAE(
-                ground_truth_X=test_concept_scores,
-                ground_truth_Z=c_test,
-                representation_function=lambda x: x,
-                random_state=np.random.RandomState(0),
-                batch_size=experiment_config.get('batch_size', 64),
-                num_train=int(test_concept_scores.shape[0] * 0.7),
-                num_eval=int(test_concept_scores.shape[0] * 0.3),
-                num_variance_estimate=int(test_concept_scores.shape[0] * 0.3),
-            ),
-        )
+        end_results['factor_vae'] = scheduled['factor_vae']
         logging.debug(
             prefix + f"\t\t\tDone with FactorVAE = {end_results['factor_vae'] * 100:.2f}%"
         )
 
-        # Then DCI
-        logging.debug(prefix + "\t\tComputing DCI Scores...")
-        end_results['dci_disentanglement'], end_results['dci_completeness'], end_results['dci_informativeness'] = utils.posible_load(
-            key=['dci_disentanglement', 'dci_completeness', 'dci_informativeness'],
-            old_results=old_results,
-            load_from_cache=load_from_cache,
-            run_fn=lambda: metrics.DCI(
-                gen_factors=c_test,
-                latents=test_concept_scores,
-            ),
-        )
+        end_results['dci_disentanglement'], end_results['dci_completeness'], end_results['dci_informativeness'] = \
+            scheduled[(
+                'dci_disentanglement',
+                'dci_completeness',
+                'dci_informativeness',
+            )]
         logging.debug(
             prefix +
             f"\t\t\tDone DCI disentanglement = "
@@ -137,17 +204,7 @@ def evaluate_concept_representations(
             f"{end_results['dci_informativeness']*100:.2f}%"
         )
 
-        # R4 Scores
-        logging.debug(prefix + "\t\tComputing R4 Score...")
-        end_results['r4'] = utils.posible_load(
-            key='r4',
-            old_results=old_results,
-            load_from_cache=load_from_cache,
-            run_fn=lambda: metrics.R4_scores(
-                V=c_test,
-                Z=test_concept_scores,
-            ),
-        )
+        end_results['r4'] = scheduled['r4']
         logging.debug(
             prefix + f"\t\t\tDone with R4 = {end_results['r4'] * 100:.2f}%"
         )
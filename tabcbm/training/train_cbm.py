@@ -420,6 +420,7 @@ def train_cbm(
             old_results=old_results,
             load_from_cache=load_from_cache,
             prefix=prefix,
+            seed=seed,
         )
 
         if experiment_config.get('perform_interventions', True):
@@ -8,6 +8,7 @@ import tensorflow as tf
 import tabcbm.concepts_xai.evaluation.metrics.completeness as completeness
 import tabcbm.concepts_xai.methods.OCACE.topicModel as CCD
 import tabcbm.models.models as models
+import tabcbm.training.data_pipeline as data_pipeline
 import tabcbm.training.representation_evaluation as representation_evaluation
 import tabcbm.training.utils as utils
 
@@ -141,12 +142,14 @@ def train_ccd(
             callbacks = [early_stopping_monitor]
         end_to_end_hist, end_to_end_time_trained = utils.timeit(
             end_to_end_model.fit,
-            x=x_train,
-            y=y_train,
+            **data_pipeline.TrialDatasets(
+                experiment_config,
+                seed=seed,
+                x=x_train,
+                y=y_train,
+            ).fit_kwargs(x="x", y="y"),
             epochs=experiment_config["pretrain_epochs"],
-            batch_size=experiment_config["batch_size"],
             callbacks=callbacks,
-            validation_split=experiment_config["holdout_fraction"],
             verbose=verbosity,
         )
         end_to_end_epochs_trained = len(end_to_end_hist.history['loss'])
@@ -297,12 +300,14 @@ def train_ccd(
         )
         ccd_hist, ccd_time_trained = utils.timeit(
             topic_model.fit,
-            x=train_encodings,
-            y=y_train,
+            **data_pipeline.TrialDatasets(
+                experiment_config,
+                seed=seed,
+                x=train_encodings,
+                y=y_train,
+            ).fit_kwargs(x="x", y="y"),
             callbacks=callbacks,
             epochs=experiment_config["max_epochs"],
-            batch_size=experiment_config["batch_size"],
-            validation_split=experiment_config["holdout_fraction"],
             verbose=verbosity,
         )
         logging.debug(prefix + "\tCCD's topic model training completed")
@@ -389,6 +394,7 @@ def train_ccd(
             old_results=old_results,
             load_from_cache=load_from_cache,
             prefix=prefix,
+            seed=seed,
         )
 
     # Let's see our topic model's completeness
@@ -366,6 +366,7 @@ def train_cem(
             old_results=old_results,
             load_from_cache=load_from_cache,
             prefix=prefix,
+            seed=seed,
         )
 
         if experiment_config.get('perform_interventions', True):
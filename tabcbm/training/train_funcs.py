@@ -6,6 +6,7 @@ import logging
 import multiprocessing
 import numpy as np
 import os
+import scipy.sparse
 import tensorflow as tf
 import torch
 
@@ -28,6 +29,10 @@ from tabcbm.training.train_tabcbm import train_tabcbm
 from tabcbm.training.train_tabnet import train_tabnet
 from tabcbm.training.train_tabtransformer import train_tabtransformer
 
+# Models that can be trained directly on scipy sparse inputs. All other
+# models are given a dense copy of any sparse dataset
+SPARSE_INPUT_MODELS = ['tabcbm', 'mlp']
+
 ############################################
 ## Utils
 ############################################
@@ -379,6 +384,19 @@ def experiment_loop(
                     x_train = cast_fn(x_train)
                 if x_test is not None:
                     x_test = cast_fn(x_test)
+                run_x_train, run_x_test = x_train, x_test
+                if scipy.sparse.issparse(x_train):
+                    # Batch normalization over the inputs needs them dense
+                    run_config['sparse_inputs'] = run_config.get(
+                        'sparse_inputs',
+                        not run_config.get('include_bn', False),
+                    ) and (arch_name in SPARSE_INPUT_MODELS)
+                    if not run_config['sparse_inputs']:
+                        logging.debug(
+                            f"\tDensifying sparse inputs for {arch}"
+                        )
+                        run_x_train = x_train.toarray()
+                        run_x_test = x_test.toarray()
 
                 # Set up[ a local directory for this model to use for its results
                 run_config["results_dir"] = os.path.join(base_results_dir, arch)
@@ -454,10 +472,10 @@ def experiment_loop(
                 elif not multiprocess_inference:
                     trial_results = train_fn(
                         experiment_config=run_config,
-                        x_train=x_train,
+                        x_train=run_x_train,
                         y_train=y_train,
                         c_train=c_train,
-                        x_test=x_test,
+                        x_test=run_x_test,
                         y_test=y_test,
                         c_test=c_test,
                         load_from_cache=load_from_cache and (not force_rerun),
@@ -484,10 +502,10 @@ def experiment_loop(
                         kwargs=dict(
                             trial_results=trial_results,
                             experiment_config=run_config,
-                            x_train=x_train,
+                            x_train=run_x_train,
                             y_train=y_train,
                             c_train=c_train,
-                            x_test=x_test,
+                            x_test=run_x_test,
                             y_test=y_test,
                             c_test=c_test,
                             load_from_cache=load_from_cache and (not force_rerun),
@@ -6,6 +6,7 @@ import sklearn
 import tensorflow as tf
 
 import tabcbm.models.models as models
+import tabcbm.training.data_pipeline as data_pipeline
 import tabcbm.training.utils as utils
 
 ############################################
@@ -50,11 +51,13 @@ def train_mlp(
             emb_dims=cat_feat_inds,
             emb_in_size=cat_dims,
             emb_out_size=experiment_config.get("emb_out_size", 1),
+            sparse_inputs=experiment_config.get("sparse_inputs", False),
         ),
         decoder=models.construct_decoder(
             units=experiment_config["decoder_units"],
             num_outputs=experiment_config["num_outputs"],
         ),
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
 
     end_to_end_model_path = os.path.join(
@@ -101,12 +104,14 @@ def train_mlp(
             callbacks = [early_stopping_monitor]
         end_to_end_hist, end_to_end_time_trained = utils.timeit(
             end_to_end_model.fit,
-            x=x_train,
-            y=y_train,
+            **data_pipeline.TrialDatasets(
+                experiment_config,
+                seed=seed,
+                x=x_train,
+                y=y_train,
+            ).fit_kwargs(x="x", y="y"),
             epochs=experiment_config["max_epochs"],
-            batch_size=experiment_config["batch_size"],
             callbacks=callbacks,
-            validation_split=experiment_config["holdout_fraction"],
             verbose=verbosity,
         )
         end_to_end_epochs_trained = len(end_to_end_hist.history['loss'])
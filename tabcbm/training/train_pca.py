@@ -73,6 +73,7 @@ def train_pca(
             old_results=old_results,
             load_from_cache=load_from_cache,
             prefix=prefix,
+            seed=seed,
         )
 
     if return_model:
@@ -6,6 +6,7 @@ import sklearn
 import tensorflow as tf
 
 import tabcbm.models.models as models
+import tabcbm.training.data_pipeline as data_pipeline
 import tabcbm.training.representation_evaluation as representation_evaluation
 import tabcbm.training.utils as utils
 import tabcbm.concepts_xai.methods.VAE.betaVAE as beta_vae
@@ -52,7 +53,13 @@ def train_senn(
     end_results = trial_results if trial_results is not None else {}
     old_results = (old_results or {}) if load_from_cache else {}
     verbosity = experiment_config.get("verbosity", 0)
-
+    # Input pipeline shared by all of our training stages
+    datasets = data_pipeline.TrialDatasets(
+        experiment_config,
+        seed=seed,
+        x=x_train,
+        y=y_train,
+    )
 
     # Proceed to do and end-to-end model in case we want to
     # do some task-specific pretraining
@@ -143,10 +150,8 @@ def train_senn(
                 callbacks = []
             autoencoder_hist, autoencoder_time_trained = utils.timeit(
                 autoencoder.fit,
-                x=x_train,
+                **datasets.fit_kwargs(x="x", y=None),
                 epochs=experiment_config["pretrain_autoencoder_epochs"],
-                batch_size=experiment_config["batch_size"],
-                validation_split=experiment_config["holdout_fraction"],
                 verbose=verbosity,
                 callbacks=callbacks,
             )
@@ -204,12 +209,9 @@ def train_senn(
 
         senn_hist, senn_time_trained = utils.timeit(
             senn_model.fit,
-            x=x_train,
-            y=y_train,
+            **datasets.fit_kwargs(x="x", y="y"),
             epochs=experiment_config["max_epochs"],
-            batch_size=experiment_config["batch_size"],
             callbacks=callbacks,
-            validation_split=experiment_config["holdout_fraction"],
             verbose=verbosity,
         )
         senn_epochs_trained = len(senn_hist.history['loss'])
@@ -276,6 +278,7 @@ def train_senn(
         old_results=old_results,
         load_from_cache=load_from_cache,
         prefix=prefix,
+        seed=seed,
     )
 
     logging.debug(prefix + "\t\tDone with evaluation...")
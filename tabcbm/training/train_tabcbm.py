@@ -10,10 +10,12 @@ from pathlib import Path
 
 import tabcbm.metrics as metrics
 import tabcbm.models.models as models
+import tabcbm.training.data_pipeline as data_pipeline
+import tabcbm.training.interventions as interventions
 import tabcbm.training.representation_evaluation as representation_evaluation
 import tabcbm.training.utils as utils
 
-from tabcbm.models.tabcbm import TabCBM
+from tabcbm.models.tabcbm import TabCBM, copula_factors
 from tabcbm.training.train_ccd import ccd_compute_k
 
 ############################################
@@ -29,6 +31,20 @@ def invert_map(align):
     return [mapping[i] for i in range(len(mapping))]
 
 
+def predict_bottleneck(model, x, batch_size):
+    # Computes the bottleneck of all samples in x one batch at a time. Rows of
+    # scipy sparse matrices are fed to the model as tf.SparseTensors
+    return np.concatenate(
+        [
+            model.predict_bottleneck(
+                data_pipeline.to_model_inputs(x[start:(start + batch_size)])
+            )[1].numpy()
+            for start in range(0, x.shape[0], batch_size)
+        ],
+        axis=0,
+    )
+
+
 ############################################
 ## TabCBM Training
 ############################################
@@ -80,6 +96,7 @@ def train_tabcbm(
         emb_in_size=cat_dims,
         emb_out_size=experiment_config.get("emb_out_size", 1),
         return_embedding_extractor=return_embedding_extractor,
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
     if return_embedding_extractor:
         # Then unpack the encoder into its constituent pieces
@@ -96,6 +113,7 @@ def train_tabcbm(
             units=experiment_config["decoder_units"],
             num_outputs=experiment_config["num_outputs"],
         ),
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
 
     encoder_path = os.path.join(
@@ -103,6 +121,13 @@ def train_tabcbm(
         f"models/pretrained_encoder{extra_name}"
     )
     decoder_path = encoder_path.replace("pretrained_encoder", "pretrained_decoder")
+    # Input pipeline shared by all of our training stages
+    datasets = data_pipeline.TrialDatasets(
+        experiment_config,
+        seed=seed,
+        x=x_train,
+        y=y_train,
+    )
     if  load_from_cache and os.path.exists(encoder_path):
         logging.debug(prefix + "Found encoder/decoder models serialized! We will unload them into the end-to-end model!")
         # Then time to load up the end-to-end model!
@@ -121,6 +146,7 @@ def train_tabcbm(
             learning_rate=experiment_config["learning_rate"],
             encoder=encoder,
             decoder=decoder,
+            sparse_inputs=experiment_config.get("sparse_inputs", False),
         )
     pretrained_epochs_trained = None
     pretrained_time_trained = None
@@ -160,12 +186,9 @@ def train_tabcbm(
                 callbacks = [early_stopping_monitor]
             pretrain_hist, pretrain_time_trained = utils.timeit(
                 end_to_end_model.fit,
-                x=x_train,
-                y=y_train,
+                **datasets.fit_kwargs(x="x", y="y"),
                 epochs=experiment_config["pretrain_epochs"],
-                batch_size=experiment_config["batch_size"],
                 callbacks=callbacks,
-                validation_split=experiment_config["holdout_fraction"],
                 verbose=verbosity,
             )
             pretrain_epochs_trained = len(pretrain_hist.history['loss'])
@@ -226,9 +249,30 @@ def train_tabcbm(
         f"{np.sum([np.prod(K.get_value(p).shape) for p in end_to_end_model.trainable_weights])}"
     )
     try:
-        cov_mat = cov_mat if cov_mat is not None else np.corrcoef(x_train.T)
-    except:
-        cov_mat = None
+        # The correlation matrix and its Cholesky factor only depend on the
+        # training data so we share them across all models and runs built on
+        # this same data
+        cov_rank = experiment_config.get('cov_rank', None)
+        cov_mat, cov_factors = copula_factors(
+            X=x_train,
+            cov_mat=cov_mat,
+            cache_dir=os.path.join(
+                experiment_config["results_dir"],
+                "copula_cache",
+            ),
+            rank=cov_rank,
+        )
+        cov_cholesky = cov_factors if cov_rank is None else None
+        cov_low_rank_factors = cov_factors if cov_rank is not None else None
+    except (np.linalg.LinAlgError, ValueError) as e:
+        # Non-finite correlations or a failed eigendecomposition. Non positive
+        # definite matrices are already handled by copula_factors
+        logging.warning(
+            prefix + "Could not factorize the feature correlation matrix "
+            f"({e}). Assuming independence between features in TabCBM "
+            "training."
+        )
+        cov_mat, cov_cholesky, cov_low_rank_factors = None, None, None
     tab_cbm_params = dict(
         features_to_concepts_model=embedding_to_code,
         features_to_embeddings_model=features_to_embedding,
@@ -237,6 +281,9 @@ def train_tabcbm(
         n_concepts=experiment_config['n_concepts'],
         n_supervised_concepts=experiment_config.get('n_supervised_concepts', 0),
         cov_mat=cov_mat,
+        cov_cholesky=cov_cholesky,
+        cov_rank=experiment_config.get('cov_rank', None),
+        cov_low_rank_factors=cov_low_rank_factors,
         gate_estimator_weight=experiment_config["gate_estimator_weight"],
 
         threshold=experiment_config.get("threshold", 0),
@@ -257,7 +304,18 @@ def train_tabcbm(
         ),
         concept_generator_units=experiment_config.get('concept_generator_units', [64]),
         rec_model_units=experiment_config.get('rec_model_units', [64]),
+        fused_concept_generators=experiment_config.get(
+            'fused_concept_generators',
+            False,
+        ),
+        batched_concept_scores=experiment_config.get(
+            'batched_concept_scores',
+            False,
+        ),
+        jit_compile_steps=experiment_config.get('jit_compile', False),
+        shared_noise_draw=experiment_config.get('shared_noise_draw', False),
         forward_deterministic=experiment_config.get('forward_deterministic', True),
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
     tabcbm_model_path = os.path.join(
         experiment_config["results_dir"],
@@ -304,10 +362,19 @@ def train_tabcbm(
             c_train_real[:, :] = np.nan
             for i, idx in enumerate(supervised_concept_idxs):
                 c_train_real[selected_samples, i] = c_train[selected_samples, idx]
-            y_train_tensors = (y_train, c_train_real)
+            # Our targets now include the concept labels so we need to extend
+            # our input pipeline with them
+            datasets = data_pipeline.TrialDatasets(
+                experiment_config,
+                seed=seed,
+                x=x_train,
+                y=y_train,
+                c=c_train_real,
+            )
+            target_keys = ("y", "c")
     else:
-        y_train_tensors = y_train
         c_train_real = c_train
+        target_keys = "y"
     if load_from_cache and os.path.exists(os.path.join(tabcbm_model_path, 'checkpoint')):
         logging.debug(
             prefix +
@@ -319,11 +386,11 @@ def train_tabcbm(
         )
         tabcbm.compile(optimizer=optimizer_gen())
         tabcbm._compute_supervised_loss(
-            x_test[:2, :],
+            data_pipeline.to_model_inputs(x_test[:2, :]),
             y_test[:2],
             c_true=c_train_real[:2, :] if c_train_real is not None else None,
         )
-        tabcbm(x_test[:2, :])
+        tabcbm(data_pipeline.to_model_inputs(x_test[:2, :]))
         tabcbm.load_weights(os.path.join(tabcbm_model_path, 'checkpoint'))
 
         ss_tabcbm_time_trained = old_results.get('ss_time_trained')
@@ -343,7 +410,9 @@ def train_tabcbm(
                 experiment_config.get("learning_rate", 1e-3),
             )
         )
-        ss_tabcbm._compute_self_supervised_loss(x_test[:2, :])
+        ss_tabcbm._compute_self_supervised_loss(
+            data_pipeline.to_model_inputs(x_test[:2, :])
+        )
         ss_tabcbm.set_weights(ss_tabcbm.get_weights())
         if experiment_config["self_supervised_train_epochs"]:
             logging.info(prefix + "TabCBM self-supervised training stage...")
@@ -385,15 +454,12 @@ def train_tabcbm(
                 ]
             else:
                 callbacks = [early_stopping_monitor]
-            ss_tabcbm(x_test[:2, :])
+            ss_tabcbm(data_pipeline.to_model_inputs(x_test[:2, :]))
             ss_tabcbm.summary()
             ss_tabcbm_hist, ss_tabcbm_time_trained = utils.timeit(
                 ss_tabcbm.fit,
-                x=x_train,
-                y=y_train_tensors,
-                validation_split=experiment_config["holdout_fraction"],
+                **datasets.fit_kwargs(x="x", y=target_keys),
                 epochs=experiment_config["self_supervised_train_epochs"],
-                batch_size=experiment_config["batch_size"],
                 verbose=verbosity,
                 callbacks=callbacks,
             )
@@ -419,7 +485,7 @@ def train_tabcbm(
         )
         tabcbm.compile(optimizer=optimizer_gen())
         tabcbm._compute_supervised_loss(
-            x_test[:2, :],
+            data_pipeline.to_model_inputs(x_test[:2, :]),
             y_test[:2],
             c_true=(
                 c_train_real[:2, :]
@@ -467,11 +533,8 @@ def train_tabcbm(
 
         tabcbm_hist, tabcbm_time_trained = utils.timeit(
             tabcbm.fit,
-            x=x_train,
-            y=y_train_tensors,
-            validation_split=experiment_config["holdout_fraction"],
+            **datasets.fit_kwargs(x="x", y=target_keys),
             epochs=experiment_config["max_epochs"],
-            batch_size=experiment_config["batch_size"],
             verbose=verbosity,
             callbacks=callbacks,
         )
@@ -604,6 +667,7 @@ def train_tabcbm(
         old_results=old_results,
         load_from_cache=load_from_cache,
         prefix=prefix,
+        seed=seed,
     )
 
     n_ground_truth_concepts = -1
@@ -616,6 +680,52 @@ def train_tabcbm(
     ):
         # Then time to do some interventions!
         logging.debug(prefix + f"\t\tPerforming concept interventions")
+        test_bottleneck = predict_bottleneck(
+            tabcbm,
+            x_test,
+            batch_size=experiment_config["batch_size"],
+        )
+
+        def _intervention_sweep(
+            learnt_concept_idxs,
+            real_concept_idxs,
+            key_prefix,
+            key_suffix,
+            load_from_cache,
+        ):
+            # Stores the accuracy of intervening on 1, 2, ... of the given
+            # learnt concepts in end_results
+            n_interveneable = len(learnt_concept_idxs)
+            sweep = interventions.intervention_sweep(
+                model=tabcbm,
+                test_bottleneck=test_bottleneck,
+                y_test=y_test,
+                c_test=c_test,
+                train_concept_scores=train_concept_scores,
+                c_train=c_train,
+                learnt_concept_idxs=learnt_concept_idxs,
+                real_concept_idxs=real_concept_idxs,
+                key_prefix=key_prefix,
+                key_suffix=key_suffix,
+                old_results=old_results,
+                load_from_cache=load_from_cache,
+                trials=experiment_config.get('intervention_trials', 5),
+                max_batch_rows=experiment_config.get(
+                    'intervention_batch_rows',
+                    2**20,
+                ),
+            )
+            for num_intervened_concepts in range(1, n_interveneable + 1):
+                key = f'{key_prefix}{num_intervened_concepts}{key_suffix}'
+                end_results[key] = sweep[key]
+                logging.debug(
+                    prefix +
+                    f"\t\t\tIntervention accuracy with "
+                    f"{num_intervened_concepts}/{n_interveneable} "
+                    f"interveneable concepts ({key}): "
+                    f"{end_results[key] * 100:.2f}%"
+                )
+
         threshs = experiment_config.get(
             'usable_concept_threshold',
             [0.85],
@@ -652,82 +762,17 @@ def train_tabcbm(
                 prefix + f"\t\t\tNumber of concepts we will intervene on " +
                 f"is {interveneable_concepts}/{experiment_config['n_concepts']}"
             )
-            _, test_bottleneck = tabcbm.predict_bottleneck(x_test)
-            test_bottleneck = test_bottleneck.numpy()
-            one_hot_labels = tf.keras.utils.to_categorical(y_test)
-            for num_intervened_concepts in range(1, interveneable_concepts + 1):
-                def _run():
-                    avg = 0.0
-                    for i in range(experiment_config.get('intervention_trials', 5)):
-                        current_sel = np.random.permutation(
-                            list(range(len(selected_concepts_idxs)))
-                        )[:num_intervened_concepts]
-
-                        fixed_used_concept_idxs = selected_concepts_idxs[current_sel]
-                        real_corr_concept_idx = corresponding_real_concepts[current_sel]
-                        new_test_bottleneck = test_bottleneck[:, :]
-                        # We need to figure out the "direction" of the intervention:
-                        #     There is not reason why a learnt concept aligned such that its
-                        #     corresponding ground truth concept is high when the learnt concept
-                        #     is high. Because they are binary, it could perfectly be the case
-                        #     that the alignment happend with the complement.
-                        for learnt_concept_idx, real_concept_idx in zip(
-                            fixed_used_concept_idxs,
-                            real_corr_concept_idx,
-                        ):
-                            correlation = np.corrcoef(
-                                train_concept_scores[:, learnt_concept_idx],
-                                c_train[:, real_concept_idx],
-                            )[0, 1]
-                            pos_score = np.percentile(
-                                train_concept_scores[:, learnt_concept_idx],
-                                95
-                            )
-                            neg_score = np.percentile(
-                                train_concept_scores[:, learnt_concept_idx],
-                                5
-                            )
-                            if correlation > 0:
-                                # Then this is a positive alignment
-                                new_test_bottleneck[:, learnt_concept_idx] = \
-                                    c_test[:, real_concept_idx] * pos_score + (
-                                        (1 - c_test[:, real_concept_idx]) * neg_score
-                                    )
-                            else:
-                                # Else we are aligned with the complement
-                                new_test_bottleneck[:, learnt_concept_idx] =  \
-                                    (1 - c_test[:, real_concept_idx]) * pos_score + (
-                                        c_test[:, real_concept_idx] * neg_score
-                                    )
-                        partial_acc = sklearn.metrics.accuracy_score(
-                            y_test,
-                            np.argmax(
-                                scipy.special.softmax(
-                                    tabcbm.from_bottleneck(new_test_bottleneck),
-                                    axis=-1,
-                                ),
-                                axis=-1
-                            ),
-                        )
-                        avg += partial_acc
-                    return avg / experiment_config.get('intervention_trials', 5)
-
-                key = f'acc_intervention_{num_intervened_concepts}_thresh_{thresh}'
-                end_results[key] = utils.posible_load(
-                    key=key,
-                    old_results=old_results,
-                    load_from_cache=load_from_cache,
-                    run_fn=_run,
-                )
-                logging.debug(
-                    prefix +
-                    f"\t\t\tIntervention accuracy with {num_intervened_concepts} "
-                    f"concepts (thresh = {thresh} with "
-                    f"{interveneable_concepts} interveneable concepts): "
-                    f"{end_results[key] * 100:.2f}%"
-                )
-                if thresh == threshs[-1]:
-                     end_results[f'acc_intervention_{num_intervened_concepts}'] = end_results[key]
+            _intervention_sweep(
+                selected_concepts_idxs,
+                corresponding_real_concepts,
+                key_prefix="acc_intervention_",
+                key_suffix=f'_thresh_{thresh}',
+                load_from_cache=load_from_cache,
+            )
+            if thresh == threshs[-1]:
+                for num_intervened_concepts in range(1, interveneable_concepts + 1):
+                    end_results[f'acc_intervention_{num_intervened_concepts}'] = \
+                        end_results[f'acc_intervention_{num_intervened_concepts}_thresh_{thresh}']
 
         # Now do the same but only for supervised concepts!
         if (
@@ -745,80 +790,13 @@ def train_tabcbm(
                 prefix + f"\t\t\tNumber of supervised concepts we will intervene on " +
                 f"is {interveneable_concepts}/{experiment_config['n_concepts']}"
             )
-            _, test_bottleneck = tabcbm.predict_bottleneck(x_test)
-            test_bottleneck = test_bottleneck.numpy()
-            one_hot_labels = tf.keras.utils.to_categorical(y_test)
-            for num_intervened_concepts in range(1, interveneable_concepts + 1):
-                def _run():
-                    avg = 0.0
-                    for i in range(experiment_config.get('intervention_trials', 5)):
-                        current_sel = np.random.permutation(
-                            list(range(len(selected_concepts_idxs)))
-                        )[:num_intervened_concepts]
-
-                        fixed_used_concept_idxs = selected_concepts_idxs[current_sel]
-                        real_corr_concept_idx = corresponding_real_concepts[current_sel]
-                        new_test_bottleneck = test_bottleneck[:, :]
-                        # We need to figure out the "direction" of the intervention:
-                        #     There is not reason why a learnt concept aligned such that its
-                        #     corresponding ground truth concept is high when the learnt concept
-                        #     is high. Because they are binary, it could perfectly be the case
-                        #     that the alignment happend with the complement.
-                        for learnt_concept_idx, real_concept_idx in zip(
-                            fixed_used_concept_idxs,
-                            real_corr_concept_idx,
-                        ):
-                            correlation = np.corrcoef(
-                                train_concept_scores[:, learnt_concept_idx],
-                                c_train[:, real_concept_idx],
-                            )[0, 1]
-                            pos_score = np.percentile(
-                                train_concept_scores[:, learnt_concept_idx],
-                                95
-                            )
-                            neg_score = np.percentile(
-                                train_concept_scores[:, learnt_concept_idx],
-                                5
-                            )
-                            if correlation > 0:
-                                # Then this is a positive alignment
-                                new_test_bottleneck[:, learnt_concept_idx] = \
-                                    c_test[:, real_concept_idx] * pos_score + (
-                                        (1 - c_test[:, real_concept_idx]) * neg_score
-                                    )
-                            else:
-                                # Else we are aligned with the complement
-                                new_test_bottleneck[:, learnt_concept_idx] =  \
-                                    (1 - c_test[:, real_concept_idx]) * pos_score + (
-                                        c_test[:, real_concept_idx] * neg_score
-                                    )
-                        partial_acc = sklearn.metrics.accuracy_score(
-                            y_test,
-                            np.argmax(
-                                scipy.special.softmax(
-                                    tabcbm.from_bottleneck(new_test_bottleneck),
-                                    axis=-1,
-                                ),
-                                axis=-1
-                            ),
-                        )
-                        avg += partial_acc
-                    return avg / experiment_config.get('intervention_trials', 5)
-
-                key = f'sup_acc_intervention_{num_intervened_concepts}'
-                end_results[key] = utils.posible_load(
-                    key=key,
-                    old_results=old_results,
-                    load_from_cache=False, #load_from_cache,
-                    run_fn=_run,
-                )
-                logging.debug(
-                    prefix +
-                    f"\t\t\tSupervised intervention accuracy with "
-                    f"{num_intervened_concepts} concepts (with "
-                    f"{interveneable_concepts} supervised interveneable "
-                    f"concepts): {end_results[key] * 100:.2f}%"
-                )
+            _intervention_sweep(
+                selected_concepts_idxs,
+                corresponding_real_concepts,
+                key_prefix="sup_acc_intervention_",
+                key_suffix="",
+                load_from_cache=False, #load_from_cache,
+            )
 
         # Now do the same but only for UNSUPERVISED concepts!
         sup_concepts_idxs = list(
@@ -846,82 +824,17 @@ def train_tabcbm(
                 prefix + f"\t\t\tNumber of supervised concepts we will intervene on " +
                 f"is {interveneable_concepts}/{experiment_config['n_concepts']}"
             )
-            _, test_bottleneck = tabcbm.predict_bottleneck(x_test)
-            test_bottleneck = test_bottleneck.numpy()
-            one_hot_labels = tf.keras.utils.to_categorical(y_test)
-            for num_intervened_concepts in range(1, interveneable_concepts + 1):
-                def _run():
-                    avg = 0.0
-                    for i in range(experiment_config.get('intervention_trials', 5)):
-                        current_sel = np.random.permutation(
-                            list(range(len(selected_concepts_idxs)))
-                        )[:num_intervened_concepts]
-
-                        fixed_used_concept_idxs = selected_concepts_idxs[current_sel]
-                        real_corr_concept_idx = corresponding_real_concepts[current_sel]
-                        new_test_bottleneck = test_bottleneck[:, :]
-                        # We need to figure out the "direction" of the intervention:
-                        #     There is not reason why a learnt concept aligned such that its
-                        #     corresponding ground truth concept is high when the learnt concept
-                        #     is high. Because they are binary, it could perfectly be the case
-                        #     that the alignment happend with the complement.
-                        for learnt_concept_idx, real_concept_idx in zip(
-                            fixed_used_concept_idxs,
-                            real_corr_concept_idx,
-                        ):
-                            correlation = np.corrcoef(
-                                train_concept_scores[:, learnt_concept_idx],
-                                c_train[:, real_concept_idx],
-                            )[0, 1]
-                            pos_score = np.percentile(
-                                train_concept_scores[:, learnt_concept_idx],
-                                95
-                            )
-                            neg_score = np.percentile(
-                                train_concept_scores[:, learnt_concept_idx],
-                                5
-                            )
-                            if correlation > 0:
-                                # Then this is a positive alignment
-                                new_test_bottleneck[:, learnt_concept_idx] = \
-                                    c_test[:, real_concept_idx] * pos_score + (
-                                        (1 - c_test[:, real_concept_idx]) * neg_score
-                                    )
-                            else:
-                                # Else we are aligned with the complement
-                                new_test_bottleneck[:, learnt_concept_idx] =  \
-                                    (1 - c_test[:, real_concept_idx]) * pos_score + (
-                                        c_test[:, real_concept_idx] * neg_score
-                                    )
-                        partial_acc = sklearn.metrics.accuracy_score(
-                            y_test,
-                            np.argmax(
-                                scipy.special.softmax(
-                                    tabcbm.from_bottleneck(new_test_bottleneck),
-                                    axis=-1,
-                                ),
-                                axis=-1
-                            ),
-                        )
-                        avg += partial_acc
-                    return avg / experiment_config.get('intervention_trials', 5)
-
-                key = f'unsup_acc_intervention_{num_intervened_concepts}_thresh_{thresh}'
-                end_results[key] = utils.posible_load(
-                    key=key,
-                    old_results=old_results,
-                    load_from_cache=load_from_cache,
-                    run_fn=_run,
-                )
-                logging.debug(
-                    prefix +
-                    f"\t\t\tUnsupervised intervention accuracy "
-                    f"with {num_intervened_concepts} concepts (thresh = "
-                    f"{thresh} with {interveneable_concepts} unsupervised "
-                    f"interveneable concepts): {end_results[key] * 100:.2f}%"
-                )
-                if thresh == threshs[-1]:
-                     end_results[f'unsup_acc_intervention_{num_intervened_concepts}'] = end_results[key]
+            _intervention_sweep(
+                selected_concepts_idxs,
+                corresponding_real_concepts,
+                key_prefix="unsup_acc_intervention_",
+                key_suffix=f'_thresh_{thresh}',
+                load_from_cache=load_from_cache,
+            )
+            if thresh == threshs[-1]:
+                for num_intervened_concepts in range(1, interveneable_concepts + 1):
+                    end_results[f'unsup_acc_intervention_{num_intervened_concepts}'] = \
+                        end_results[f'unsup_acc_intervention_{num_intervened_concepts}_thresh_{thresh}']
 
 
     # Log statistics on the predicted masks
@@ -965,11 +878,6 @@ def train_tabcbm(
                     concept_scores=test_concept_scores,
                     c_test=c_test,
                     reduction=np.mean,
-                    alignment=(
-                        end_results['best_alignment']
-                        if max(experiment_config['n_concepts'], c_test.shape[-1]) > 6
-                        else None
-                    ),
                 )['best_reduced_auc'],
             )
             logging.debug(
@@ -1020,9 +928,6 @@ def train_tabcbm(
         print("Best alignment:", end_results['best_alignment'])
         if experiment_config['n_concepts'] < n_ground_truth_concepts:
             print("Best inv alignment:", end_results['inv_best_alignment'])
-        used_align = end_results['inv_best_alignment'] if (
-                experiment_config['n_concepts'] < n_ground_truth_concepts
-        ) else end_results['best_alignment']
         end_results['best_mean_mask_auc'] = utils.posible_load(
             key='best_mean_mask_auc',
             old_results=old_results,
@@ -1031,11 +936,6 @@ def train_tabcbm(
                 concept_importance_masks=masks,
                 ground_truth_concept_masks=ground_truth_concept_masks,
                 reduction=np.mean,
-                alignment=(
-                    used_align
-                    if max(experiment_config['n_concepts'], c_test.shape[-1]) > 6
-                    else None
-                ),
             )['best_reduced_auc'],
         )
         logging.debug(
@@ -1093,11 +993,6 @@ def train_tabcbm(
                 concept_importance_masks=masks,
                 ground_truth_concept_masks=ground_truth_concept_masks,
                 reduction=np.max,
-                alignment=(
-                    used_align
-                    if max(experiment_config['n_concepts'], c_test.shape[-1]) > 6
-                    else None
-                ),
             )['best_reduced_auc'],
         )
         logging.debug(
@@ -1160,6 +1055,19 @@ def load_tabcbm(
     cat_feat_inds=None,
     cat_dims=None,
 ):
+    cov_rank = experiment_config.get('cov_rank', None)
+    cov_cholesky, cov_low_rank_factors = None, None
+    if cov_mat is not None:
+        cov_mat, cov_factors = copula_factors(
+            cov_mat=cov_mat,
+            cache_dir=os.path.join(
+                experiment_config["results_dir"],
+                "copula_cache",
+            ),
+            rank=cov_rank,
+        )
+        cov_cholesky = cov_factors if cov_rank is None else None
+        cov_low_rank_factors = cov_factors if cov_rank is not None else None
 
     # Proceed to do and end-to-end model in case we want to
     # do some task-specific pretraining
@@ -1177,6 +1085,7 @@ def load_tabcbm(
         emb_in_size=cat_dims,
         emb_out_size=experiment_config.get("emb_out_size", 1),
         return_embedding_extractor=return_embedding_extractor,
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
     if return_embedding_extractor:
         # Then unpack the encoder into its constituent pieces
@@ -1193,6 +1102,7 @@ def load_tabcbm(
             units=experiment_config["decoder_units"],
             num_outputs=experiment_config["num_outputs"],
         ),
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
     tab_cbm_params = dict(
         features_to_concepts_model=embedding_to_code,
@@ -1202,6 +1112,9 @@ def load_tabcbm(
         n_concepts=experiment_config['n_concepts'],
         n_supervised_concepts=experiment_config.get('n_supervised_concepts', 0),
         cov_mat=cov_mat,
+        cov_cholesky=cov_cholesky,
+        cov_rank=experiment_config.get('cov_rank', None),
+        cov_low_rank_factors=cov_low_rank_factors,
         gate_estimator_weight=experiment_config["gate_estimator_weight"],
 
         threshold=experiment_config.get("threshold", 0),
@@ -1222,6 +1135,17 @@ def load_tabcbm(
         ),
         concept_generator_units=experiment_config.get('concept_generator_units', [64]),
         rec_model_units=experiment_config.get('rec_model_units', [64]),
+        fused_concept_generators=experiment_config.get(
+            'fused_concept_generators',
+            False,
+        ),
+        batched_concept_scores=experiment_config.get(
+            'batched_concept_scores',
+            False,
+        ),
+        jit_compile_steps=experiment_config.get('jit_compile', False),
+        shared_noise_draw=experiment_config.get('shared_noise_draw', False),
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
     tabcbm_model_path = os.path.join(
         experiment_config["results_dir"],
@@ -1251,6 +1175,9 @@ def load_tabcbm(
         n_concepts=experiment_config['n_concepts'],
         n_supervised_concepts=experiment_config.get('n_supervised_concepts', 0),
         cov_mat=cov_mat,
+        cov_cholesky=cov_cholesky,
+        cov_rank=experiment_config.get('cov_rank', None),
+        cov_low_rank_factors=cov_low_rank_factors,
         gate_estimator_weight=experiment_config["gate_estimator_weight"],
 
         threshold=experiment_config.get("threshold", 0),
@@ -1271,6 +1198,17 @@ def load_tabcbm(
         ),
         concept_generator_units=experiment_config.get('concept_generator_units', [64]),
         rec_model_units=experiment_config.get('rec_model_units', [64]),
+        fused_concept_generators=experiment_config.get(
+            'fused_concept_generators',
+            False,
+        ),
+        batched_concept_scores=experiment_config.get(
+            'batched_concept_scores',
+            False,
+        ),
+        jit_compile_steps=experiment_config.get('jit_compile', False),
+        shared_noise_draw=experiment_config.get('shared_noise_draw', False),
+        sparse_inputs=experiment_config.get("sparse_inputs", False),
     )
 
     tabcbm = TabCBM(
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+# The copula samplers live next to the TabCBM model, which needs TensorFlow
+pytest.importorskip("tensorflow")
+import tabcbm.models.tabcbm as tabcbm
+
+
+def _factor_correlation(n_features, n_factors, seed):
+    # Correlation matrix of features driven by a few shared latent factors
+    # plus independent noise, as we expect from co-expressed genes
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(size=(n_features, n_factors))
+    cov = loadings @ loadings.T + np.diag(
+        rng.uniform(0.5, 1.5, size=n_features)
+    )
+    std = np.sqrt(np.diag(cov))
+    return cov / np.outer(std, std)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_full_rank_sampler_matches_cholesky_sampler(seed):
+    cov_mat = _factor_correlation(n_features=50, n_factors=3, seed=seed)
+    errors = tabcbm.compare_copula_samplers(
+        cov_mat,
+        rank=50,
+        probs=np.random.default_rng(seed).uniform(0.2, 0.8, size=50),
+        n_samples=20000,
+        seed=seed,
+    )
+    assert errors['cov_rel_error'] < 1e-5
+    # Everything else is down to sampling noise
+    assert errors['max_rate_error'] < 0.03
+    assert errors['max_mask_corr_error'] < 0.06
+    assert errors['mean_mask_corr_error'] < 0.015
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_low_rank_sampler_matches_cholesky_sampler(seed):
+    cov_mat = _factor_correlation(n_features=50, n_factors=3, seed=seed)
+    errors = tabcbm.compare_copula_samplers(
+        cov_mat,
+        rank=3,
+        probs=np.random.default_rng(seed).uniform(0.2, 0.8, size=50),
+        n_samples=20000,
+        seed=seed,
+    )
+    assert errors['cov_rel_error'] < 0.05
+    # The diagonal term keeps the marginal mask probabilities exact
+    assert errors['max_rate_error'] < 0.03
+    assert errors['max_mask_corr_error'] < 0.06
+    assert errors['mean_mask_corr_error'] < 0.015
@@ -0,0 +1,149 @@
+import itertools
+import numpy as np
+import pytest
+import scipy.sparse
+
+import tabcbm.data.scsim as scsim
+
+
+def _simulate(seed, chunk_size=None):
+    # Same simulation parameters as our synthetic single-cell dataset but
+    # for a much smaller number of cells and genes
+    simulator = scsim.scsim(
+        ngenes=300,
+        ncells=500,
+        n_cell_types=5,
+        libloc=7.64,
+        libscale=0.78,
+        mean_rate=7.68,
+        mean_shape=0.34,
+        expoutprob=0.00286,
+        expoutloc=6.15,
+        expoutscale=0.49,
+        diffexpprob=0.025,
+        diffexpdownprob=0.,
+        diffexploc=1.0,
+        diffexpscale=1.0,
+        bcv_dispersion=0.448,
+        bcv_dof=22.087,
+        act_prog_gene_sizes=[30],
+        act_prog_down_prob=0.,
+        act_prog_de_loc=1.0,
+        act_prog_de_scale=1,
+        act_prog_cell_frac=0.3,
+        act_prog_cell_types=[list(range(1, 6))],
+        min_act_prog_usage=0.1,
+        max_act_prog_usage=0.7,
+        seed=seed,
+        chunk_size=chunk_size,
+    )
+    simulator.simulate()
+    return simulator
+
+
+def _summary_statistics(counts):
+    counts = scipy.sparse.csr_matrix(counts)
+    n_entries = counts.shape[0] * counts.shape[1]
+    return {
+        'mean count': counts.sum() / n_entries,
+        'fraction of zeros': 1 - counts.count_nonzero() / n_entries,
+        'mean library size': np.mean(counts.sum(axis=-1)),
+    }
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+@pytest.mark.parametrize("chunk_size", [64, 500])
+def test_chunked_counts_match_unchunked_statistics(seed, chunk_size):
+    dense = _simulate(seed)
+    chunked = _simulate(seed, chunk_size=chunk_size)
+
+    assert scipy.sparse.isspmatrix_csr(chunked.counts)
+    assert chunked.counts.shape == dense.counts.shape
+
+    dense_stats = _summary_statistics(dense.counts.to_numpy())
+    chunked_stats = _summary_statistics(chunked.counts)
+    for name, value in dense_stats.items():
+        assert chunked_stats[name] == pytest.approx(value, rel=0.05), name
+
+
+def _loop_combination_labels(cell_types, has_act_program, n_cell_types):
+    # Reference implementation used before combination labels were vectorized
+    used_combos = set()
+    for i in range(len(cell_types)):
+        used_combos.add((cell_types[i], tuple(has_act_program[i])))
+    combination_label_map = {}
+    for cell_type in range(1, n_cell_types + 1):
+        for activity_program_combo in itertools.product(
+            *[[0, 1] for _ in range(has_act_program.shape[-1])]
+        ):
+            key = (cell_type, tuple(activity_program_combo))
+            if key in used_combos:
+                combination_label_map[key] = len(combination_label_map)
+    return np.array([
+        combination_label_map[(cell_types[i], tuple(has_act_program[i]))]
+        for i in range(len(cell_types))
+    ])
+
+
+def _loop_ground_truth_concept_masks(simulator, n_cell_types, kept_gene_mask):
+    # Reference implementation used before concept masks were vectorized
+    masks = []
+    for prog_idx in range(n_cell_types):
+        masks.append(np.array([
+            # Positional lookup, as the gene parameters are indexed by name
+            1 if simulator.geneparams[
+                f'cell_type_{prog_idx + 1}_gene_selection'
+            ].iloc[j]
+            else 0 for j in range(simulator.ngenes)
+            if kept_gene_mask[j]
+        ]))
+    for prog_idx in range(len(simulator.activity_program_genes)):
+        masks.append(np.array([
+            1 if j in simulator.activity_program_genes[prog_idx] else 0
+            for j in range(simulator.ngenes)
+            if kept_gene_mask[j]
+        ]))
+    return masks
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_combination_labels_match_loop(seed):
+    simulator = _simulate(seed)
+    rng = np.random.default_rng(seed)
+    # Drop some cells (as cell filtering would) so that not every
+    # combination is necessarily present
+    kept_cells = np.sort(rng.choice(simulator.ncells, 400, replace=False))
+    cell_types = simulator.cellparams['cell_type'].to_numpy()[kept_cells]
+    has_act_program = np.stack(
+        simulator.cellparams['has_act_program'].to_numpy()
+    )[kept_cells]
+
+    np.testing.assert_array_equal(
+        scsim.combination_labels(cell_types, has_act_program),
+        _loop_combination_labels(
+            cell_types,
+            has_act_program,
+            simulator.n_cell_types,
+        ),
+    )
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_ground_truth_concept_masks_match_loop(seed):
+    simulator = _simulate(seed)
+    kept_gene_mask = np.random.default_rng(seed).random(simulator.ngenes) < 0.8
+
+    masks = scsim.ground_truth_concept_masks(
+        simulator,
+        n_cell_types=simulator.n_cell_types,
+        kept_gene_mask=kept_gene_mask,
+    )
+    expected = _loop_ground_truth_concept_masks(
+        simulator,
+        simulator.n_cell_types,
+        kept_gene_mask,
+    )
+    assert masks.shape == (len(expected), np.sum(kept_gene_mask))
+    assert masks.dtype == expected[0].dtype
+    for mask, expected_mask in zip(masks, expected):
+        np.testing.assert_array_equal(mask, expected_mask)